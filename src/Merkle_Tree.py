@@ -2,10 +2,17 @@
 # Created by Ao Wang, 15300240004. All rights reserved.
 # This file implements Merkle Tree.
 
+import binascii
 import hashlib
 import json
 from collections import OrderedDict
 
+from metrics import *
+from utils import *
+
+DIGEST_SIZE = 32     # the bytes of a SHA-256 digest
+
+
 class Merkle_Node(object):
     def __init__(self, parent=None, transaction=None, lchild=None, rchild=None):
         self.parent = parent
@@ -25,11 +32,15 @@ class Merkle_Tree(object):
         for trans in self.transaction_list:
             node = Merkle_Node()
             node.transaction = trans
-            temp = json.dumps(node.transaction, sort_keys=True).encode()
-            self.tree_nodes[hashlib.sha256(temp).hexdigest()] = node
+            self.tree_nodes[hash_block(node.transaction)] = node
             self.last_nodes.append(node)
     
     def create_tree(self):
+        with MERKLE_SECONDS.time(kind='tree'):
+            self.create_level()
+
+    def create_level(self):
+        # combine the nodes of the last layer, until the root is left
         if len(self.transaction_list) == 0:
             return
 
@@ -48,12 +59,10 @@ class Merkle_Tree(object):
             # get hash
             if type(current_node.transaction) != str:
                 # it's leaf node, transaction is real
-                temp = json.dumps(current_node.transaction, sort_keys=True).encode()
-                current_hash = hashlib.sha256(temp).hexdigest()
+                current_hash = hash_block(current_node.transaction)
                 # sibling is also leaf node
                 if sibling_node is not None:
-                    temp = json.dumps(sibling_node.transaction, sort_keys=True).encode()
-                    sibling_hash = hashlib.sha256(temp).hexdigest()
+                    sibling_hash = hash_block(sibling_node.transaction)
             else:
                 # the inner nodes, transaction is str
                 current_hash = hashlib.sha256(current_node.transaction.encode()).hexdigest()
@@ -79,7 +88,7 @@ class Merkle_Tree(object):
         
         if len(last_nodes) != 1:
             self.last_nodes = temp_nodes
-            self.create_tree()
+            self.create_level()
         else:
             self.root = last_nodes[0]
     
@@ -91,26 +100,422 @@ class Merkle_Tree(object):
         # Return the dict, hash is the key
         return self.tree_nodes
     
+    def get_proof(self, hash_val):
+        '''
+        Get the audit path of a leaf by following the parents, create the tree first
+        :param hash_val: <str> the hash of the leaf
+        :return: <tuple> (index of the leaf, the hashes of the siblings), None if it's not a leaf
+        '''
+        node = self.tree_nodes.get(hash_val)
+        if node is None or type(node.transaction) == str:
+            return None     # not found, or an inner node
+        index = 0
+        path = []
+        level = 0
+        while node.parent is not None:
+            parent = node.parent
+            if parent.rchild is node:
+                index |= 1 << level
+                sibling = parent.lchild
+            else:
+                sibling = parent.rchild
+            if sibling is None:
+                path.append(None)
+            elif level == 0:
+                path.append(hash_block(sibling.transaction))
+            else:
+                path.append(sibling.transaction)
+            node = parent
+            level += 1
+        return index, path
+
     def get_root_transaction(self):
         # get the top hash result of the root
         # Create the tree first
         if len(self.transaction_list) == 0:
             return None
         elif len(self.transaction_list) == 1:
-            return hashlib.sha256(json.dumps(self.transaction_list[0], sort_keys=True).encode()).hexdigest()
+            return hash_block(self.transaction_list[0])
         else:
             return self.root.transaction
 
 # 检查数据是否被修改就只需要计算一下交易记录的梅克尔树的根节点,然后和区块头的梅克尔跟比较就可以得出结果了。
-    
+
+
+class Merkle_Array_Tree(object):
+    '''
+    Merkle tree over the hashes of the leaves, every level is a bytes buffer of 32-byte digests
+    The levels are built bottom-up without recursion or node objects,
+    and its root is the same as Merkle_Tree.get_root_transaction()
+    '''
+    def __init__(self, transaction_list=[], leaf_hashes=None, keep_nodes=True):
+        '''
+        :param transaction_list: <list> the leaves, hashed by hash_block()
+        :param leaf_hashes: <list> the hashes of the leaves (hex str or 32 bytes) instead of the leaves
+        :param keep_nodes: <bool> keep every level after it's built, False to keep the last one only
+        '''
+        if leaf_hashes is None:
+            leaf_hashes = [hash_block(trans) for trans in transaction_list]
+        self.size = len(leaf_hashes)    # the number of leaves
+        self.keep_nodes = keep_nodes
+        self.leaves = bytearray()
+        for leaf_hash in leaf_hashes:
+            self.leaves += bytes.fromhex(leaf_hash) if isinstance(leaf_hash, str) else leaf_hash
+        self.levels = []    # levels[0] is the leaves, levels[-1] is the root
+
+    @staticmethod
+    def create_level(level, depth):
+        '''
+        Combine the nodes of a level into their parents
+        :param level: <bytes> the digests of the nodes
+        :param depth: <int> 0 for the leaves
+        :return: <bytes> the digests of the parents
+        '''
+        sha256 = hashlib.sha256
+        hexlify = binascii.hexlify
+        view = memoryview(level)
+        count = len(level) // DIGEST_SIZE
+
+        def value(index):
+            # leaves are hashed once, inner nodes are hashed again before combining
+            node = view[index*DIGEST_SIZE:(index+1)*DIGEST_SIZE]
+            if depth == 0:
+                return hexlify(node)
+            return hexlify(sha256(hexlify(node)).digest())
+
+        parents = bytearray()
+        for index in range(0, count - 1, 2):
+            parents += sha256(value(index) + value(index+1)).digest()
+        if count % 2 == 1:
+            parents += sha256(value(count-1)).digest()   # no sibling, hash itself only
+        return bytes(parents)
+
+    def create_tree(self):
+        with MERKLE_SECONDS.time(kind='array'):
+            level = self.leaves
+            self.levels = [level]
+            depth = 0
+            while len(level) > DIGEST_SIZE:
+                level = self.create_level(level, depth)
+                depth += 1
+                if self.keep_nodes:
+                    self.levels.append(level)
+                else:
+                    self.levels = [level]
+
+    def get_levels(self):
+        # Create the tree first
+        return self.levels
+
+    def get_tree_nodes(self):
+        '''
+        Map the hash of every node to its place, the tree should be created with keep_nodes
+        :return: <OrderedDict> hash -> (depth, index)
+        '''
+        tree_nodes = OrderedDict()
+        for depth, level in enumerate(self.levels):
+            for index in range(len(level) // DIGEST_SIZE):
+                tree_nodes[level[index*DIGEST_SIZE:(index+1)*DIGEST_SIZE].hex()] = (depth, index)
+        return tree_nodes
+
+    def get_proof(self, hash_val):
+        '''
+        Get the audit path of a leaf, the tree should be created with keep_nodes
+        :param hash_val: <str> the hash of the leaf, or <int> the index of the leaf
+        :return: <tuple> (index of the leaf, the hashes of the siblings), None if it's not a leaf
+        '''
+        if len(self.levels) == 0:
+            self.create_tree()
+        if isinstance(hash_val, int):
+            leaf_index = hash_val
+        else:
+            leaves = self.levels[0]
+            digest = bytes.fromhex(hash_val)
+            position = leaves.find(digest)
+            while position != -1 and position % DIGEST_SIZE != 0:
+                position = leaves.find(digest, position + 1)
+            if position == -1:
+                return None
+            leaf_index = position // DIGEST_SIZE
+        if not (0 <= leaf_index < self.size):
+            return None
+
+        path = []
+        index = leaf_index
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level) // DIGEST_SIZE:
+                path.append(level[sibling*DIGEST_SIZE:(sibling+1)*DIGEST_SIZE].hex())
+            else:
+                path.append(None)
+            index >>= 1
+        return leaf_index, path
+
+    def get_root_transaction(self):
+        # get the top hash result of the root, the tree is created if not yet
+        if self.size == 0:
+            return None
+        if len(self.levels) == 0:
+            self.create_tree()
+        return self.levels[-1][:DIGEST_SIZE].hex()
+
+
+class Merkle_Accumulator(object):
+    '''
+    Append-only Merkle accumulator over the hashes of the leaves.
+    Only the frontier of peaks (the roots of full subtrees) is kept,
+    and its root is the same as Merkle_Tree.get_root_transaction()
+    With keep_levels, the full subtrees are kept as digest arrays too,
+    so it can prove its leaves and be truncated
+    '''
+    def __init__(self, leaf_hashes=[], keep_levels=False):
+        self.size = 0       # the number of leaves
+        self.peaks = []     # peaks[level] is the node of a full subtree, or None
+        self.root = None    # the cached root of all leaves
+        self.levels = [] if keep_levels else None   # levels[depth] is the digests of the full subtrees
+
+        if len(leaf_hashes) > 0:
+            with MERKLE_SECONDS.time(kind='accumulator'):
+                for leaf_hash in leaf_hashes:
+                    self.push(leaf_hash)
+                self.root = self.compute_root()
+
+    def __setstate__(self, state):
+        # accumulators pickled by older versions keep no levels
+        self.levels = None
+        self.__dict__.update(state)
+
+    @staticmethod
+    def node_hash(level, node):
+        # leaves are hashed once, inner nodes are hashed again before combining
+        if level == 0:
+            return node
+        return hashlib.sha256(node.encode()).hexdigest()
+
+    def keep(self, level, node):
+        # store a full subtree
+        if self.levels is None:
+            return
+        if level == len(self.levels):
+            self.levels.append(bytearray())
+        self.levels[level] += bytes.fromhex(node)
+
+    def push(self, leaf_hash):
+        # add a leaf without updating the root
+        node = leaf_hash
+        level = 0
+        self.keep(level, node)
+        while level < len(self.peaks) and self.peaks[level] is not None:
+            # merge two full subtrees of the same level
+            left = self.node_hash(level, self.peaks[level])
+            right = self.node_hash(level, node)
+            node = hashlib.sha256((left + right).encode()).hexdigest()
+            self.peaks[level] = None
+            level += 1
+            self.keep(level, node)
+        if level == len(self.peaks):
+            self.peaks.append(None)
+        self.peaks[level] = node
+        self.size += 1
+
+    def append(self, leaf_hash):
+        '''
+        Add a leaf to the accumulator, costs O(log n) hashes
+        :param leaf_hash: <str> SHA-256 hash of the leaf, e.g. BlockChain.hash(block)
+        '''
+        self.push(leaf_hash)
+        self.root = self.compute_root()
+
+    def get_root(self):
+        '''
+        Get the root as if the tree of all leaves were built, costs O(1)
+        :return: <str> the root hash, None if there is no leaf
+        '''
+        return self.root
+
+    def compute_root(self):
+        # fold the peaks along the right border of the tree
+        if self.size == 0:
+            return None
+
+        # the lowest peak is the rightmost node of its level
+        level = 0
+        while self.peaks[level] is None:
+            level += 1
+        node = self.peaks[level]
+
+        # climb the right border of the tree
+        while (self.size - 1) >> level != 0:
+            index = (self.size - 1) >> level     # the index of current node in its level
+            current_hash = self.node_hash(level, node)
+            if index % 2 == 1:
+                # the left sibling is a full subtree
+                sibling_hash = self.node_hash(level, self.peaks[level])
+                node = hashlib.sha256((sibling_hash + current_hash).encode()).hexdigest()
+            else:
+                # no sibling, hash itself only
+                node = hashlib.sha256(current_hash.encode()).hexdigest()
+            level += 1
+        return node
+
+    def copy(self):
+        # the copy keeps no levels, it's cheap
+        res = Merkle_Accumulator()
+        res.size = self.size
+        res.peaks = list(self.peaks)
+        res.root = self.root
+        return res
+
+    def snapshot(self):
+        # a frozen view sharing the levels, push() only adds digests after its size and truncate() copies the levels
+        res = self.copy()
+        res.levels = None if self.levels is None else list(self.levels)
+        return res
+
+    def get_leaf(self, index):
+        # the hash of a leaf, the levels are needed
+        return self.levels[0][index*DIGEST_SIZE:(index+1)*DIGEST_SIZE].hex()
+
+    def find_leaf(self, leaf_hash):
+        '''
+        Find a leaf by its hash, the levels are needed
+        :param leaf_hash: <str> the hash of the leaf
+        :return: <int> the index of the leaf, None if it's not found
+        '''
+        digest = bytes.fromhex(leaf_hash)
+        position = self.levels[0].find(digest)
+        while position != -1 and position < self.size * DIGEST_SIZE:
+            if position % DIGEST_SIZE == 0:
+                return position // DIGEST_SIZE
+            position = self.levels[0].find(digest, position + 1)
+        return None
+
+    def get_node(self, level, index, size):
+        '''
+        The node of the tree over the first size leaves, the levels are needed
+        The full subtrees are stored, the nodes on the right border are computed
+        :return: <str> the hash of the node
+        '''
+        if level < len(self.levels) and (index + 1) << level <= size:
+            return self.levels[level][index*DIGEST_SIZE:(index+1)*DIGEST_SIZE].hex()
+        left = self.node_hash(level - 1, self.get_node(level - 1, 2 * index, size))
+        if (2 * index + 1) << (level - 1) < size:
+            right = self.node_hash(level - 1, self.get_node(level - 1, 2 * index + 1, size))
+            return hashlib.sha256((left + right).encode()).hexdigest()
+        return hashlib.sha256(left.encode()).hexdigest()    # no sibling, hash itself only
+
+    def get_proof(self, index, size=None):
+        '''
+        Get the audit path of a leaf in the tree over the first size leaves, the levels are needed
+        :param index: <int> the index of the leaf
+        :param size: <int> the number of leaves in the tree, default is all the leaves
+        :return: <list> the hashes of the siblings from the leaf to the root, None if there is no sibling
+        '''
+        size = self.size if size is None else size
+        path = []
+        level = 0
+        width = size    # the number of nodes in current level
+        while width > 1:
+            sibling = index ^ 1
+            path.append(self.get_node(level, sibling, size) if sibling < width else None)
+            index >>= 1
+            level += 1
+            width = (width + 1) // 2
+        return path
+
+    def prefix(self, size):
+        '''
+        Get the accumulator of the first size leaves, costs O(log n), the levels are needed
+        :param size: <int> the number of leaves
+        :return: <Merkle_Accumulator> without levels
+        '''
+        res = Merkle_Accumulator()
+        res.size = size
+        level = 0
+        while size >> level != 0:
+            if (size >> level) % 2 == 1:
+                res.peaks.append(self.get_node(level, (size >> level) - 1, size))
+            else:
+                res.peaks.append(None)
+            level += 1
+        res.root = res.compute_root()
+        return res
+
+    def truncate(self, size):
+        '''
+        Keep the first size leaves only, costs O(log n), the levels are needed
+        :param size: <int> the number of leaves to keep
+        '''
+        if size >= self.size:
+            return
+        res = self.prefix(size)
+        for level in range(len(self.levels)):
+            self.levels[level] = self.levels[level][:(size >> level) * DIGEST_SIZE]     # a copy for the snapshots
+        while len(self.levels) > 0 and len(self.levels[-1]) == 0:
+            self.levels.pop()
+        self.size = res.size
+        self.peaks = res.peaks
+        self.root = res.root
+
+
+def get_trans_root(transactions):
+    '''
+    Get the root of the Merkle tree over the hashes of the transactions in a block
+    :param transactions: <list> the transactions
+    :return: <str>
+    '''
+    tree = Merkle_Array_Tree(leaf_hashes=[trans['hash'] for trans in transactions], keep_nodes=False)
+    return tree.get_root_transaction()
+
+
+def verify_proof(leaf_hash, index, size, path, root):
+    '''
+    Check an audit path from a leaf to the root, costs O(log n) hashes
+    :param leaf_hash: <str> the hash of the leaf
+    :param index: <int> the index of the leaf
+    :param size: <int> the number of leaves in the tree
+    :param path: <list> the hashes of the siblings, None if there is no sibling
+    :param root: <str> the expected root
+    :return: <bool> True if the leaf is in the tree
+    '''
+    if not (0 <= index < size) or root is None:
+        return False
+    node = leaf_hash
+    level = 0
+    width = size
+    for sibling in path:
+        if width <= 1:
+            return False    # the path is too long
+        current_hash = Merkle_Accumulator.node_hash(level, node)
+        if sibling is None:
+            if index != width - 1 or index % 2 == 1:
+                return False
+            node = hashlib.sha256(current_hash.encode()).hexdigest()
+        else:
+            sibling_hash = Merkle_Accumulator.node_hash(level, sibling)
+            if index % 2 == 1:
+                node = hashlib.sha256((sibling_hash + current_hash).encode()).hexdigest()
+            else:
+                node = hashlib.sha256((current_hash + sibling_hash).encode()).hexdigest()
+        index >>= 1
+        level += 1
+        width = (width + 1) // 2
+    return width == 1 and node == root
+
+
 def Merkle_proof(tree, hash_val):
     """
     Decide whether the hash value is in the tree
-    :param tree: <Merkle_Tree()> a Merkle tree
+    :param tree: <Merkle_Tree()> a Merkle tree, or a Merkle_Array_Tree() with nodes kept
     :param hash_val: <str> the undecided hash value
     :return: <boolean> True or False
     """
-    pass
+    proof = tree.get_proof(hash_val)
+    if proof is None:
+        return False
+    index, path = proof
+    return verify_proof(hash_val, index, len(tree.transaction_list) if isinstance(tree, Merkle_Tree) else tree.size,
+                        path, tree.get_root_transaction())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,387 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the benchmarks of the hot paths on synthetic chains.
+
+import json
+import os
+import pickle
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import deque
+from time import perf_counter, time
+from types import SimpleNamespace
+
+from ecdsa import SigningKey, SECP256k1
+
+from block_chain import *
+from utils import *
+from Merkle_Tree import *
+from miner import *
+from verifier import *
+from wallet import Wallet
+
+
+def generate_chain(height, transactions=1, keys=4, directory=None, seed=0):
+    '''
+    Generate a valid chain with mining rewards and signed transfers
+    No proof is searched, valid_chain does not check it
+    :param height: <int> the number of blocks after the genesis block
+    :param transactions: <int> the transfers in every block besides the reward
+    :param keys: <int> the number of wallets sending and receiving the coins
+    :param directory: <str> the directory to store the chain, None to keep it in memory
+    :param seed: <int> the seed of the random choices
+    :return: <tuple> (BlockChain, the addresses of the wallets)
+    '''
+    rand = random.Random(seed)
+    pri_keys = [SigningKey.generate(curve=SECP256k1) for _ in range(keys)]
+    pub_keys = [pri_key.get_verifying_key().to_string().hex() for pri_key in pri_keys]
+    addresses = [get_wallet_address(pri_key.get_verifying_key()) for pri_key in pri_keys]
+
+    blockchain = BlockChain(directory)
+    if len(blockchain.chain) == 0:
+        block = get_empty_block()
+        block['index'] = 0
+        block['Blockheader']['hashPreBlock'] = 1
+        blockchain.add_block(block)
+
+    unspent = deque()   # [((hash, index), value, owner)], the oldest first
+    for index in range(1, height + 1):
+        block = get_empty_block()
+        block['index'] = index
+        block['Blockheader']['hashPreBlock'] = blockchain.block_hash(-1)
+        block['Blockheader']['hashMerkleRoot'] = blockchain.merkle_root()
+
+        miner = index % keys
+        trans_in = get_trans_in(pre_hash=block['Blockheader']['hashPreBlock'], n=BLOCK_REWARD, sig='system')
+        block['Transaction']['in'].append(trans_in)
+        block['Transaction']['out'].append(get_trans_out(value=BLOCK_REWARD, address=addresses[miner], from_address='system'))
+        block['Transaction']['hash'] = get_trans_hash(block['Transaction'])
+        outputs = [((block['Transaction']['hash'], 0), BLOCK_REWARD, miner)]
+
+        block['Transactions'] = []
+        for _ in range(min(transactions, len(unspent))):
+            key, value, owner = unspent.popleft()
+            target = rand.randrange(keys)
+            prev_out = {'hash': key[0], 'n': value, 'index': key[1]}
+            sig = pri_keys[owner].sign(get_sign_message(prev_out)).hex()
+
+            trans = get_empty_trans()
+            trans['in'].append(get_trans_in(pre_hash=key[0], n=value, sig=sig, pub_key=pub_keys[owner], index=key[1]))
+            trans['out'].append(get_trans_out(value=value/2, address=addresses[target], from_address=addresses[owner]))
+            trans['out'].append(get_trans_out(value=value-value/2, address=addresses[owner], from_address=addresses[owner]))
+            trans['hash'] = get_trans_hash(trans)
+            block['Transactions'].append(trans)
+            outputs.append(((trans['hash'], 0), value/2, target))
+            outputs.append(((trans['hash'], 1), value-value/2, owner))
+        block['Blockheader']['hashTransRoot'] = get_trans_root(get_transactions(block))
+
+        blockchain.add_block(block)
+        unspent.extend(outputs)     # spendable from the next block
+    blockchain.commit(force=True)
+    return blockchain, addresses
+
+
+def measure(func, repeat=3):
+    '''
+    Run a function several times
+    :param func: <function> called without parameters
+    :param repeat: <int> the number of runs
+    :return: <tuple> (the best seconds, the result of the last run)
+    '''
+    best = None
+    res = None
+    for _ in range(repeat):
+        start = perf_counter()
+        res = func()
+        seconds = perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, res
+
+
+def make_result(seconds, count, unit, **extra):
+    res = {
+        'seconds': seconds,
+        'count': count,
+        'unit': unit,
+        'per_second': count / seconds if seconds > 0 else 0.0,
+    }
+    res.update(extra)
+    return res
+
+
+def bench_proof_of_work(blockchain, args):
+    results = {}
+    for name, miner in [('serial', SerialMiner(args.difficulty)), ('parallel', ParallelMiner(args.workers, args.difficulty))]:
+        hashes = 0
+        start = perf_counter()
+        for _ in range(args.repeat):
+            miner.mine(int(get_random_256(), 16))
+            hashes += sum([stats['hashes'] for stats in miner.get_stats()])
+        seconds = perf_counter() - start
+        results['proof_of_work.' + name] = make_result(seconds / args.repeat, hashes / args.repeat, 'hashes',
+                                                       difficulty=args.difficulty)
+        if isinstance(miner, ParallelMiner):
+            miner.close()
+    return results
+
+
+def bench_merkle(blockchain, args):
+    count = min(len(blockchain.chain), args.merkle_leaves)
+    blocks = blockchain.chain[:count]
+    hashes = [blockchain.block_hash(height) for height in range(count)]
+    seconds, _ = measure(lambda: Merkle_Tree(blocks).create_tree(), args.repeat)
+    results = {'merkle.create_tree': make_result(seconds, count, 'leaves')}
+    seconds, _ = measure(lambda: Merkle_Array_Tree(leaf_hashes=hashes).create_tree(), args.repeat)
+    results['merkle.array'] = make_result(seconds, count, 'leaves')
+    seconds, _ = measure(lambda: Merkle_Array_Tree(leaf_hashes=hashes, keep_nodes=False).create_tree(), args.repeat)
+    results['merkle.array_root_only'] = make_result(seconds, count, 'leaves')
+    seconds, _ = measure(lambda: Merkle_Accumulator(hashes).get_root(), args.repeat)
+    results['merkle.accumulator'] = make_result(seconds, count, 'leaves')
+    return results
+
+
+def bench_valid_chain(blockchain, args):
+    chain = blockchain.chain
+    # every input not from mining is signed
+    signatures = sum([len([trans_in for trans_in in trans['in'] if trans_in['sig'] != 'system'])
+                      for block in chain for trans in get_transactions(block)])
+
+    def cold():
+        # nothing cached: a new node validating the chain
+        validator = BlockChain()
+        validator.verifier = SignatureVerifier(args.workers)
+        assert validator.valid_chain(chain) is True
+        validator.verifier.close()
+
+    warm = BlockChain()
+    def revalidate():
+        # the signatures are cached, the watermark is not used
+        warm.validated_height = -1
+        assert warm.valid_chain(chain) is True
+
+    results = {}
+    seconds, _ = measure(cold, args.repeat)
+    revalidate()    # fill the cache
+    results['valid_chain.cold'] = make_result(seconds, len(chain), 'blocks', signatures=signatures)
+    seconds, _ = measure(revalidate, args.repeat)
+    results['valid_chain.cached'] = make_result(seconds, len(chain), 'blocks', signatures=signatures)
+    seconds, _ = measure(lambda: warm.valid_chain(chain), args.repeat)
+    results['valid_chain.watermark'] = make_result(seconds, len(chain), 'blocks')
+    return results
+
+
+def bench_balance(blockchain, args):
+    addresses = args.addresses
+    lookups = 10000
+    def lookup():
+        for i in range(lookups):
+            blockchain.utxo.get_balance(addresses[i % len(addresses)])
+
+    wallet = SimpleNamespace(address=addresses[0])
+    def scan():
+        # the balance computed from every block, as older versions did
+        return sum([Wallet.get_block_balance(wallet, block) for block in blockchain.chain])
+
+    def rebuild():
+        utxo = UTXOSet()
+        for height, block in enumerate(blockchain.chain):
+            utxo.connect_block(block, blockchain.block_hash(height))
+        return utxo
+
+    results = {}
+    seconds, _ = measure(lookup, args.repeat)
+    results['balance.utxo_lookup'] = make_result(seconds, lookups, 'lookups')
+    seconds, _ = measure(scan, args.repeat)
+    results['balance.block_scan'] = make_result(seconds, len(blockchain.chain), 'blocks')
+    seconds, _ = measure(rebuild, args.repeat)
+    results['balance.utxo_rebuild'] = make_result(seconds, len(blockchain.chain), 'blocks')
+    return results
+
+
+def bench_filters(blockchain, args):
+    results = {}
+    for name, address in [('member', args.addresses[0]), ('absent', 'nobody')]:
+        wallet = SimpleNamespace(address=address)
+        def scan():
+            # every block is read
+            return sum([Wallet.get_block_balance(wallet, block) for block in blockchain.chain])
+        def match():
+            # only the matching blocks are read
+            return sum([Wallet.get_block_balance(wallet, blockchain.chain[height])
+                        for height in blockchain.match_blocks([address])])
+        seconds, _ = measure(scan, args.repeat)
+        results['filters.scan_' + name] = make_result(seconds, len(blockchain.chain), 'blocks')
+        seconds, _ = measure(match, args.repeat)
+        matched = len(list(blockchain.match_blocks([address])))
+        results['filters.match_' + name] = make_result(seconds, len(blockchain.chain), 'blocks', matched=matched)
+    return results
+
+
+def bench_store(blockchain, args):
+    results = {}
+    directory = tempfile.mkdtemp(prefix='bench-store-')
+    try:
+        def write():
+            shutil.rmtree(directory, ignore_errors=True)
+            stored = BlockChain(directory)
+            for block in blockchain.chain:
+                stored.add_block(block)
+            stored.commit(force=True)
+            stored.close()
+
+        seconds, _ = measure(write, args.repeat)
+        size = sum([os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names])
+        results['store.write'] = make_result(seconds, len(blockchain.chain), 'blocks', bytes=size)
+
+        def load():
+            stored = BlockChain(directory)
+            stored.close()
+        seconds, _ = measure(load, args.repeat)
+        results['store.load'] = make_result(seconds, len(blockchain.chain), 'blocks')
+
+        # the whole chain pickled into one file, as older versions did
+        legacy = BlockChain()
+        legacy.chain = list(blockchain.chain)
+        legacy_path = os.path.join(directory, 'blockchain.pkl')
+        def dump():
+            with open(legacy_path, 'wb') as file:
+                pickle.dump(legacy, file)
+        seconds, _ = measure(dump, args.repeat)
+        results['store.pickle_dump'] = make_result(seconds, len(blockchain.chain), 'blocks',
+                                                   bytes=os.path.getsize(legacy_path))
+        def load_pickle():
+            with open(legacy_path, 'rb') as file:
+                return pickle.load(file)
+        seconds, _ = measure(load_pickle, args.repeat)
+        results['store.pickle_load'] = make_result(seconds, len(blockchain.chain), 'blocks')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_serialize(blockchain, args):
+    results = {}
+    def whole():
+        # the whole document built in memory, as jsonify did
+        return json.dumps({'chain': [get_plain(block) for block in blockchain.chain], 'length': len(blockchain.chain)}).encode()
+    seconds, data = measure(whole, args.repeat)
+    results['serialize.document'] = make_result(seconds, len(blockchain.chain), 'blocks', bytes=len(data))
+
+    def stream():
+        return sum([len(chunk) for chunk in blockchain.iter_encoded()])
+    seconds, size = measure(stream, args.repeat)
+    results['serialize.stream'] = make_result(seconds, len(blockchain.chain), 'blocks', bytes=size)
+
+    def stream_ndjson():
+        return sum([len(chunk) for chunk in blockchain.iter_encoded(ndjson=True)])
+    seconds, size = measure(stream_ndjson, args.repeat)
+    results['serialize.ndjson'] = make_result(seconds, len(blockchain.chain), 'blocks', bytes=size)
+
+    def stream_gzip():
+        return sum([len(chunk) for chunk in gzip_chunks(blockchain.iter_encoded())])
+    seconds, size = measure(stream_gzip, args.repeat)
+    results['serialize.gzip'] = make_result(seconds, len(blockchain.chain), 'blocks', bytes=size)
+    return results
+
+
+BENCHMARKS = {
+    'proof_of_work': bench_proof_of_work,
+    'merkle': bench_merkle,
+    'valid_chain': bench_valid_chain,
+    'balance': bench_balance,
+    'filters': bench_filters,
+    'store': bench_store,
+    'serialize': bench_serialize,
+}
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Find the benchmarks slower than the baseline
+    :param results: <dict> name -> result of this run
+    :param baseline: <dict> name -> result of an earlier run
+    :param tolerance: <float> the allowed slowdown. Eg. 0.2 for 20%
+    :return: <dict> name -> {'seconds', 'baseline', 'ratio'}
+    '''
+    regressions = {}
+    for name, res in results.items():
+        if name not in baseline or baseline[name]['seconds'] <= 0:
+            continue
+        ratio = res['seconds'] / baseline[name]['seconds']
+        if ratio > 1 + tolerance:
+            regressions[name] = {'seconds': res['seconds'], 'baseline': baseline[name]['seconds'], 'ratio': ratio}
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the hot paths on a synthetic chain')
+    parser.add_argument('--height', default=1000, type=int, help='the number of blocks, 1k to 1M')
+    parser.add_argument('-t', '--transactions', default=1, type=int, help='the signed transfers in every block')
+    parser.add_argument('-k', '--keys', default=4, type=int, help='the number of wallets')
+    parser.add_argument('-d', '--difficulty', default=DIFFICULTY, type=int, help='the difficulty of proof of work')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='the processes mining and verifying')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='the runs of every benchmark, the best is kept')
+    parser.add_argument('--merkle-leaves', default=10000, type=int, help='the most blocks in the Merkle tree')
+    parser.add_argument('--only', default=None, help='the benchmarks to run, separated by commas')
+    parser.add_argument('--directory', default=None, help='store the generated chain here instead of in memory')
+    parser.add_argument('--seed', default=0, type=int, help='the seed of the generated chain')
+    parser.add_argument('-o', '--output', default=None, help='write the results to the file instead of stdout')
+    parser.add_argument('--baseline', default=None, help='the results of an earlier run to compare with')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='the allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}, choose from {", ".join(BENCHMARKS)}')
+
+    start = perf_counter()
+    blockchain, args.addresses = generate_chain(args.height, args.transactions, args.keys, args.directory, args.seed)
+    generate_seconds = perf_counter() - start
+
+    results = {}
+    for name in names:
+        results.update(BENCHMARKS[name](blockchain, args))
+
+    report = {
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {
+            'height': args.height,
+            'transactions': args.transactions,
+            'keys': args.keys,
+            'difficulty': args.difficulty,
+            'workers': args.workers,
+            'repeat': args.repeat,
+            'stored': args.directory is not None,
+        },
+        'generate_seconds': generate_seconds,
+        'results': results,
+    }
+
+    regressions = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print (text)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,42 +4,436 @@
 
 import hashlib
 import json
+import os
 import pickle   # we use pickle to store and load data
+import threading
+from contextlib import contextmanager
+from functools import wraps
 
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
 
 from Merkle_Tree import *
+from block_filter import *
+from block_store import *
+from block_tree import *
+from metrics import *
+from miner import *
 from utils import *
+from utxo import *
+from verifier import *
+
+STATE_INTERVAL = 1024   # blocks between two checkpoints of the derived state, they're connected again when loaded
+
+
+class ForkedChain(object):
+    '''
+    A chain made of the first height+1 blocks of another chain and the new blocks after them
+    The shared blocks are not copied
+    '''
+    def __init__(self, base, height, blocks):
+        self.base = base        # the chain sharing the blocks
+        self.height = height    # the height of the common ancestor
+        self.blocks = blocks    # the blocks after the common ancestor
+
+    def __len__(self):
+        return self.height + 1 + len(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('block height out of range')
+        if index <= self.height:
+            return self.base[index]
+        return self.blocks[index-self.height-1]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def writer(method):
+    # run a method on the single writer path of the chain, see BlockChain.writing()
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.writing():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class BlockChain(object):
-    def __init__(self):
-        self.chain = []         # the list of block chains
+    def __init__(self, directory=None, read_only=False):
+        '''
+        :param directory: <str> the directory to store the chain, None to keep it in memory
+        :param read_only: <bool> open the chain stored by another process, and follow() its writes
+        '''
+        self.directory = directory
+        self.read_only = read_only
+        if directory is None:
+            self.store = None
+            self.chain = []     # the list of block chains
+            self.filters = []   # the filters of the blocks in chain
+        else:
+            self.store = BlockStore(os.path.join(directory, 'blocks'), read_only=read_only)
+            self.chain = StoredChain(self.store)    # read the blocks lazily
+            self.filters = BlockStore(os.path.join(directory, 'filters'), read_only=read_only)   # stored as the blocks are
+        self.merkle = Merkle_Accumulator(keep_levels=True)  # the Merkle accumulator of all the blocks in chain
+        self.utxo = UTXOSet(MAX_FORK_DEPTH) # the unspent outputs of all the blocks in chain
+        self.state_height = -1              # the height of the derived state stored by store_state()
+        self.tree = BlockTree(self.block_hash)  # the validated branches competing with chain
+
+        # the watermark of validation, a chain extending it only checks the new blocks
+        self.validated_height = -1                  # the index of the last validated block
+        self.validated_hash = None                  # the hash of the last validated block
+        self.validated_merkle = Merkle_Accumulator()  # the Merkle state of the validated blocks
+
+        self._miner = None      # the proof of work engine, created when it's first used, see miner
+        self.verifier = SignatureVerifier()     # verify the signatures with caches
+
+        # one writer at a time, the readers use the snapshot published after every write
+        self.lock = threading.RLock()
+        self.writers = 0        # the depth of the nested writes
+        self.snapshot = None    # <ChainSnapshot> the chain as of the last finished write
+        self.signal = None      # <TipSignal> tells the read replicas about the writes, None if there is none
+        self.followed = None    # the sequence of the signal last followed, for a read-only chain
+
+        if self.store is not None:
+            self.load_state()
+        self.publish()
+    
+
+    def __getstate__(self):
+        # the mining and verifying engines hold processes, they're not stored
+        state = self.__dict__.copy()
+        state.pop('_miner', None)
+        state.pop('verifier', None)
+        state.pop('tree', None)     # the side branches are fetched again
+        state.pop('lock', None)
+        state.pop('writers', None)
+        state.pop('snapshot', None)
+        state.pop('signal', None)
+        return state
+    
+
+    def __setstate__(self, state):
+        # chains pickled by older versions have no watermark
+        self.__init__()
+        self.__dict__.update(state)
+        if self.merkle.size != len(self.chain) or self.merkle.levels is None:
+            self.merkle = Merkle_Accumulator([self.hash(block) for block in self.chain], keep_levels=True)
+        if self.utxo.height != len(self.chain) - 1 or self.utxo.legacy_height is None:
+            self.connect_utxo(-1)
+        if len(self.filters) != len(self.chain):
+            self.filters = [make_filter(block, self.hash(block)) for block in self.chain]
+        self.publish()
+    
+
+    @property
+    def miner(self):
+        '''
+        The proof of work engine, a ParallelMiner unless it's replaced
+        Its processes are not started for a chain that never mines
+        '''
+        if self._miner is None:
+            self._miner = ParallelMiner()
+        return self._miner
+    
+
+    @miner.setter
+    def miner(self, miner):
+        self._miner = miner
+    
+
+    def cancel_mining(self):
+        # stop the search of a proof, a miner never created has nothing to stop
+        if self._miner is not None:
+            self._miner.cancel()
+    
+
+    def get_mining_stats(self):
+        # the counters of the miner's processes, [] if it's never created
+        if self._miner is None:
+            return []
+        return self._miner.get_stats()
+    
+
+    @contextmanager
+    def writing(self):
+        '''
+        Change the chain on the single writer path
+        The writes can be nested, the readers see the new snapshot when the outermost one finishes,
+        and so do the read replicas, the signal is odd while the store is being written
+        The branches left too far below the tip are pruned then, whether the tip moved or a branch lost
+        Usage: with blockchain.writing(): ...
+        '''
+        with self.lock:
+            if self.writers == 0 and self.signal is not None:
+                self.signal.begin()
+            self.writers += 1
+            try:
+                yield self
+            finally:
+                self.writers -= 1
+                if self.writers == 0:
+                    if len(self.tree) > 0:
+                        self.tree.prune(len(self.chain) - 1)
+                    self.publish()
+                    if self.signal is not None:
+                        self.signal.end(len(self.chain))
+    
+
+    def publish(self):
+        # make the snapshot of the current chain, costs O(log n)
+        self.snapshot = ChainSnapshot(self)
+    
+
+    def follow(self, signal):
+        '''
+        Catch up with the process writing the same directory, for a read-only chain
+        The entries read are checked against the signal, like a sequence lock,
+        the blocks after the common ancestor are connected again
+        :param signal: <TipSignal> the tip published by the writer
+        :return: <bool> True if the chain has changed
+        '''
+        sequence, length = signal.read()
+        if sequence == self.followed or sequence % 2 == 1:
+            return False    # nothing new, or being written, the last snapshot is read meanwhile
+        with self.writing():
+            if sequence == self.followed:
+                return False    # followed by another thread
+            entries, filters = self.store.index, self.filters.index
+            kept = self.store.follow(length)
+            if kept is None or self.filters.follow(length) is None or signal.read()[0] != sequence:
+                # written while read, try again on the next call
+                self.store.index, self.filters.index = entries, filters
+                return False
+            self.followed = sequence
+            if kept == self.utxo.height + 1 and kept == length:
+                return False
+            self.merkle.truncate(kept)
+            self.rollback_utxo(kept - 1)
+            for index in range(kept, length):
+                block_hash = self.store.get_hash(index)
+                self.merkle.append(block_hash)
+                self.utxo.connect_block(self.chain[index], block_hash)
+            return True
+    
+
+    def close(self):
+        # close the files of the stored blocks and filters
+        if self.store is not None:
+            self.store.close()
+            self.filters.close()
+    
+
+    def state_path(self):
+        return os.path.join(self.directory, 'state.pkl')
+    
+
+    def load_state(self):
+        '''
+        Load the Merkle accumulator, the unspent outputs and the watermark checkpointed by commit()
+        The blocks of the checkpoint replaced by a reorg are rolled back with the undo records,
+        and the blocks after it are connected again, at most STATE_INTERVAL of them if it's current
+        '''
+        state = None
+        if os.path.exists(self.state_path()) is True:
+            with open(self.state_path(), 'rb') as file:
+                state = pickle.load(file)
+        height = -1
+        if state is not None:
+            height = self.find_state_height(state)
+        if height >= 0:
+            self.merkle = state['merkle']
+            self.utxo = state['utxo']
+            self.validated_height = state['validated_height']
+            self.validated_hash = state['validated_hash']
+            self.validated_merkle = state['validated_merkle']
+            if self.merkle.levels is None:
+                # stored by older versions, the levels are needed by the proofs
+                self.merkle = Merkle_Accumulator([self.store.get_hash(index) for index in range(height+1)],
+                                                 keep_levels=True)
+            self.merkle.truncate(height + 1)
+            self.utxo.rollback(height)
+            if self.utxo.max_undo is None:
+                self.utxo.max_undo = MAX_FORK_DEPTH     # stored by older versions
+            if self.validated_height > height:
+                self.validated_height = height
+                self.validated_hash = self.store.get_hash(height)
+                self.validated_merkle = self.merkle.prefix(height + 1)
+            self.state_height = height
+
+        for index in range(height+1, len(self.chain)):
+            block_hash = self.store.get_hash(index)
+            self.merkle.append(block_hash)
+            self.utxo.connect_block(self.chain[index], block_hash)
+        if self.read_only is not True:
+            self.load_filters()     # the writer keeps them
+    
+
+    def find_state_height(self, state):
+        '''
+        Find the last block of a checkpoint still in the chain
+        :param state: <dict> stored by store_state()
+        :return: <int> the height, -1 if the checkpoint can't be used
+        '''
+        utxo = state['utxo']
+        if utxo.legacy_height is None:
+            return -1   # stored by older versions, which connected the blocks created before them with other rules
+        height = min(state['height'], len(self.chain) - 1)
+        if height == state['height'] and height >= 0 and self.store.get_hash(height) == state['hash']:
+            return height
+        # a reorg after the checkpoint, the blocks with undo records can be rolled back
+        while height >= utxo.base and utxo.get_hash(height) != self.store.get_hash(height):
+            height -= 1
+        if height < utxo.base:
+            return -1   # replaced deeper than the undo records
+        return height
+    
+
+    def rollback_utxo(self, height):
+        # roll the unspent outputs back to height, they're connected again if the undo records don't reach it
+        if self.utxo.can_rollback(height) is True:
+            self.utxo.rollback(height)
+        else:
+            self.connect_utxo(height)
+    
+
+    def connect_utxo(self, height):
+        # build the unspent outputs of the blocks up to height again, they replace the old ones when complete
+        utxo = UTXOSet(self.utxo.max_undo)
+        for index in range(height + 1):
+            utxo.connect_block(self.chain[index], self.block_hash(index))
+        self.utxo = utxo
+    
+
+    def load_filters(self):
+        # drop the filters of the blocks lost or replaced, then create the missing ones
+        height = min(len(self.filters), len(self.chain)) - 1
+        while height >= 0 and self.filters.get_hash(height) != self.store.get_hash(height):
+            height -= 1
+        self.filters.truncate(height + 1)
+        for index in range(height+1, len(self.chain)):
+            block_hash = self.store.get_hash(index)
+            self.filters.append(make_filter(self.chain[index], block_hash), block_hash)
+    
+
+    @writer
+    def commit(self, force=False):
+        '''
+        Commit the appended blocks to disk, fsync is batched unless forced
+        The derived state is checkpointed every STATE_INTERVAL blocks, not at every fsync,
+        the blocks after the checkpoint are connected again when the chain is loaded
+        :param force: <bool> fsync now
+        '''
+        if self.store is None or self.read_only is True:
+            return
+        with STORE_SECONDS.time():
+            if self.store.sync(force) is True:
+                self.filters.sync(force=True)
+                if len(self.chain) - 1 - self.state_height >= STATE_INTERVAL:
+                    self.store_state()
+    
+
+    def store_state(self):
+        # store the derived state, so it's not rebuilt when loaded
+        state = {
+            'height': len(self.chain) - 1,
+            'hash': self.block_hash(-1) if len(self.chain) > 0 else None,
+            'merkle': self.merkle,
+            'utxo': self.utxo,
+            'validated_height': self.validated_height,
+            'validated_hash': self.validated_hash,
+            'validated_merkle': self.validated_merkle,
+        }
+        # write to a temporary file first, so a crash never corrupts the state
+        temp_path = self.state_path() + '.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(state, file)
+        os.replace(temp_path, self.state_path())
+        self.state_height = state['height']
+    
+
+    @staticmethod
+    def encode(block):
+        '''
+        The canonical encoding of a Block, which is hashed and stored
+        :param block: <dict> Block
+        :return: <bytes>
+        '''
+        return encode_block(block)
     
 
     @staticmethod
     def hash(block):
         '''
         create a SHA-256 hash of a Block
+        The hash of a Block object is computed once, until it's changed
         :param block: <dict> Block
         :return: <str>
         '''
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        return hash_block(block)
+    
+
+    def block_hash(self, height):
+        '''
+        The hash of the block at height in the chain
+        :param height: <int> the height of the block
+        :return: <str>
+        '''
+        if self.store is not None:
+            return self.store.get_hash(height)     # no need to read the body
+        return self.hash(self.chain[height])
+    
+
+    def block_data(self, height):
+        '''
+        The canonical encoding of the block at height in the chain
+        :param height: <int> the height of the block
+        :return: <bytes>
+        '''
+        if self.store is not None:
+            return self.store.get(height)   # no need to decode the body
+        return self.encode(self.chain[height])
+    
+
+    def iter_encoded(self, start=0, stop=None, ndjson=False):
+        '''
+        Yield the encoded blocks one by one, the chain is never built in memory
+        :param start: <int> the height of the first block
+        :param stop: <int> the height after the last block, None for the tip
+        :param ndjson: <bool> one block per line if True, a JSON document {'chain', 'length', ...} if False
+        :return: <generator> bytes
+        '''
+        if stop is None:
+            stop = len(self.chain)
+        if ndjson:
+            for height in range(start, stop):
+                yield self.block_data(height) + b'\n'
+            return
+
+        yield b'{"chain": ['
+        for height in range(start, stop):
+            if height > start:
+                yield b', '
+            yield self.block_data(height)
+        tail = {'length': len(self.chain), 'from': start, 'offset': start, 'limit': stop - start}
+        yield b'], ' + json.dumps(tail)[1:].encode()
     
 
     def proof_of_work(self):
         """
         Simple Proof of Work Algorithm:
             - Find a number p' such that hash(pp') contains leading 4 zeroes
-        :return: <int>
+        The search is done by self.miner and can be cancelled by self.cancel_mining()
+        :return: <int> the proof, None if cancelled
         """
 
-        proof = 0
         rand = int(get_random_256(), 16)    # TODO: change to last block's hash?
-        while self.valid_proof(rand, proof) is False:
-            proof += 1
-
-        return proof
+        with PROOF_OF_WORK_SECONDS.time():
+            return self.miner.mine(rand)
     
 
     @staticmethod
@@ -57,6 +451,147 @@ class BlockChain(object):
         return guess_hash[:4] == '0000'
     
 
+    def merkle_root(self):
+        '''
+        The Merkle root of the whole chain, which is hashMerkleRoot of the next block
+        :return: <str>
+        '''
+        return self.merkle.get_root()
+    
+
+    @writer
+    def add_block(self, block):
+        '''
+        Append a block to the chain and the Merkle accumulator
+        Its spends are checked against the unspent outputs, which the validators can't see
+        :param block: <dict> Block
+        :return: <bool> False if a spend is invalid, the block is not appended then
+        '''
+        block = to_block(block)
+        block_hash = self.hash(block)
+        if self.utxo.connect_block(block, block_hash, self.get_owner) is not None:
+            INVALID_BLOCKS.inc()
+            return False
+        data = self.encode(block)
+        if self.store is not None:
+            self.store.append(data, block_hash)
+            self.filters.append(make_filter(block, block_hash), block_hash)
+        else:
+            self.chain.append(block)
+            self.filters.append(make_filter(block, block_hash))
+        self.merkle.append(block_hash)
+        return True
+    
+
+    def get_owner(self, pub_key):
+        # the address of a public key, the key is parsed once by the verifier
+        return get_wallet_address(self.verifier.get_key(pub_key))
+    
+
+    @writer
+    def add_branch(self, height, blocks):
+        '''
+        Keep the blocks of a branch in the tree, they should be validated first
+        :param height: <int> the height of the block before them
+        :param blocks: <list> the blocks after the block at height
+        :return: <str> the hash of the last block, None if the branch can't be linked
+        '''
+        parent = self.block_hash(height) if height >= 0 else None
+        for block in blocks:
+            block = to_block(block)
+            block_hash = self.hash(block)
+            if parent is not None and block['Blockheader']['hashPreBlock'] != parent:
+                return None     # the chain has changed since the branch was validated
+            if not self.tree.is_main(block_hash, block['index']):
+                if self.tree.add(block, block_hash, parent) is None:
+                    return None
+            parent = block_hash
+        return parent
+    
+
+    @writer
+    def reorganize(self, tip_hash=None):
+        '''
+        Switch the main chain to a branch in the tree
+        Only the blocks after the common ancestor are detached and attached,
+        the detached ones are kept in the tree as a branch, so switching back costs no download
+        :param tip_hash: <str> the tip of the branch, None for the best tip of the fork choice
+        :return: <list> the detached blocks, None if the chain is not changed
+        '''
+        if tip_hash is None:
+            tip_hash = self.tree.best_tip(len(self.chain) - 1)
+            if tip_hash is None:
+                return None
+        height, branch = self.tree.get_branch(tip_hash)
+        if height is None:
+            return None
+
+        tip = self.block_hash(-1)
+        detached = self.rewind(height)
+        for index, node in enumerate(branch):
+            self.tree.remove(node.hash)
+            if self.add_block(node.block) is not True:
+                # a bad spend, the block and the ones after it are dropped and the old chain is attached again
+                for child in branch[index+1:]:
+                    self.tree.remove(child.hash)
+                self.reorganize(tip)
+                return None
+        return detached
+    
+
+    @writer
+    def rewind(self, height):
+        '''
+        Detach the blocks after height, the derived state is rolled back block by block
+        The detached blocks are kept in the tree as a branch
+        :param height: <int> the height of the last block to keep
+        :return: <list> the detached blocks
+        '''
+        detached = []
+        parent = self.block_hash(height) if height >= 0 else None
+        for index in range(height+1, len(self.chain)):
+            block = self.chain[index]
+            block_hash = self.block_hash(index)
+            self.tree.add(block, block_hash, parent)
+            detached.append(block)
+            parent = block_hash
+
+        # the indexes are copied before cut, the snapshots still read the old ones
+        self.merkle.truncate(height + 1)
+        self.rollback_utxo(height)
+        if height < self.state_height - MAX_FORK_DEPTH:
+            self.state_height = -1      # the checkpoint can't be rolled back so far, the next commit stores one
+        if self.store is not None:
+            self.store.truncate(height + 1)
+            self.filters.truncate(height + 1)
+        else:
+            self.chain = self.chain[:height+1]
+            self.filters = self.filters[:height+1]
+        return detached
+    
+
+    @writer
+    def replace_chain(self, chain):
+        '''
+        Replace the chain with another one, which should be validated first
+        Only the blocks after the common ancestor are replaced
+        :param chain: <list> the new chain
+        :return: <list> the detached blocks
+        '''
+        # find the common ancestor
+        if isinstance(chain, ForkedChain) and chain.base is self.chain:
+            height = chain.height
+        else:
+            height = min(len(self.chain), len(chain)) - 1
+            while height >= 0 and self.block_hash(height) != self.hash(chain[height]):
+                height -= 1
+        if height == len(chain) - 1:
+            # a prefix of our chain
+            return self.rewind(height)
+        tip_hash = self.add_branch(height, chain[height+1:])
+        return self.reorganize(tip_hash) or []
+    
+
     @property
     def last_block(self):
         '''
@@ -65,43 +600,289 @@ class BlockChain(object):
         return self.chain[-1]
     
 
+    def get_filter(self, height):
+        '''
+        The filter of the block at height, no need to read the block
+        :param height: <int> the height of the block
+        :return: <bytes>
+        '''
+        if self.store is not None:
+            return self.filters.get(height)
+        return self.filters[height]
+    
+
+    def match_blocks(self, items, start=0, stop=None):
+        '''
+        Find the blocks that may concern the items, only their filters are read
+        :param items: <list> the addresses
+        :param start: <int> the height of the first block
+        :param stop: <int> the height after the last block, None for the tip
+        :return: <generator> the heights of the matching blocks
+        '''
+        stop = len(self.chain) if stop is None else stop
+        for height in range(start, stop):
+            if filter_match(self.get_filter(height), self.block_hash(height), items):
+                yield height
+    
+
+    def find_block(self, block_hash):
+        '''
+        Find a block of the chain by its hash
+        :param block_hash: <str> the hash of the block
+        :return: <int> the height of the block, None if it's not found
+        '''
+        try:
+            return self.merkle.find_leaf(block_hash)
+        except ValueError:
+            return None     # not a hash
+    
+
+    def get_block_proof(self, height, size=None):
+        '''
+        Prove a block is in the chain, against the Merkle root of the first size blocks
+        The root of the first size blocks is hashMerkleRoot of the block at height size
+        :param height: <int> the height of the block
+        :param size: <int> the number of blocks in the tree, default is all the blocks
+        :return: <dict> the proof, None if size is out of range
+        '''
+        size = len(self.chain) if size is None else size
+        if not (height < size <= len(self.chain)):
+            return None
+        return {
+            'type': 'block',
+            'hash': self.block_hash(height),
+            'index': height,
+            'size': size,
+            'path': self.merkle.get_proof(height, size),
+            'root': self.merkle.prefix(size).get_root() if size < len(self.chain) else self.merkle_root(),
+            'committed_in': size if size < len(self.chain) else None,   # the block whose header has the root
+        }
+    
+
+    def get_trans_proof(self, trans_hash, height):
+        '''
+        Prove a transaction is in a block, against hashTransRoot of the block
+        :param trans_hash: <str> the hash of the transaction
+        :param height: <int> the height of the block
+        :return: <dict> the proof, None if the transaction is not in the block
+        '''
+        if not (0 <= height < len(self.chain)):
+            return None
+        block = self.chain[height]
+        if 'hashTransRoot' not in block['Blockheader']:
+            return None     # created by older versions
+        hashes = [trans['hash'] for trans in get_transactions(block)]
+        if trans_hash not in hashes:
+            return None
+        tree = Merkle_Array_Tree(leaf_hashes=hashes)
+        index, path = tree.get_proof(hashes.index(trans_hash))
+        return {
+            'type': 'transaction',
+            'hash': trans_hash,
+            'index': index,
+            'size': len(hashes),
+            'path': path,
+            'root': block['Blockheader']['hashTransRoot'],
+            'height': height,
+            'block_hash': self.block_hash(height),
+            'Blockheader': block['Blockheader'],
+        }
+    
+
+    def start_validation(self, height):
+        '''
+        Get a validator for the blocks after the block at height of our chain
+        :param height: <int> the height of the last block kept, -1 to validate from the genesis block
+        :return: <ChainValidator>
+        '''
+        if height == -1:
+            return ChainValidator(self.verifier)
+        with self.lock:     # a consistent state, the validation itself needs no lock
+            block_hash = self.block_hash(height)
+            if height == self.validated_height and block_hash == self.validated_hash:
+                merkle = self.validated_merkle.copy()
+            elif height == len(self.chain) - 1:
+                merkle = self.merkle.copy()
+            else:
+                merkle = self.merkle.prefix(height + 1)
+        return ChainValidator(self.verifier, height, block_hash, merkle)
+    
+
+    @writer
+    def mark_validated(self, validator):
+        '''
+        Move the watermark to the last block accepted by a finished validator
+        :param validator: <ChainValidator>
+        '''
+        self.validated_height = validator.height
+        self.validated_hash = validator.last_hash
+        self.validated_merkle = validator.merkle
+    
+
     def valid_chain(self, chain):
         '''
         Check whether the input chain is valid
+        Only the blocks after the validated watermark are checked if the chain extends it
         '''
-        current_index = 1
-        while current_index < len(chain):
-            block = chain[current_index]
-            last_block = chain[current_index-1]
+        if len(chain) == 0:
+            return True
+        with VALIDATION_SECONDS.time():
+            return self.validate(chain)
+    
+
+    def validate(self, chain):
+        # valid_chain() without the timing
+        height = self.validated_height
+        if 0 <= height < len(chain) and self.hash(chain[height]) == self.validated_hash:
+            # extends the validated prefix, continue from the running state
+            validator = ChainValidator(self.verifier, height, self.validated_hash, self.validated_merkle.copy())
+        else:
+            validator = ChainValidator(self.verifier)
 
-            # check the previous hash
-            if block['Blockheader']['hashPreBlock'] != self.hash(last_block):
+        for index in range(validator.height + 1, len(chain)):
+            if validator.add(chain[index]) is not True:
                 return False
-            
-            # check the Merkle root
-            lis = chain[:current_index]
-            mt = Merkle_Tree(lis)
-            mt.create_tree()
-            if mt.get_root_transaction() != block['Blockheader']['hashMerkleRoot']:
+        if validator.finish() is not True:
+            return False
+
+        # move the watermark to the tip of this chain
+        self.mark_validated(validator)
+        return True
+
+
+class ChainSnapshot(object):
+    '''
+    A frozen view of the chain at one tip, made by BlockChain.publish() and read without any lock
+    The blocks and the indexes are shared with the chain: appending never changes what the view sees,
+    and a reorg copies an index before cutting it
+    '''
+    def __init__(self, blockchain):
+        if blockchain.store is None:
+            self.store = None
+            self.chain = ForkedChain(blockchain.chain, len(blockchain.chain) - 1, [])
+            self.filters = ForkedChain(blockchain.filters, len(blockchain.filters) - 1, [])
+        else:
+            self.chain = blockchain.chain.snapshot()
+            self.store = self.chain.store
+            self.filters = blockchain.filters.snapshot()
+        self.merkle = blockchain.merkle.snapshot()
+
+    def __len__(self):
+        return len(self.chain)
+
+    @property
+    def tip_hash(self):
+        # the hash of the last block, None if there is none
+        if len(self.chain) == 0:
+            return None
+        return self.block_hash(-1)
+
+    # the reads of the chain, against the frozen view
+    encode = staticmethod(encode_block)
+    hash = staticmethod(hash_block)
+    block_hash = BlockChain.block_hash
+    block_data = BlockChain.block_data
+    iter_encoded = BlockChain.iter_encoded
+    merkle_root = BlockChain.merkle_root
+    last_block = BlockChain.last_block
+    get_filter = BlockChain.get_filter
+    match_blocks = BlockChain.match_blocks
+    find_block = BlockChain.find_block
+    get_block_proof = BlockChain.get_block_proof
+    get_trans_proof = BlockChain.get_trans_proof
+
+
+class ChainValidator(object):
+    '''
+    Validate the blocks of a chain one by one, each against the previous one
+    The signatures are verified in batches while the blocks arrive,
+    so a bad chain is rejected at the first bad batch
+    '''
+    def __init__(self, verifier, height=-1, last_hash=None, merkle=None, batch_size=256):
+        '''
+        :param verifier: <SignatureVerifier> to verify the signatures
+        :param height: <int> the height of the last accepted block, -1 if none
+        :param last_hash: <str> the hash of the last accepted block
+        :param merkle: <Merkle_Accumulator> the Merkle state of the accepted blocks
+        :param batch_size: <int> verify the collected signatures when there are so many
+        '''
+        self.verifier = verifier
+        self.height = height
+        self.last_hash = last_hash
+        self.merkle = merkle or Merkle_Accumulator()
+        self.batch_size = batch_size
+        self.signatures = []    # [(pub_key, message, sig)], collected but not verified
+        self.valid = True
+
+    def check(self, block):
+        # the checks of a block against the previous one, except the signatures
+        if self.height == -1:
+            return True     # the genesis block is not checked
+        
+        # check the previous hash
+        if block['Blockheader']['hashPreBlock'] != self.last_hash:
+            return False
+        
+        # check the Merkle root of the accepted blocks
+        if self.merkle.get_root() != block['Blockheader']['hashMerkleRoot']:
+            return False
+        
+        # check the transaction hashes and their Merkle root, which older versions have not
+        transactions = get_transactions(block)
+        if 'Transactions' in block and 'hashTransRoot' not in block['Blockheader']:
+            return False    # the pooled transactions must be committed
+        if 'hashTransRoot' in block['Blockheader']:
+            for trans in transactions:
+                if trans['hash'] != get_trans_hash(trans):
+                    return False
+            if get_trans_root(transactions) != block['Blockheader']['hashTransRoot']:
                 return False
-            
-            # check the signature
-            for dic in block['Transaction']['in']:
-                if dic['sig'] != 'system':  # not from mining
-                    #signature = dic['sig']
-                    signature = bytes(bytearray.fromhex(dic['sig']))    # get from str
-                    # dic['pub_key']
-                    vk = VerifyingKey.from_string(bytes(bytearray.fromhex(dic['pub_key'])), curve=SECP256k1)    # we store str to transfer via HTTP
-                    
-                    # this transaction's signature
-                    temp = {}
-                    temp['hash'] = dic['prev_out']['hash']
-                    temp['n'] = dic['prev_out']['n']
-                    ha = hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
-                    if vk.verify(signature, ha.encode()) is not True:
-                        return False
-                        
-            current_index += 1
         
+        # collect the signatures, they are verified in batches
+        for trans in transactions:
+            for dic in trans['in']:
+                if dic['sig'] != 'system':  # not from mining
+                    # we store str to transfer via HTTP
+                    self.signatures.append((dic['pub_key'], get_sign_message(dic['prev_out']), dic['sig']))
+        return True
+
+    def add(self, block):
+        '''
+        Accept the next block if it's valid
+        :param block: <dict> the next block
+        :return: <bool> False if the chain is invalid from now on
+        '''
+        if self.valid is not True:
+            return False
+        try:
+            self.valid = self.check(block)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            self.valid = False     # malformed block
+        if self.valid and len(self.signatures) >= self.batch_size:
+            self.valid = self.flush()
+        if self.valid is not True:
+            INVALID_CHAINS.inc()
+            return False
+
+        self.last_hash = hash_block(block)
+        self.merkle.append(self.last_hash)
+        self.height += 1
+        VALIDATED_BLOCKS.inc()
         return True
 
+    def flush(self):
+        # verify the collected signatures
+        signatures = self.signatures
+        self.signatures = []
+        return self.verifier.verify(signatures)
+
+    def finish(self):
+        '''
+        Verify the signatures left
+        :return: <bool> True if all the accepted blocks are valid
+        '''
+        if self.valid is True:
+            self.valid = self.flush()
+            if self.valid is not True:
+                INVALID_CHAINS.inc()
+        return self.valid
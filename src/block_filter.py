@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the compact filters of blocks, which tell whether a block may concern an address.
+
+import hashlib
+
+from utils import *
+
+FILTER_BITS = 10    # the bits of the filter for every item, about 1% false positives
+FILTER_HASHES = 7   # the number of bits set for every item
+MIN_FILTER_SIZE = 8     # the bytes of the smallest filter
+
+
+def get_block_items(block):
+    '''
+    The addresses a block concerns: the receivers and the senders of its transactions
+    :param block: <dict> Block
+    :return: <set> the addresses
+    '''
+    items = set()
+    for trans in get_transactions(block):
+        for trans_out in trans['out']:
+            items.add(trans_out['address'])
+            if trans_out['from_address'] != 'system':
+                items.add(trans_out['from_address'])
+    return items
+
+
+def get_positions(block_hash, item, bits):
+    # the bits of an item, the block hash is the key so the false positives differ between blocks
+    digest = hashlib.sha256((block_hash + str(item)).encode()).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:16], 'big') | 1
+    return [(h1 + i * h2) % bits for i in range(FILTER_HASHES)]
+
+
+def make_filter(block, block_hash):
+    '''
+    Create the Bloom filter of a block
+    :param block: <dict> Block
+    :param block_hash: <str> the hash of the block
+    :return: <bytes>
+    '''
+    items = get_block_items(block)
+    size = max(MIN_FILTER_SIZE, (len(items) * FILTER_BITS + 7) // 8)
+    data = bytearray(size)
+    for item in items:
+        for position in get_positions(block_hash, item, size * 8):
+            data[position >> 3] |= 1 << (position & 7)
+    return bytes(data)
+
+
+def filter_match(data, block_hash, items):
+    '''
+    Check a filter without the block
+    :param data: <bytes> the filter
+    :param block_hash: <str> the hash of the block
+    :param items: <list> the addresses
+    :return: <bool> True if the block may concern any of them, False if it surely does not
+    '''
+    if len(data) == 0:
+        return True     # no filter, the block has to be read
+    bits = len(data) * 8
+    for item in items:
+        for position in get_positions(block_hash, item, bits):
+            if data[position >> 3] & (1 << (position & 7)) == 0:
+                break
+        else:
+            return True
+    return False
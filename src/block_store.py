@@ -0,0 +1,286 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the append-only store of blocks on disk.
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from utils import *
+
+RECORD = struct.Struct('>II')       # the header of a record: length and CRC-32 of the body
+ENTRY = struct.Struct('>IQI32s')    # the index entry: segment, offset of the record, length of the body, block hash
+SEGMENT_SIZE = 64 * 1024 * 1024     # start a new segment file when the current one is full
+
+
+class BlockStore(object):
+    '''
+    Blocks are appended to segment files as length-prefixed records,
+    and the index file maps the height to the record and the block hash.
+    Nothing is rewritten: a reorg only truncates the index.
+    A store opened read-only on the same directory follows the writer, see follow().
+    '''
+    def __init__(self, directory, sync_every=16, read_only=False):
+        '''
+        :param directory: <str> the directory of the segment files and the index file
+        :param sync_every: <int> fsync after this number of appended blocks
+        :param read_only: <bool> open the store written by another process, nothing is written
+        '''
+        self.directory = directory
+        self.sync_every = sync_every    # fsync after this number of appended blocks
+        self.pending = 0                # the number of blocks appended since the last fsync
+        self.maps = {}                  # segment -> mmap of the segment file
+        self.read_only = read_only
+        if read_only is True:
+            self.open_read_only()
+            return
+        os.makedirs(directory, exist_ok=True)
+
+        # load the index, drop the entries whose records did not reach the disk
+        self.index_path = os.path.join(directory, 'index.dat')
+        with open(self.index_path, 'ab+') as file:
+            file.seek(0)
+            self.index = bytearray(file.read())
+        del self.index[len(self.index) - len(self.index) % ENTRY.size:]
+        while len(self) > 0 and self.check(len(self) - 1) is not True:
+            del self.index[-ENTRY.size:]
+        self.index_file = open(self.index_path, 'r+b', buffering=0)
+        self.index_file.truncate(len(self.index))
+        self.index_file.seek(0, os.SEEK_END)
+
+        # append to the last segment
+        self.segment = 0
+        while os.path.exists(self.segment_path(self.segment + 1)):
+            self.segment += 1
+        self.segment_file = open(self.segment_path(self.segment), 'ab', buffering=0)
+
+    def open_read_only(self):
+        # load the complete entries, the last ones may be read before their records are, follow() checks them
+        self.index_path = os.path.join(self.directory, 'index.dat')
+        self.index_file = open(self.index_path, 'rb', buffering=0)
+        self.index = bytearray(self.index_file.read())
+        del self.index[len(self.index) - len(self.index) % ENTRY.size:]
+        self.segment = None
+        self.segment_file = None
+
+    def __len__(self):
+        return len(self.index) // ENTRY.size
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'blk%05d.dat' % segment)
+
+    def get_entry(self, height):
+        '''
+        :param height: <int> the height of the block
+        :return: <tuple> (segment, offset, length, raw hash)
+        '''
+        if height < 0:
+            height += len(self)
+        if height < 0 or height >= len(self):
+            raise IndexError('block height out of range')
+        return ENTRY.unpack_from(self.index, height * ENTRY.size)
+
+    def get_hash(self, height):
+        # the hash of the block at height, the body is not read
+        return self.get_entry(height)[3].hex()
+
+    def get_map(self, segment, end):
+        # map the segment file, map it again if it has grown
+        # the old map is not closed, a reader may still be slicing it, it's closed when collected
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(self.segment_path(segment), 'rb') as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mapped
+        return mapped
+
+    def get(self, height):
+        '''
+        Read the body of a block lazily through mmap
+        :param height: <int> the height of the block
+        :return: <bytes> the canonical encoding of the block
+        '''
+        segment, offset, length, _ = self.get_entry(height)
+        mapped = self.get_map(segment, offset + RECORD.size + length)
+        start = offset + RECORD.size
+        return mapped[start:start+length]
+
+    def check(self, height):
+        # whether the record of the entry is complete on disk
+        segment, offset, length, _ = self.get_entry(height)
+        path = self.segment_path(segment)
+        if os.path.exists(path) is not True or os.path.getsize(path) < offset + RECORD.size + length:
+            return False
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            header = file.read(RECORD.size)
+            body = file.read(length)
+        return RECORD.unpack(header) == (length, zlib.crc32(body))
+
+    def append(self, data, block_hash):
+        '''
+        Append a block to the store
+        :param data: <bytes> the canonical encoding of the block
+        :param block_hash: <str> the hash of the block
+        '''
+        offset = self.segment_file.seek(0, os.SEEK_END)
+        if offset > 0 and offset + RECORD.size + len(data) > SEGMENT_SIZE:
+            self.sync(force=True)
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.segment_path(self.segment), 'ab', buffering=0)
+            offset = 0
+
+        self.segment_file.write(RECORD.pack(len(data), zlib.crc32(data)) + data)
+        entry = ENTRY.pack(self.segment, offset, len(data), bytes.fromhex(block_hash))
+        self.index_file.write(entry)
+        self.index += entry
+
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync(force=True)
+
+    def truncate(self, length):
+        '''
+        Keep the first length blocks only
+        The records are left in the segments, they are never read again
+        :param length: <int> the number of blocks to keep
+        '''
+        if length >= len(self):
+            return
+        self.index = self.index[:length * ENTRY.size]     # a copy, the snapshots keep the old one
+        self.index_file.truncate(len(self.index))
+        self.index_file.seek(0, os.SEEK_END)
+        self.pending += 1
+
+    def sync(self, force=False):
+        '''
+        Commit the appended blocks, fsync is batched unless forced
+        :param force: <bool> fsync now
+        :return: <bool> True if fsync is done
+        '''
+        if self.pending == 0 or (force is not True and self.pending < self.sync_every):
+            return False
+        # the records reach the disk before the index entries pointing to them
+        os.fsync(self.segment_file.fileno())
+        os.fsync(self.index_file.fileno())
+        self.pending = 0
+        return True
+
+    def read_entries(self, start, stop):
+        # the entries from start to stop in the index file, fewer if the file is shorter
+        return os.pread(self.index_file.fileno(), (stop - start) * ENTRY.size, start * ENTRY.size)
+
+    def follow(self, length):
+        '''
+        Catch up with the process writing the store, for a store opened read-only
+        The new entries are read from the index file, the ones replaced by a reorg are found from the tip down,
+        so it costs the number of changed blocks, not the length of the chain
+        :param length: <int> the number of blocks the writer has published
+        :return: <int> the number of blocks kept, the ones after them are new, None if the file is shorter
+        '''
+        kept = min(len(self), length)
+        while kept > 0 and self.read_entries(kept - 1, kept) != self.index[(kept-1)*ENTRY.size:kept*ENTRY.size]:
+            kept -= 1
+        entries = self.read_entries(kept, length)
+        if len(entries) != (length - kept) * ENTRY.size:
+            return None
+        self.index = self.index[:kept * ENTRY.size] + entries     # a copy, the snapshots keep the old one
+        return kept
+
+    def snapshot(self):
+        '''
+        A frozen view of the blocks stored now, read without any lock
+        Appending only adds entries after the view, and truncate() replaces the index instead of cutting it
+        :return: <StoreSnapshot>
+        '''
+        return StoreSnapshot(self, self.index, len(self))
+
+    def close(self):
+        self.sync(force=True)
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.index_file.close()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+
+
+class StoreSnapshot(object):
+    '''
+    The blocks of a BlockStore up to a length, made by BlockStore.snapshot()
+    '''
+    def __init__(self, store, index, length):
+        self.store = store
+        self.index = index      # the index of the store when the view was made
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    # the same reads as the store, against the frozen index
+    get_entry = BlockStore.get_entry
+    get_hash = BlockStore.get_hash
+    get = BlockStore.get
+
+    def get_map(self, segment, end):
+        return self.store.get_map(segment, end)
+
+
+class BlockCache(object):
+    '''
+    The recently decoded blocks, keyed by their hashes, shared by the chain and its snapshots
+    '''
+    def __init__(self, size=256):
+        self.size = size
+        self.blocks = OrderedDict()     # hash -> block
+        self.lock = threading.Lock()
+
+    def get(self, block_hash):
+        with self.lock:
+            block = self.blocks.get(block_hash)
+            if block is not None:
+                self.blocks.move_to_end(block_hash)
+            return block
+
+    def put(self, block_hash, block):
+        with self.lock:
+            self.blocks[block_hash] = block
+            if len(self.blocks) > self.size:
+                self.blocks.popitem(last=False)
+
+
+class StoredChain(object):
+    '''
+    A read-only list of the blocks in a BlockStore, or in a StoreSnapshot
+    Blocks are decoded when they are read, the recent ones are cached
+    '''
+    def __init__(self, store, cache_size=256, cache=None):
+        self.store = store
+        self.cache = cache or BlockCache(cache_size)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[i] for i in range(*height.indices(len(self)))]
+        block_hash = self.store.get_hash(height)
+        block = self.cache.get(block_hash)
+        if block is None:
+            data = self.store.get(height)
+            block = to_block(json.loads(data), data, block_hash)  # nothing to hash again
+            self.cache.put(block_hash, block)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def snapshot(self):
+        # the blocks stored now, sharing the cache
+        return StoredChain(self.store.snapshot(), cache=self.cache)
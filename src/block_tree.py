@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the tree of the branches competing with the main chain.
+
+MAX_FORK_DEPTH = 100    # a branch whose tip is this far below the main tip is dropped
+
+
+class TreeNode(object):
+    '''
+    A block off the main chain
+    '''
+    __slots__ = ('hash', 'parent', 'height', 'block')
+
+    def __init__(self, block_hash, parent, height, block):
+        self.hash = block_hash
+        self.parent = parent    # the hash of the previous block
+        self.height = height    # the height in its branch, which is the work of the branch
+        self.block = block
+
+
+class BlockTree(object):
+    '''
+    The blocks of the side branches, keyed by their hashes, with links to their parents
+    The blocks of the main chain are not copied, they are found by their heights,
+    so a branch ends at the first parent not in the tree, which is its common ancestor with the main chain
+    '''
+    def __init__(self, get_hash, max_depth=MAX_FORK_DEPTH):
+        '''
+        :param get_hash: <function> the hash of the main chain block at a height, IndexError if there is none
+        :param max_depth: <int> the branches whose tips are further below the main tip are dropped
+        '''
+        self.get_hash = get_hash
+        self.max_depth = max_depth
+        self.nodes = {}     # hash -> TreeNode
+        self.children = {}  # hash -> the number of children in the tree
+        self.tips = {}      # hash -> None, the nodes with no children, in the order of arrival
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def is_main(self, block_hash, height):
+        # whether the block at height of the main chain has the hash, None at -1 is the parent of the genesis block
+        if height == -1:
+            return block_hash is None
+        try:
+            return height >= 0 and self.get_hash(height) == block_hash
+        except IndexError:
+            return False
+
+    def get_height(self, block_hash, height):
+        '''
+        Find a block on any branch
+        :param block_hash: <str> the hash of the block
+        :param height: <int> the height it claims
+        :return: <int> the height, None if it's unknown
+        '''
+        if block_hash in self.nodes:
+            return self.nodes[block_hash].height
+        if self.is_main(block_hash, height):
+            return height
+        return None
+
+    def add(self, block, block_hash, parent):
+        '''
+        Add a block to a side branch, the block should be validated against its branch first
+        :param block: <dict> Block
+        :param block_hash: <str> the hash of the block
+        :param parent: <str> the hash of the previous block, on the main chain or in the tree
+        :return: <TreeNode> None if the parent is unknown
+        '''
+        if block_hash in self.nodes:
+            return self.nodes[block_hash]
+        height = self.get_height(parent, block['index'] - 1)
+        if height is None or height != block['index'] - 1:
+            return None
+        node = TreeNode(block_hash, parent, height + 1, block)
+        self.nodes[block_hash] = node
+        self.tips[block_hash] = None
+        if parent in self.nodes:
+            self.children[parent] = self.children.get(parent, 0) + 1
+            self.tips.pop(parent, None)
+        return node
+
+    def remove(self, block_hash):
+        # drop a node, its children stay and will be found on the main chain or dropped by prune()
+        node = self.nodes.pop(block_hash, None)
+        if node is None:
+            return
+        self.tips.pop(block_hash, None)
+        self.children.pop(block_hash, None)
+        if node.parent in self.children:
+            self.children[node.parent] -= 1
+            if self.children[node.parent] == 0:
+                del self.children[node.parent]
+                self.tips[node.parent] = None
+
+    def get_branch(self, block_hash):
+        '''
+        Walk back from a node to the main chain, costs the length of the branch
+        :param block_hash: <str> the hash of a node
+        :return: <tuple> (height of the common ancestor, [TreeNode] after it, the oldest first)
+        '''
+        branch = []
+        node = self.nodes.get(block_hash)
+        while node is not None:
+            branch.append(node)
+            node = self.nodes.get(node.parent)
+        branch.reverse()
+        if len(branch) == 0 or self.is_main(branch[0].parent, branch[0].height - 1) is not True:
+            return None, branch     # cut off from the main chain
+        return branch[0].height - 1, branch
+
+    def best_tip(self, height):
+        '''
+        Choose the fork: the highest tip wins, the first one seen wins a tie
+        :param height: <int> the height of the main tip, which wins a tie with any branch
+        :return: <str> the hash of the best tip, None if the main chain is the best
+        '''
+        best = None
+        for block_hash in self.tips:
+            node = self.nodes[block_hash]
+            if node.height > height:
+                best = block_hash
+                height = node.height
+        return best
+
+    def get_tips(self):
+        '''
+        :return: <list> [{'hash', 'height', 'fork_height'}] of the side branches
+        '''
+        tips = []
+        for block_hash in self.tips:
+            ancestor, branch = self.get_branch(block_hash)
+            tips.append({'hash': block_hash, 'height': self.nodes[block_hash].height, 'fork_height': ancestor})
+        return tips
+
+    def prune(self, height):
+        '''
+        Drop the branches whose tips are too far below the main tip, and the ones cut off from the main chain
+        :param height: <int> the height of the main tip
+        '''
+        for block_hash in list(self.tips):
+            if block_hash not in self.nodes:
+                continue
+            ancestor, branch = self.get_branch(block_hash)
+            if ancestor is not None and branch[-1].height >= height - self.max_depth:
+                continue
+            # from the tip down to a node shared with another branch
+            for node in reversed(branch):
+                if self.children.get(node.hash, 0) > 0:
+                    break
+                self.remove(node.hash)
@@ -0,0 +1,511 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the simulator of a cluster of nodes on the loopback interface, for load and propagation tests.
+
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser
+from time import sleep, time
+
+from werkzeug.serving import make_server
+
+from block_chain import *
+from metrics import *
+from miner import *
+from peers import *
+from utils import *
+from verifier import *
+
+TOPOLOGIES = ('ring', 'mesh', 'random')
+
+
+def make_topology(size, kind='ring', degree=4, rand=None):
+    '''
+    Choose the neighbors of every node, the links go both ways
+    :param size: <int> the number of nodes
+    :param kind: <str> 'ring', 'mesh' or 'random'
+    :param degree: <int> the average number of neighbors in a random topology
+    :param rand: <random.Random> the random choices
+    :return: <list> links[i] is the set of the neighbors of node i
+    '''
+    rand = rand or random.Random(0)
+    links = [set() for _ in range(size)]
+
+    def link(a, b):
+        if a != b:
+            links[a].add(b)
+            links[b].add(a)
+
+    if kind == 'ring':
+        for index in range(size):
+            link(index, (index + 1) % size)
+    elif kind == 'mesh':
+        for index in range(size):
+            for other in range(index + 1, size):
+                link(index, other)
+    elif kind == 'random':
+        # a random tree keeps the cluster connected, the other links are added until the degree is reached
+        for index in range(1, size):
+            link(index, rand.randrange(index))
+        edges = size - 1
+        target = min(size * (size - 1) // 2, size * degree // 2)
+        while edges < target:
+            a, b = rand.randrange(size), rand.randrange(size)
+            if a != b and b not in links[a]:
+                link(a, b)
+                edges += 1
+    else:
+        raise ValueError('unknown topology %s'%kind)
+    return links
+
+
+def make_genesis(directory):
+    # the chain of the genesis block only, as Wallet makes it, copied to every node
+    blockchain = BlockChain(directory)
+    block = get_empty_block()
+    block['index'] = 0
+    block['Blockheader']['hashPreBlock'] = 1
+    blockchain.add_block(block)
+    blockchain.commit(force=True)
+    blockchain.close()
+
+
+def run_node(directory, port, difficulty, sync_interval):
+    '''
+    The main function of a node, in a process forked by Cluster.start()
+    :param directory: <str> the directory of the wallet and its chain
+    :param port: <int> the port to listen on
+    :param difficulty: <int> the difficulty of proof of work
+    :param sync_interval: <float> seconds between two rounds of background sync, 0 to rely on the gossip
+    '''
+    sys.stdout = sys.stderr = open(os.path.join(directory, 'log.txt'), 'w', buffering=1)
+    os.environ['MINIBITCOIN_DATA_DIR'] = directory
+    import main     # the wallet is created now, in the directory of the node
+
+    # the nodes share the CPUs, every one mines and verifies on a single thread
+    main.my_wallet.blockchain.miner = SerialMiner(difficulty)
+    main.my_wallet.blockchain.verifier = SignatureVerifier(workers=1)
+    main.my_wallet.node_address = '127.0.0.1:%d'%port
+    if sync_interval > 0:
+        main.my_wallet.start_sync(sync_interval)
+    make_server('127.0.0.1', port, main.app, threaded=True).serve_forever()
+
+
+def quantile(buckets, count, q):
+    '''
+    Estimate a quantile from the cumulative buckets of a histogram
+    :param buckets: <list> [(upper bound, cumulative count)], sorted by the bound
+    :param count: <float> the number of observations
+    :param q: <float> the quantile. Eg. 0.95
+    :return: <float> the upper bound of the bucket holding the quantile, None if there is nothing
+    '''
+    for bound, cumulative in buckets:
+        if count > 0 and cumulative >= q * count:
+            return bound
+    return None
+
+
+class Cluster(object):
+    '''
+    Nodes on loopback ports, every one a process serving main.py with a wallet of its own
+    All the nodes start from the same genesis block, and are driven through their HTTP APIs
+    '''
+    def __init__(self, size, port=12000, directory=None, difficulty=DIFFICULTY, sync_interval=0.0):
+        '''
+        :param size: <int> the number of nodes
+        :param port: <int> the port of the first node, the others follow it
+        :param directory: <str> the directory of the nodes, None for a temporary one
+        :param difficulty: <int> the difficulty of proof of work
+        :param sync_interval: <float> seconds between two rounds of background sync, 0 to rely on the gossip
+        '''
+        self.size = size
+        self.port = port
+        self.directory = directory
+        self.temporary = directory is None     # removed by stop()
+        self.difficulty = difficulty
+        self.sync_interval = sync_interval
+        self.nodes = ['127.0.0.1:%d'%(port + index) for index in range(size)]
+        self.addresses = []     # the wallet address of every node
+        self.links = [set() for _ in range(size)]
+        self.processes = []
+        self.client = PeerClient(timeout=10.0, max_workers=32, backoff=0.0)    # no node is ever skipped
+
+        self.jobs = []          # (node index, job id) of the mining jobs
+        self.arrivals = [{} for _ in range(size)]   # the tips of every node, block hash -> the time first seen
+        self.watcher = None
+        self.watching = threading.Event()
+
+    def start(self, timeout=60.0):
+        '''
+        Fork the nodes and wait until all of them answer
+        The nodes are forked before any thread is started, and share the modules loaded here
+        :param timeout: <float> seconds to wait
+        '''
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='minibitcoin-cluster-')
+        genesis = os.path.join(self.directory, 'genesis')
+        make_genesis(genesis)
+
+        context = multiprocessing.get_context('fork')
+        for index in range(self.size):
+            directory = os.path.join(self.directory, 'node%d'%index)
+            shutil.copytree(genesis, directory)
+            process = context.Process(target=run_node,
+                                      args=(directory, self.port + index, self.difficulty, self.sync_interval))
+            process.start()
+            self.processes.append(process)
+
+        deadline = time() + timeout
+        while len(self.get_tips()) < self.size:
+            if time() > deadline:
+                raise RuntimeError('the nodes did not start in %s seconds'%timeout)
+            sleep(0.2)
+        for index in range(self.size):
+            with open(os.path.join(self.directory, 'node%d'%index, 'address.pkl'), 'rb') as file:
+                self.addresses.append(pickle.load(file))
+
+    def stop(self):
+        self.watching.set()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.temporary is True and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def post(self, index, path, body=None):
+        '''
+        :param index: <int> the index of the node
+        :return: <tuple> (status code, JSON body), (None, None) if the node does not reply
+        '''
+        response = self.client.request(self.nodes[index], path, 'POST', json=body)
+        if response is None:
+            return None, None
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def connect(self, topology='ring', degree=4, rand=None):
+        '''
+        Register the neighbors of every node
+        :param topology: <str> 'ring', 'mesh' or 'random'
+        :param degree: <int> the average number of neighbors in a random topology
+        '''
+        self.links = make_topology(self.size, topology, degree, rand)
+        for index, neighbors in enumerate(self.links):
+            self.post(index, '/nodes/register', {'nodes': ['http://' + self.nodes[other] for other in sorted(neighbors)]})
+
+    def get_tips(self):
+        '''
+        :return: <dict> node -> {'height', 'hash', 'length'} of the nodes replying
+        '''
+        return self.client.fan_out(self.nodes, '/chain/tip')
+
+    def mine(self, index, blocks=1):
+        '''
+        Queue a mining job on a node
+        :return: <str> the id of the job, None if the node refused
+        '''
+        status, res = self.post(index, '/mine', {'blocks': blocks})
+        if status != 202:
+            return None
+        self.jobs.append((index, res['job']['id']))
+        return res['job']['id']
+
+    def transfer(self, source, target, value):
+        '''
+        Send coins from the wallet of a node to the wallet of another one
+        :return: <bool> True if the transaction is accepted by the source
+        '''
+        status, _ = self.post(source, '/transactions/new', {'value': value, 'address': self.addresses[target]})
+        return status == 201
+
+    def wait_jobs(self, timeout=600.0):
+        '''
+        Wait for the mining jobs to finish
+        :return: <list> the finished jobs, as returned by /mine/<id>
+        '''
+        jobs = []
+        deadline = time() + timeout
+        for index, job_id in self.jobs:
+            while time() <= deadline:
+                job = self.client.get_json(self.nodes[index], '/mine/' + job_id)
+                if job is not None and job['state'] not in ('queued', 'running'):
+                    jobs.append(job)
+                    break
+                sleep(0.1)
+        return jobs
+
+    def watch(self, interval=0.1):
+        # poll the tips in the background, remember when every node first had every tip
+        def loop():
+            while self.watching.is_set() is not True:
+                self.observe(self.get_tips())
+                self.watching.wait(interval)
+
+        self.watching.clear()
+        self.watcher = threading.Thread(target=loop, daemon=True)
+        self.watcher.start()
+
+    def observe(self, tips):
+        # the tips of the nodes now
+        now = time()
+        for index, node in enumerate(self.nodes):
+            if node in tips:
+                self.arrivals[index].setdefault(tips[node]['hash'], now)
+
+    def get_arrivals(self, chain):
+        '''
+        Find when every node had the blocks of a chain
+        A node has a block once its tip is the block or any block after it on the chain,
+        so a block on another branch at the same height is never taken for it
+        :param chain: <list> the block hashes of the chain, by height
+        :return: <dict> block hash -> the time, the blocks some node was never seen with are left out
+        '''
+        reached = [0.0] * len(chain)    # None once a node is not known to have the block
+        for seen in self.arrivals:
+            earliest = None     # the first time the node had the block at height
+            for height in range(len(chain) - 1, -1, -1):
+                first = seen.get(chain[height])
+                if first is not None and (earliest is None or first < earliest):
+                    earliest = first
+                if earliest is None or reached[height] is None:
+                    reached[height] = None
+                else:
+                    reached[height] = max(reached[height], earliest)
+        return {chain[height]: reached[height] for height in range(len(chain)) if reached[height] is not None}
+
+    def wait_converged(self, timeout=30.0, interval=0.1):
+        '''
+        Wait until every node has the same tip
+        :return: <float> the time it happened, None if it did not before the timeout
+        '''
+        deadline = time() + timeout
+        while time() <= deadline:
+            tips = self.get_tips()
+            self.observe(tips)
+            if len(tips) == self.size and len(set([tip['hash'] for tip in tips.values()])) == 1:
+                return time()
+            sleep(interval)
+        return None
+
+    def get_main_chain(self, index=0):
+        '''
+        :return: <list> the block hashes of the chain of a node, by height
+        '''
+        hashes = []
+        while True:
+            # as many headers as the node returns in one response
+            res = self.client.get_json(self.nodes[index], '/chain/headers', params={'from': len(hashes)})
+            if res is None or len(res['headers']) == 0:
+                return hashes
+            hashes.extend([header['hash'] for header in res['headers']])
+            if len(hashes) >= res['length']:
+                return hashes
+
+    def gather_metrics(self):
+        '''
+        Sum the metrics of all the nodes
+        :return: <dict> name -> {labels: value}, see parse_metrics()
+        '''
+        totals = {}
+        for node in self.nodes:
+            response = self.client.request(node, '/metrics')
+            if response is None or response.status_code != 200:
+                continue
+            for name, samples in parse_metrics(response.text).items():
+                total = totals.setdefault(name, {})
+                for labels, value in samples.items():
+                    total[labels] = total.get(labels, 0.0) + value
+        return totals
+
+
+def summarize(values):
+    # the distribution of a list of seconds
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def get_latency(metrics):
+    '''
+    The latency of every route served by the nodes, from minibitcoin_http_request_seconds
+    :return: <dict> route -> {'count', 'mean', 'p50', 'p95'}, the quantiles are bucket bounds
+    '''
+    buckets = {}    # route -> [(bound, cumulative count)]
+    for labels, value in metrics.get('minibitcoin_http_request_seconds_bucket', {}).items():
+        labels = dict(labels)
+        bound = float(labels['le'])
+        buckets.setdefault(labels['route'], []).append((bound, value))
+    latency = {}
+    for labels, count in metrics.get('minibitcoin_http_request_seconds_count', {}).items():
+        route = dict(labels)['route']
+        total = metrics['minibitcoin_http_request_seconds_sum'].get(labels, 0.0)
+        route_buckets = sorted(buckets.get(route, []))
+        latency[route] = {
+            'count': int(count),
+            'mean': total / count if count > 0 else None,
+            'p50': quantile(route_buckets, count, 0.5),
+            'p95': quantile(route_buckets, count, 0.95),
+        }
+    return latency
+
+
+def get_traffic(metrics):
+    '''
+    The bytes served by the nodes, from minibitcoin_http_bytes and minibitcoin_chain_payload_bytes
+    :return: <dict> {'sent', 'received', 'chains'}, the chains are streamed and not in sent
+    '''
+    traffic = {'sent': 0, 'received': 0, 'chains': 0}
+    for labels, value in metrics.get('minibitcoin_http_bytes_total', {}).items():
+        traffic[dict(labels)['direction']] += int(value)
+    for labels, value in metrics.get('minibitcoin_chain_payload_bytes_sum', {}).items():
+        if dict(labels)['direction'] == 'sent':
+            traffic['chains'] += int(value)
+    traffic['total'] = traffic['sent'] + traffic['received'] + traffic['chains']
+    return traffic
+
+
+def run_workload(cluster, blocks, interval, transfers=0, value=0.1, rand=None):
+    '''
+    Mine blocks on random nodes one after another, with random transfers between the wallets
+    A block asked for before the last one has spread is mined on an old tip, which makes a fork
+    :param cluster: <Cluster> the started and connected cluster
+    :param blocks: <int> the number of blocks to mine
+    :param interval: <float> seconds between two blocks asked for
+    :param transfers: <int> the transfers sent after every block asked for
+    :param value: <float> the coins of every transfer
+    :param rand: <random.Random> the random choices
+    :return: <dict> {'sent', 'accepted'} transfers
+    '''
+    rand = rand or random.Random(0)
+    counts = {'sent': 0, 'accepted': 0}
+    for _ in range(blocks):
+        cluster.mine(rand.randrange(cluster.size))
+        for _ in range(transfers if cluster.size > 1 else 0):
+            source, target = rand.sample(range(cluster.size), 2)
+            counts['sent'] += 1
+            if cluster.transfer(source, target, value) is True:
+                counts['accepted'] += 1
+        sleep(interval)
+    return counts
+
+
+def main():
+    parser = ArgumentParser(description='Run a cluster of nodes on the loopback interface and report how blocks spread')
+    parser.add_argument('-n', '--nodes', default=20, type=int, help='the number of nodes')
+    parser.add_argument('--topology', default='random', choices=TOPOLOGIES, help='how the nodes are linked')
+    parser.add_argument('--degree', default=4, type=int, help='the average number of neighbors in a random topology')
+    parser.add_argument('-b', '--blocks', default=20, type=int, help='the number of blocks to mine')
+    parser.add_argument('-i', '--interval', default=0.5, type=float, help='seconds between two blocks asked for')
+    parser.add_argument('-t', '--transfers', default=1, type=int, help='the transfers sent after every block asked for')
+    parser.add_argument('-d', '--difficulty', default=DIFFICULTY, type=int, help='the difficulty of proof of work')
+    parser.add_argument('-s', '--sync-interval', default=0.0, type=float, help='seconds between two rounds of background sync on every node, 0 to rely on the gossip')
+    parser.add_argument('-p', '--port', default=12000, type=int, help='the port of the first node')
+    parser.add_argument('--timeout', default=60.0, type=float, help='seconds to wait for the nodes to agree on a tip')
+    parser.add_argument('--settle', default=3, type=int, help='the most blocks mined after the workload to break a tie')
+    parser.add_argument('--directory', default=None, help='keep the nodes here instead of in a temporary directory')
+    parser.add_argument('--seed', default=0, type=int, help='the seed of the random choices')
+    parser.add_argument('-o', '--output', default=None, help='write the report to the file instead of stdout')
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    cluster = Cluster(args.nodes, args.port, args.directory, args.difficulty, args.sync_interval)
+    try:
+        start = time()
+        cluster.start()
+        cluster.connect(args.topology, args.degree, rand)
+        start_seconds = time() - start
+
+        cluster.watch()
+        start = time()
+        transfers = run_workload(cluster, args.blocks, args.interval, args.transfers, rand=rand)
+        jobs = cluster.wait_jobs()
+        workload_seconds = time() - start
+
+        # two tips of the same height are only settled by the next block
+        mined_at = time()
+        converged = cluster.wait_converged(args.timeout)
+        settle = 0
+        while converged is None and settle < args.settle:
+            cluster.jobs = []
+            cluster.mine(0)
+            jobs.extend(cluster.wait_jobs())
+            settle += 1
+            converged = cluster.wait_converged(args.timeout)
+        cluster.watching.set()
+
+        chain = cluster.get_main_chain()
+        on_chain = set(chain)
+        arrivals = cluster.get_arrivals(chain)
+        mined = [block for job in jobs for block in job['mined']]
+        propagation = [max(0.0, arrivals[block['hash']] - job['finished'])
+                       for job in jobs for block in job['mined'] if block['hash'] in arrivals]
+        stale = len([block for block in mined if block['hash'] not in on_chain])
+        metrics = cluster.gather_metrics()
+    finally:
+        cluster.stop()
+
+    report = {
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {
+            'nodes': args.nodes,
+            'topology': args.topology,
+            'degree': args.degree,
+            'links': sum([len(neighbors) for neighbors in cluster.links]) // 2,
+            'blocks': args.blocks,
+            'interval': args.interval,
+            'transfers': args.transfers,
+            'difficulty': args.difficulty,
+            'sync_interval': args.sync_interval,
+        },
+        'start_seconds': start_seconds,
+        'workload_seconds': workload_seconds,
+        'converged': converged is not None,
+        'convergence_seconds': converged - mined_at if converged is not None else None,
+        'settle_blocks': settle,
+        'height': len(chain) - 1,
+        'mined_blocks': len(mined),
+        'stale_blocks': stale,
+        'stale_rate': stale / len(mined) if len(mined) > 0 else 0.0,
+        'stale_rounds': sum([job['stale'] for job in jobs]),
+        'propagation_seconds': summarize(propagation),
+        'transfers': transfers,
+        'reorgs': int(sum(metrics.get('minibitcoin_reorg_depth_blocks_count', {}).values())),
+        'gossip': {','.join([value for _, value in labels]): int(count)
+                   for labels, count in metrics.get('minibitcoin_gossip_messages_total', {}).items()},
+        'bytes': get_traffic(metrics),
+        'latency': get_latency(metrics),
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print (text)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the light wallet, which keeps the block headers only (SPV).
+
+import os
+import pickle
+from argparse import ArgumentParser
+from time import time
+
+from Merkle_Tree import *
+from block_filter import *
+from peers import *
+from utils import *
+from utxo import *
+from wallet import Wallet
+
+MAX_HEADERS = 2000  # the most headers in one request, the same as the full nodes
+NO_ROOT = bytes(DIGEST_SIZE)    # stored for the blocks without a transaction root
+
+
+class HeaderChain(object):
+    '''
+    The block hashes and transaction roots of a chain, about 96 bytes a block
+    The block hashes are the leaves of a Merkle accumulator keeping its levels,
+    so a reorg is rolled back in O(log n) instead of hashing the kept headers again
+    A block is hashed with its transactions, so neither the hash nor hashTransRoot of a header can be checked here,
+    they are kept as the peer tells them, see LightWallet for the trust model
+    '''
+    def __init__(self):
+        self.roots = bytearray()        # the digests of hashTransRoot, NO_ROOT if there is none
+        self.merkle = Merkle_Accumulator(keep_levels=True)  # the Merkle state of the block hashes
+
+    def __setstate__(self, state):
+        # the headers stored by older versions keep the block hashes apart, and the peaks only
+        hashes = state.pop('hashes', None)
+        self.__dict__.update(state)
+        if hashes is not None:
+            self.merkle = Merkle_Accumulator([hashes[index:index+DIGEST_SIZE].hex()
+                                              for index in range(0, len(hashes), DIGEST_SIZE)], keep_levels=True)
+
+    def __len__(self):
+        return self.merkle.size
+
+    def block_hash(self, height):
+        if height < 0:
+            height += len(self)
+        return self.merkle.get_leaf(height)
+
+    def get_trans_root(self, height):
+        # the transaction root of the block at height, None if the block has none
+        root = bytes(self.roots[height*DIGEST_SIZE:(height+1)*DIGEST_SIZE])
+        if root == NO_ROOT:
+            return None
+        return root.hex()
+
+    def is_legacy(self, height):
+        # whether the block is created by older versions, as UTXOSet.is_legacy() tells by the blocks without a root
+        if height > LEGACY_HEIGHT:
+            return False
+        return bytes(self.roots[:(height+1)*DIGEST_SIZE]) == NO_ROOT * (height + 1)
+
+    def start(self, height):
+        '''
+        Get the state to check the headers after the block at height, costs O(log n)
+        :param height: <int> the height of the last header kept, -1 for none
+        :return: <dict> {'height', 'hash', 'merkle'}
+        '''
+        if height == len(self) - 1:
+            merkle = self.merkle.copy()
+        else:
+            merkle = self.merkle.prefix(height + 1)
+        return {'height': height, 'hash': self.block_hash(height) if height >= 0 else None, 'merkle': merkle}
+
+    @staticmethod
+    def check(state, header):
+        '''
+        Check the next header and move the state to it
+        The hash of a header can't be computed, a block is hashed with its transactions,
+        it's bound by hashPreBlock and hashMerkleRoot of the next header instead.
+        So the hash of the last header is trusted until a header after it is checked,
+        and hashTransRoot is never bound to the hash, it's trusted as the peer tells it.
+        :param state: <dict> returned by start()
+        :param header: <dict> {'index', 'hash', 'Blockheader'}
+        :return: <bool> True if it's valid
+        '''
+        try:
+            if header['index'] != state['height'] + 1:
+                return False
+            if state['height'] >= 0:
+                if header['Blockheader']['hashPreBlock'] != state['hash']:
+                    return False
+                if header['Blockheader']['hashMerkleRoot'] != state['merkle'].get_root():
+                    return False
+            if len(bytes.fromhex(header['hash'])) != DIGEST_SIZE:
+                return False
+            bytes.fromhex(header['Blockheader'].get('hashTransRoot') or '')
+        except (KeyError, TypeError, ValueError):
+            return False    # malformed header
+        state['height'] += 1
+        state['hash'] = header['hash']
+        state['merkle'].append(header['hash'])
+        return True
+
+    def replace(self, height, headers):
+        '''
+        Keep the headers until height, then append the checked headers
+        :param height: <int> the height of the last header kept
+        :param headers: <list> the checked headers after it
+        '''
+        self.merkle.truncate(height + 1)
+        del self.roots[(height+1)*DIGEST_SIZE:]
+        for header in headers:
+            self.merkle.append(header['hash'])
+            root = header['Blockheader'].get('hashTransRoot')
+            self.roots += bytes.fromhex(root) if root else NO_ROOT
+
+
+class LightWallet(object):
+    '''
+    A wallet verifying its payments without the whole chain (SPV)
+    Only the headers and the filters of the blocks are synced, the blocks whose filters match my address
+    are downloaded and checked against the block hashes of the headers, my unspent outputs are found in them.
+    The trust model: the headers are trusted as the peer tells them. The block hash covers the transactions
+    and can't be computed from the header, and the proof of work is not kept in the block, so a peer can make up
+    a consistent chain of headers. The filters are trusted too, a peer can hide a block concerning me.
+    So the peers should be full nodes the user trusts, e.g. their own
+    It keeps no chain, only the handling of the keys and the peers is shared with Wallet
+    '''
+    def __init__(self, key_gen=False, load_key=True, data_dir='light'):
+        '''
+        :param data_dir: <str> the directory of keys and the headers
+        '''
+        self.pri_key = None                 # private key
+        self.pub_key = None                 # public key
+        self.address = None                 # wallet address
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.headers = HeaderChain()        # the headers of the longest chain
+        self.unspent = {}                   # (hash, index) -> {'value', 'height'}, found in the matching blocks
+        self.scanned = -1                   # the height of the last block whose filter is checked
+        self.spent = set()                  # the outputs spent by my transactions not mined yet
+        self.peers = []                     # the full nodes to ask
+        self.client = PeerClient()          # pooled connections to the peers
+        self.quorum = None                  # the number of peer tips to wait for, None for a majority
+        self.last_sync = None               # the time of the last sync with the peers
+        self.received = 0                   # the bytes received from the peers
+
+        if key_gen is True and load_key is not True:
+            self.generate_keys()
+        if key_gen is not True and load_key is True:
+            self.load_keys()
+        if (key_gen is True and load_key is True) or \
+            (key_gen is not True and load_key is not True):
+            print ('key_gen and load_key can\'t have the same boolean value!')
+            exit(0)
+        self.load_headers()
+
+
+    # the keys, the signing and the peers, as a full wallet does
+    generate_keys = Wallet.generate_keys
+    load_keys = Wallet.load_keys
+    make_transaction = Wallet.make_transaction
+    peer_register = Wallet.peer_register
+
+
+    def headers_path(self):
+        return os.path.join(self.data_dir, 'headers.pkl')
+
+
+    def load_headers(self):
+        if os.path.exists(self.headers_path()) is True:
+            with open(self.headers_path(), 'rb') as file:
+                state = pickle.load(file)
+            if len(state) == 3:
+                self.headers, _, self.spent = state     # the outputs of older versions are scanned again
+            else:
+                self.headers, self.unspent, self.spent, self.scanned = state
+
+
+    def store_headers(self):
+        # write to a temporary file first, so a crash never corrupts the headers
+        temp_path = self.headers_path() + '.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump((self.headers, self.unspent, self.spent, self.scanned), file)
+        os.replace(temp_path, self.headers_path())
+
+
+    def get_json(self, node, path, params=None):
+        # count the bytes received
+        response = self.client.request(node, path, params=params, timeout=self.client.download_timeout)
+        if response is None or response.status_code != 200:
+            return None
+        self.received += len(response.content)
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+
+    def sync_headers(self, node, length):
+        '''
+        Download the headers of a peer after the common ancestor
+        :param node: <str> the peer
+        :param length: <int> the length of the peer's chain
+        :return: <bool> True if our headers were replaced
+        '''
+        height = find_common_ancestor(self.client, node, length, len(self.headers), self.headers.block_hash)
+        if height is None:
+            return False
+        state = self.headers.start(height)
+        headers = []
+        while state['height'] < length - 1:
+            res = self.get_json(node, '/chain/headers', params={'from': state['height'] + 1, 'limit': MAX_HEADERS})
+            if not isinstance(res, dict) or not isinstance(res.get('headers'), list):
+                return False    # the peer fails
+            if len(res['headers']) == 0:
+                break
+            for header in res['headers']:
+                if self.headers.check(state, header) is not True:
+                    return False    # the peer's chain is invalid
+                headers.append(header)
+        if state['height'] + 1 <= len(self.headers):
+            return False    # not longer than ours
+
+        self.headers.replace(height, headers)
+        if height < self.scanned:
+            # the outputs spent by the replaced blocks are unknown, scan the blocks again
+            self.unspent = {}
+            self.scanned = -1
+        return True
+
+
+    def sync_blocks(self, node):
+        '''
+        Find my unspent outputs in the blocks after the last scanned one, up to our tip
+        The filters of the blocks are checked first, only the matching blocks are downloaded
+        :param node: <str> the peer
+        :return: <bool> True if all the blocks are scanned
+        '''
+        unspent = dict(self.unspent)
+        height = self.scanned + 1
+        while height < len(self.headers):
+            res = self.get_json(node, '/chain/filters', params={'from': height, 'limit': MAX_HEADERS})
+            if not isinstance(res, dict) or not isinstance(res.get('filters'), list) or len(res['filters']) == 0:
+                return False    # the peer fails
+            for item in res['filters'][:len(self.headers) - height]:
+                block_hash = self.headers.block_hash(height)
+                try:
+                    if item['index'] != height or item['hash'] != block_hash:
+                        return False    # not the blocks of our headers
+                    match = filter_match(bytes.fromhex(item['filter']), block_hash, [self.address])
+                except (KeyError, TypeError, ValueError):
+                    return False    # malformed filter
+                if match and self.scan_block(node, height, unspent) is not True:
+                    return False
+                height += 1
+
+        self.unspent = unspent
+        self.scanned = height - 1
+        self.spent = set([key for key in self.spent if key in unspent])     # the mined ones are gone
+        return True
+
+
+    def scan_block(self, node, height, unspent):
+        '''
+        Download a block matching my address and apply it to my unspent outputs, as UTXOSet.connect_block() does
+        :param node: <str> the peer
+        :param height: <int> the height of the block
+        :param unspent: <dict> my unspent outputs, changed in place
+        :return: <bool> False if the peer fails or the block is not the one of our headers
+        '''
+        res = self.get_json(node, '/blocks/' + self.headers.block_hash(height))
+        try:
+            block = res['block']
+            if hash_block(block) != self.headers.block_hash(height):
+                return False    # the peer lies
+            if self.headers.is_legacy(height):
+                # the balance of older versions, see UTXOSet.connect_legacy()
+                key = get_legacy_key(self.address)
+                value = get_legacy_changes(block['Transaction']).get(self.address, 0.0)
+                value += unspent[key]['value'] if key in unspent else 0.0
+                unspent.pop(key, None)
+                if value > 0:
+                    unspent[key] = {'value': value, 'height': height}
+                return True
+
+            for trans in get_transactions(block):
+                for trans_in in trans['in']:
+                    if 'index' in trans_in['prev_out']:
+                        unspent.pop((trans_in['prev_out']['hash'], trans_in['prev_out']['index']), None)
+                for index, trans_out in enumerate(trans['out']):
+                    if trans_out['address'] == self.address and trans_out['value'] != 0.0:
+                        unspent[(trans['hash'], index)] = {'value': trans_out['value'], 'height': height}
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return False    # malformed block
+        return True
+
+
+    def sync(self):
+        '''
+        Sync the headers of the longest chain, then the unspent outputs of my address
+        :return: <bool> True if our headers were replaced
+        '''
+        quorum = self.quorum or len(self.peers) // 2 + 1
+        tips = self.client.fan_out(self.peers, '/chain/tip', quorum=quorum)
+        tips = dict([(node, tip) for node, tip in tips.items() if isinstance(tip, dict) and type(tip.get('length')) is int])
+        replaced = False
+        # try the longest first
+        for node in sorted(tips, key=lambda node: tips[node]['length'], reverse=True):
+            if tips[node]['length'] <= len(self.headers):
+                break
+            if self.sync_headers(node, tips[node]['length']):
+                replaced = True
+                break
+
+        # any peer with our headers has the blocks
+        for node in tips:
+            if self.scanned == len(self.headers) - 1 or self.sync_blocks(node):
+                break
+        if len(tips) > 0:
+            self.last_sync = time()     # a peer answered, no sync when all of them fail
+        self.store_headers()
+        return replaced
+
+
+    def get_balance(self, fresh=False):
+        '''
+        Get the balance from the checked unspent outputs
+        :param fresh: <bool> sync with the peers first
+        :return: <float>
+        '''
+        if fresh:
+            self.sync()
+        return sum([output['value'] for key, output in self.unspent.items() if key not in self.spent])
+
+
+    def get_transaction_inputs(self, amount):
+        balance = 0.0
+        inputs = []
+        for key, output in sorted(self.unspent.items(), key=lambda item: item[1]['height']):
+            if key in self.spent:
+                continue
+            inputs.append((key, output['value']))
+            balance += output['value']
+            if balance >= amount:
+                return inputs
+        return None     # coins not enough
+
+
+    def new_transaction(self, amount, address, fee=0.0):
+        '''
+        Sign a transaction and submit it to the peers
+        :return: <tuple> (transaction, reason), reason is None if a peer accepted it
+        '''
+        inputs = self.get_transaction_inputs(amount + fee)
+        if inputs is None:
+            return None, 'Balance not enough'
+        trans = self.make_transaction(inputs, amount, address, fee)
+
+        reason = 'No peer replied'
+        for node in self.peers:
+            response = self.client.request(node, '/transactions/submit', method='POST', json=trans)
+            if response is None:
+                continue
+            if response.status_code == 201:
+                self.spent.update([key for key, _ in inputs])
+                self.store_headers()
+                return trans, None
+            reason = response.json().get('message', reason)
+        return trans, reason
+
+
+    def get_stats(self):
+        '''
+        :return: <dict> the size of the data kept and received
+        '''
+        return {
+            'headers': len(self.headers),
+            'header_bytes': sum([len(level) for level in self.headers.merkle.levels]) + len(self.headers.roots),
+            'outputs': len(self.unspent),
+            'received_bytes': self.received,
+        }
+
+
+def main():
+    parser = ArgumentParser(description='The light wallet, which keeps the block headers only')
+    parser.add_argument('command', choices=['address', 'balance', 'send'], help='the operation')
+    parser.add_argument('args', nargs='*', help='send: the value and the target address')
+    parser.add_argument('-n', '--nodes', required=True, help='the full nodes, separated by commas. Eg. http://127.0.0.1:10000')
+    parser.add_argument('-d', '--data-dir', default='light', help='the directory of keys and the headers')
+    parser.add_argument('-f', '--fee', default=0.0, type=float, help='the fee for the miner')
+    args = parser.parse_args()
+
+    wallet = LightWallet(data_dir=args.data_dir)
+    for node in args.nodes.split(','):
+        wallet.peer_register(node)
+    if args.command == 'address':
+        print (f'My wallet address is {wallet.address}')
+        return
+
+    wallet.sync()
+    if args.command == 'balance':
+        print (f'My balance is {wallet.get_balance()} coins')
+    elif args.command == 'send':
+        if len(args.args) != 2:
+            parser.error('send needs the value and the target address')
+        trans, reason = wallet.new_transaction(float(args.args[0]), args.args[1], args.fee)
+        print (reason or f'{args.args[0]} coins will be transfered to {args.args[1]}.')
+    print (wallet.get_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import sys
 import os
 from argparse import ArgumentParser
 import threading
+from time import perf_counter
 import requests
 
 # disable Flask's output
@@ -15,12 +16,16 @@ import logging
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 
 from block_chain import *
 from utils import *
 from wallet import *
 from Merkle_Tree import *
+from metrics import *
+from miner import *
+from mining_jobs import *
+from replicas import *
 
 path = sys.path[0]
 os.chdir(path)  # change to current directory
@@ -28,151 +33,510 @@ os.chdir(path)  # change to current directory
 
 app = Flask(__name__)
 
+MAX_HEADERS = 2000  # the most headers in one response
+SYNC_INTERVAL = 10.0    # seconds between two rounds of background sync, 0 to disable
+MAX_BLOCK_TRANSACTIONS = 500    # the most transactions packed from the pool into a block
+MINE_TIMEOUT = 60.0     # seconds GET /mine waits for its block
+REPLICA_ROUTES = {'full_chain', 'chain_tip', 'chain_headers', 'chain_filters', 'get_proof', 'get_block',
+                  'get_utxos', 'get_balance', 'get_address', 'sync_status', 'get_metrics'}  # served by the read replicas
+
+
+# the instance of the wallet, MINIBITCOIN_DATA_DIR runs more nodes from one copy of the code
+my_wallet = Wallet(data_dir=os.environ.get('MINIBITCOIN_DATA_DIR', 'database'))
+mining_jobs = MiningJobs(my_wallet, MAX_BLOCK_TRANSACTIONS)   # mining runs on its own thread
+replica_signal = None   # <TipSignal> the tip of the primary, set in the read replicas only
+
+CHAIN_HEIGHT.set_function(lambda: len(my_wallet.blockchain.snapshot) - 1)
+HASH_RATE.set_function(lambda: sum([stats['hash_rate'] for stats in my_wallet.blockchain.get_mining_stats()]))
+PEER_LATENCY.set_function(lambda: {(node, ): stats['latency'] for node, stats in my_wallet.client.get_stats().items()
+                                   if stats['latency'] is not None})
+MEMPOOL_SIZE.set_function(lambda: len(my_wallet.mempool))
+CHAIN_STALENESS.set_function(my_wallet.get_staleness)
+MINING_JOBS.set_function(lambda: {(state, ): count for state, count in mining_jobs.get_stats().items()})
+
+
+def is_fresh():
+    # whether the request asks to update from peers first, the read replicas never write
+    return replica_signal is None and request.args.get('fresh', '0') not in ('0', '', 'false')
+
+
+@app.before_request
+def start_timer():
+    g.start = perf_counter()
+
+
+@app.before_request
+def follow_primary():
+    # in a read replica, refuse what is not a read, and catch up with the primary first
+    if replica_signal is None:
+        return None
+    if request.endpoint not in REPLICA_ROUTES:
+        return jsonify({'message': 'This is a read replica, send it to the primary'}), 405
+    my_wallet.blockchain.follow(replica_signal)
+    return None
+
+
+@app.after_request
+def record_request(response):
+    # the time until the response is returned, a streamed body is not waited for
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    HTTP_BYTES.inc(request.content_length or 0, route=route, direction='received')
+    if response.is_streamed is not True:
+        HTTP_BYTES.inc(response.calculate_content_length() or 0, route=route, direction='sent')
+    if 'start' in g:
+        HTTP_REQUEST_SECONDS.observe(perf_counter() - g.start, route=route)
+    return response
+
+
+@app.after_request
+def add_staleness(response):
+    # how old the local view of the chain is, the read replicas don't sync
+    staleness = my_wallet.get_staleness()
+    if staleness is not None and replica_signal is None:
+        response.headers['X-Chain-Staleness'] = '%.3f'%staleness
+    return response
 
-# the instance of the wallet
-my_wallet = Wallet()
 
 @app.route('/mine', methods=['GET'])
 def mine():
     '''
-    Mine a block. Reward is 5.0 coins.
+    Mine a block and wait for it. Reward is 5.0 coins.
+    Use ?fresh=1 to update from peers first, and ?timeout=S to wait S seconds at most
+    It's 202 with the queued job if the block is not mined in time, as POST /mine is
     '''
-    my_wallet.resolve_conflicts()   # update from peers
-    assert my_wallet.blockchain.valid_chain(my_wallet.blockchain.chain) == True
-    last_block = my_wallet.blockchain.last_block
+    if is_fresh():
+        my_wallet.sync()   # update from peers
+    assert my_wallet.blockchain.valid_chain(my_wallet.blockchain.snapshot.chain) == True
+
+    job = mining_jobs.submit(blocks=1)
+    if job.done.wait(request.args.get('timeout', MINE_TIMEOUT, type=float)) is not True:
+        # queued behind other jobs, or the proof is hard to find
+        response = {
+            'message': 'Mining job %s is not done yet'%job.id,
+            'job': job.to_dict(),
+            'status': '/mine/%s'%job.id,
+            'cancel': '/mine/%s/cancel'%job.id,
+        }
+        return jsonify(response), 202
+    if len(job.mined) == 0:
+        response = {
+            'message': 'Mining cancelled' if job.error is None else 'Mining failed: %s'%job.error,
+            'job': job.to_dict(),
+            'hash_rate': job.hash_rate,
+        }
+        return jsonify(response), 409 if job.error is None else 500
+
+    block = job.mined[0]
+    response = {
+        'message': 'Mining succeed',
+        'index': block['index'],
+        'amount': block['amount'],
+        'transactions': block['transactions'],
+        'hash_rate': job.hash_rate,
+    }
+    return jsonify(response), 200
 
-    proof = my_wallet.blockchain.proof_of_work()    # do the calculation
 
-    # create a new block
-    block = get_empty_block()
-    block['index'] = last_block['index'] + 1
-    block['Blockheader']['hashPreBlock'] = my_wallet.blockchain.hash(last_block)
+@app.route('/mine', methods=['POST'])
+def submit_mining():
+    '''
+    Queue a mining job and return at once
+    Body (optional): {"blocks": 1, "fresh": false}, blocks 0 to keep mining until cancelled
+    '''
+    values = request.get_json(silent=True) or {}
+    try:
+        blocks = int(values.get('blocks', 1))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Wrong number of blocks'}), 400
+    if blocks < 0:
+        return jsonify({'message': 'Wrong number of blocks'}), 400
+
+    job = mining_jobs.submit(blocks=blocks, fresh=values.get('fresh') is True or is_fresh())
+    response = {
+        'message': 'Mining job %s queued'%job.id,
+        'job': job.to_dict(),
+        'status': '/mine/%s'%job.id,
+        'cancel': '/mine/%s/cancel'%job.id,
+    }
+    return jsonify(response), 202
 
-    mt = Merkle_Tree(my_wallet.blockchain.chain)
-    mt.create_tree()
-    block['Blockheader']['hashMerkleRoot'] = mt.get_root_transaction()
 
-    trans_in = get_trans_in(n=5.0, sig='system')
-    block['Transaction']['in'].append(trans_in)
+@app.route('/mine/jobs', methods=['GET'])
+def list_mining():
+    '''
+    Get the status of all the kept mining jobs
+    '''
+    jobs = [job.to_dict() for job in mining_jobs.list()]
+    return jsonify({'jobs': jobs, 'length': len(jobs)}), 200
 
-    trans_out = get_trans_out(value=5.0, address=my_wallet.address, from_address='system')
-    block['Transaction']['out'].append(trans_out)
 
-    temp={}
-    temp['in'] = block['Transaction']['in']
-    temp['out'] = block['Transaction']['out']
-    block['Transaction']['hash'] = hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
+@app.route('/mine/<job_id>', methods=['GET'])
+def mining_status(job_id):
+    '''
+    Get the state, the mined blocks and the hash rate of a mining job
+    '''
+    job = mining_jobs.get(job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
 
-    my_wallet.blockchain.chain.append(block)
-    my_wallet.store_chain()
 
+@app.route('/mine/<job_id>/cancel', methods=['POST'])
+def cancel_mining(job_id):
+    '''
+    Stop a mining job, the block being searched is dropped
+    '''
+    job = mining_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    job.done.wait(timeout=5.0)  # the round stops at the next batch of nonces
     response = {
-        'message': 'Mining succeed',
-        'index': block['index'],
-        'amount': '5.0',
+        'message': 'Mining job %s %s'%(job.id, job.state),
+        'job': job.to_dict(),
     }
     return jsonify(response), 200
 
 
-# even if all the coins are transfered to others,
-# we transfer 0.0 to ourself, which is easier to calculate balance
-
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
     '''
-    A new transfer from current wallet
+    A new transfer from current wallet, which is added to the pool and mined later
     Use Postman to transfer parameters
     Parameters transfered to Postman:
     {
         "value":    ,
-        "address":  ""
+        "address":  "",
+        "fee":      (optional)
     }
+    Use ?fresh=1 to update from peers first
     '''
-    my_wallet.resolve_conflicts()
-    assert my_wallet.blockchain.valid_chain(my_wallet.blockchain.chain) == True
-    last_block = my_wallet.blockchain.last_block
+    if is_fresh():
+        my_wallet.sync()
 
     values = request.get_json()
     # Check that the required fields are in the POST'ed data
     required = ['value', 'address']
-    if not all(k in values for k in required):
+    if not isinstance(values, dict) or not all(k in values for k in required):
         return 'Missing values', 400
     
-    balance = my_wallet.get_balance()
-    amount = values['value']
-    if balance < amount:
-        # balance is not enough
-        return 'Balance not enough', 403
-    
-    # the new block
-    new_block = get_empty_block()
-    new_block['index'] = last_block['index'] + 1
-    new_block['Blockheader']['hashPreBlock'] = my_wallet.blockchain.hash(last_block)
-    mt = Merkle_Tree(my_wallet.blockchain.chain)
-    mt.create_tree()
-    new_block['Blockheader']['hashMerkleRoot'] = mt.get_root_transaction()
-
-    # get the blocks for input
-    block_dict = my_wallet.get_transaction_input_blocks(amount)
-    # deploy tran_in
-    coins = 0.0
-    for block_str in block_dict:    # key is str
-        block = eval(block_str)
-        if coins + block_dict[block_str] < amount:  # all the coins in the block
-            n = block_dict[block_str]
-        else:   # part of the coins
-            n = amount - coins
-        coins += block_dict[block_str]
-
-        pre_hash = block['Transaction']['hash']
-        temp = {}
-        temp['hash'] = pre_hash
-        temp['n'] = n
-
-        ha = hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
-        sig = my_wallet.pri_key.sign(ha.encode()).hex() # str, use private key to sign the hash
-        pub_key = my_wallet.pub_key.to_string().hex()   # str
-        
-        trans_in = get_trans_in(pre_hash=pre_hash, n=n, sig=sig, pub_key=pub_key)   # dict
-        new_block['Transaction']['in'].append(trans_in) # add the input
-    
-    trans_out_1 = get_trans_out(value=amount, address=values['address'], from_address=my_wallet.address)
-    trans_out_2 = get_trans_out(value=coins-amount, address=my_wallet.address, from_address=my_wallet.address)    # coins-amount (maybe 0.0) to my wallet
-    new_block['Transaction']['out'].append(trans_out_1)
-    new_block['Transaction']['out'].append(trans_out_2)
+    fee = values.get('fee', 0.0)
+    if isinstance(fee, bool) or not isinstance(fee, (int, float)) or not 0 <= fee < float('inf'):
+        return jsonify({'message': 'Wrong fee'}), 400
 
-    # get the transaction hash
-    temp={}
-    temp['in'] = new_block['Transaction']['in']
-    temp['out'] = new_block['Transaction']['out']
-    new_block['Transaction']['hash'] = hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
+    amount = values['value']
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or not 0 <= amount < float('inf'):
+        return jsonify({'message': 'Wrong value'}), 400
+    if not isinstance(values['address'], str):
+        return jsonify({'message': 'Wrong address'}), 400
 
-    my_wallet.blockchain.chain.append(new_block)
-    my_wallet.store_chain() # store the chain
+    trans, reason = my_wallet.new_transaction(amount, values['address'], fee)
+    if reason is not None:
+        # balance is not enough
+        return jsonify({'message': reason}), 403
 
     addr = values['address']
-    response = {'message': f'{amount} coins has been transfered to {addr}.'}
+    response = {
+        'message': f'{amount} coins will be transfered to {addr}.',
+        'hash': trans['hash'],
+    }
     return jsonify(response), 201
 
 
+@app.route('/transactions/submit', methods=['POST'])
+def submit_transaction():
+    '''
+    Add a transaction signed by another wallet to the pool
+    Input: the transaction {"hash": "", "in": [], "out": []}
+    '''
+    trans = request.get_json()
+    if not isinstance(trans, dict) or not all(k in trans for k in ['hash', 'in', 'out']):
+        return 'Missing values', 400
+    reason = my_wallet.submit_transaction(trans)
+    if reason is not None:
+        return jsonify({'message': reason}), 403
+    return jsonify({'message': 'Transaction added to the pool', 'hash': trans['hash']}), 201
+
+
+@app.route('/transactions/pending', methods=['GET'])
+def pending_transactions():
+    '''
+    Get the transactions in the pool
+    '''
+    response = {
+        'transactions': list(my_wallet.mempool.transactions.values()),
+        'length': len(my_wallet.mempool),
+    }
+    return jsonify(response), 200
+
+
 @app.route('/balance', methods=['GET'])
 def get_balance():
     '''
     Get the balance of this wallet
+    Use ?fresh=1 to update from peers first
     '''
-    balance = my_wallet.get_balance()
+    balance = my_wallet.get_balance(fresh=is_fresh())
     response = {'message': f'My balance is {balance} coins'}
     return jsonify(response), 200
 
 
+def count_payload(chunks):
+    # observe the bytes of a chain sent, before compression
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        CHAIN_PAYLOAD_BYTES.observe(size, direction='sent')
+
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
     '''
-    Get the full chain of this wallet
+    Get the full chain of this wallet, the blocks are streamed
+    Use ?offset=N (or ?from=N) and ?limit=M to get a page of the blocks only
+    Use ?format=ndjson (or Accept: application/x-ndjson) to get one block per line
+    The response is compressed if the client accepts gzip,
+    and it's 304 if the client has the same page of the same tip already (If-None-Match)
+    '''
+    snapshot = my_wallet.blockchain.snapshot     # the blocks streamed are the ones at this tip
+    length = len(snapshot)
+    start = max(0, request.args.get('offset', request.args.get('from', 0, type=int), type=int))
+    limit = request.args.get('limit', None, type=int)
+    stop = length if limit is None else min(length, start + limit)
+    stop = max(start, stop)
+    ndjson = request.args.get('format') == 'ndjson' \
+        or request.accept_mimetypes.best == 'application/x-ndjson'
+
+    # the tip, the page and the format make the body
+    etag = '%s:%d-%d:%s'%(snapshot.tip_hash or '', start, stop, 'ndjson' if ndjson else 'json')
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    chunks = count_payload(snapshot.iter_encoded(start, stop, ndjson))
+    response = Response(mimetype='application/x-ndjson' if ndjson else 'application/json')
+    if request.accept_encodings['gzip'] > 0:
+        chunks = gzip_chunks(chunks)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.response = stream_with_context(chunks)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    response.headers['X-Chain-Length'] = str(length)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+@app.route('/chain/tip', methods=['GET'])
+def chain_tip():
+    '''
+    Get the height and hash of the last block
+    '''
+    snapshot = my_wallet.blockchain.snapshot
+    response = {
+        'height': len(snapshot) - 1,
+        'hash': snapshot.tip_hash,
+        'length': len(snapshot),
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/forks', methods=['GET'])
+def chain_forks():
+    '''
+    Get the tips of the side branches kept in the block tree
+    '''
+    with my_wallet.blockchain.lock:     # the tree has no snapshot, it's read between the writes
+        response = {
+            'height': len(my_wallet.blockchain.chain) - 1,
+            'tips': my_wallet.blockchain.tree.get_tips(),
+            'blocks': len(my_wallet.blockchain.tree),
+        }
+    return jsonify(response), 200
+
+
+@app.route('/chain/headers', methods=['GET'])
+def chain_headers():
+    '''
+    Get the block headers and block hashes from height N
+    Use ?from=N&limit=M, at most MAX_HEADERS headers are returned
     '''
+    snapshot = my_wallet.blockchain.snapshot
+    chain = snapshot.chain
+    start = max(0, request.args.get('from', 0, type=int))
+    limit = min(MAX_HEADERS, request.args.get('limit', MAX_HEADERS, type=int))
+    headers = []
+    for height in range(start, min(len(chain), start + limit)):
+        headers.append({
+            'index': height,
+            'hash': snapshot.block_hash(height),
+            'Blockheader': chain[height]['Blockheader'],
+        })
     response = {
-        'chain': my_wallet.blockchain.chain,
-        'length': len(my_wallet.blockchain.chain),
+        'headers': headers,
+        'length': len(chain),
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/filters', methods=['GET'])
+def chain_filters():
+    '''
+    Get the filters of the blocks from height N, check them with filter_match()
+    Use ?from=N&limit=M, at most MAX_HEADERS filters are returned
+    '''
+    blockchain = my_wallet.blockchain.snapshot
+    start = max(0, request.args.get('from', 0, type=int))
+    limit = min(MAX_HEADERS, request.args.get('limit', MAX_HEADERS, type=int))
+    filters = []
+    for height in range(start, min(len(blockchain.chain), start + limit)):
+        filters.append({
+            'index': height,
+            'hash': blockchain.block_hash(height),
+            'filter': blockchain.get_filter(height).hex(),
+        })
+    response = {
+        'filters': filters,
+        'length': len(blockchain.chain),
+    }
+    return jsonify(response), 200
+
+
+@app.route('/proof/<hash_val>', methods=['GET'])
+def get_proof(hash_val):
+    '''
+    Get the Merkle proof of a block or a transaction, check it with verify_proof()
+    A block is proved against the root of the first N blocks with ?size=N, default is all the blocks,
+    the root of the first N blocks is hashMerkleRoot of the block at height N
+    A transaction is proved against hashTransRoot of its block, use ?height=N to give the block
+    '''
+    blockchain = my_wallet.blockchain.snapshot
+    height = blockchain.find_block(hash_val)
+    if height is not None:
+        proof = blockchain.get_block_proof(height, request.args.get('size', None, type=int))
+        if proof is None:
+            return jsonify({'message': 'Size out of range'}), 400
+        return jsonify(proof), 200
+
+    height = request.args.get('height', None, type=int)
+    if height is None:
+        return jsonify({'message': 'Block not found, use ?height=N for a transaction'}), 404
+    proof = blockchain.get_trans_proof(hash_val, height)
+    if proof is None:
+        return jsonify({'message': 'Transaction not found in the block'}), 404
+    return jsonify(proof), 200
+
+
+@app.route('/blocks/<hash_val>', methods=['GET'])
+def get_block(hash_val):
+    '''
+    Get a block by its hash, on our chain or on a side branch
+    '''
+    snapshot = my_wallet.blockchain.snapshot
+    node = my_wallet.blockchain.tree.nodes.get(hash_val)
+    height = snapshot.find_block(hash_val)
+    if height is not None:
+        data = snapshot.block_data(height)
+    elif node is not None:
+        height, data = node.height, snapshot.encode(node.block)
+    else:
+        return jsonify({'message': 'Block not found'}), 404
+    body = b'{"block": ' + data + b', "height": ' + str(height).encode() + b'}'
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/blocks/announce', methods=['POST'])
+def announce_block():
+    '''
+    A peer has a new block, it's fetched in the background if we don't have it
+    Input: {"hash": "", "height": , "node": "192.168.0.5:5000"}, node is where to fetch it, one of our peers
+    '''
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or not all(k in values for k in ['hash', 'height', 'node']):
+        return 'Missing values', 400
+    if not isinstance(values['hash'], str) or type(values['height']) is not int or values['height'] < 0 \
+        or not isinstance(values['node'], str):
+        return jsonify({'message': 'Wrong values'}), 400
+    if values['node'] not in my_wallet.peers:
+        # a session is kept for every node fetched from, only the registered peers are
+        GOSSIP_MESSAGES.inc(kind='block', result='rejected')
+        return jsonify({'message': 'Not a registered peer'}), 403
+    if my_wallet.inventory.claim(values['hash']) is not True:
+        GOSSIP_MESSAGES.inc(kind='block', result='known')
+        return jsonify({'message': 'Block known'}), 200
+    my_wallet.gossip.submit(my_wallet.receive_block, values['hash'], values['height'], values['node'])
+    return jsonify({'message': 'Block will be fetched'}), 202
+
+
+@app.route('/tx/<trans_hash>', methods=['GET'])
+def get_pooled_transaction(trans_hash):
+    '''
+    Get a transaction in the pool by its hash
+    '''
+    trans = my_wallet.mempool.transactions.get(trans_hash)
+    if trans is None:
+        return jsonify({'message': 'Transaction not in the pool'}), 404
+    return jsonify(trans), 200
+
+
+@app.route('/tx/announce', methods=['POST'])
+def announce_transaction():
+    '''
+    A peer has a new transaction, it's fetched in the background if it's not in our pool
+    Input: {"hash": "", "node": "192.168.0.5:5000"}, node is where to fetch it, one of our peers
+    '''
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or not all(k in values for k in ['hash', 'node']):
+        return 'Missing values', 400
+    if not isinstance(values['hash'], str) or not isinstance(values['node'], str):
+        return jsonify({'message': 'Wrong values'}), 400
+    if values['node'] not in my_wallet.peers:
+        GOSSIP_MESSAGES.inc(kind='transaction', result='rejected')
+        return jsonify({'message': 'Not a registered peer'}), 403
+    if my_wallet.inventory.claim(values['hash']) is not True:
+        GOSSIP_MESSAGES.inc(kind='transaction', result='known')
+        return jsonify({'message': 'Transaction known'}), 200
+    my_wallet.gossip.submit(my_wallet.receive_transaction, values['hash'], values['node'])
+    return jsonify({'message': 'Transaction will be fetched'}), 202
+
+
+@app.route('/utxos/<address>', methods=['GET'])
+def get_utxos(address):
+    '''
+    Get the unspent outputs of an address for light wallets
+    Every output comes with its transaction and the Merkle proof of the transaction in its block,
+    the whole block is given instead if it has no transaction root
+    The balances moved from older versions are not outputs of a transaction, they can't be proved and are left out
+    '''
+    with my_wallet.blockchain.lock:
+        # the unspent outputs are changed in place by the writes, read them with the snapshot of the same tip
+        blockchain = my_wallet.blockchain.snapshot
+        utxo = my_wallet.blockchain.utxo
+        unspent = [(key, value, utxo.outputs[key]['height']) for key, value in utxo.get_unspent(address)]
+    outputs = []
+    for key, value, height in unspent:
+        trans_hash, index = key
+        block = blockchain.chain[height]
+        output = {'hash': trans_hash, 'index': index, 'value': value, 'height': height}
+        for trans in get_transactions(block):
+            if trans['hash'] == trans_hash:
+                output['trans'] = trans
+                break
+        if 'trans' not in output:
+            continue
+        proof = blockchain.get_trans_proof(trans_hash, height)
+        if proof is None:
+            output['block'] = block     # created by older versions
+        else:
+            output['proof'] = {'index': proof['index'], 'size': proof['size'], 'path': proof['path']}
+        outputs.append(output)
+
+    response = {
+        'outputs': outputs,
+        'length': len(blockchain),
+        'tip': blockchain.tip_hash,
     }
     return jsonify(response), 200
 
@@ -208,19 +572,15 @@ def consensus():
     '''
     Our consensus algorithm.
     '''
-    replaced = my_wallet.resolve_conflicts()
-
-    if replaced:
-        response = {
-            'message': 'Our chain was replaced',
-            'new_chain': my_wallet.blockchain.chain
-        }
-    else:
-        response = {
-            'message': 'Our chain is authoritative',
-            'chain': my_wallet.blockchain.chain
-        }
+    replaced = my_wallet.sync()
 
+    # the chain itself is fetched by /chain, which is streamed
+    snapshot = my_wallet.blockchain.snapshot
+    response = {
+        'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+        'length': len(snapshot),
+        'hash': snapshot.tip_hash,
+    }
     return jsonify(response), 200
 
 
@@ -242,20 +602,66 @@ def get_neighbors():
     '''
     response = {
         'message': f'My peers are {my_wallet.peers}',
+        'stats': my_wallet.client.get_stats(),
     }
     return jsonify(response), 201
 
 
 
 
+@app.route('/sync/status', methods=['GET'])
+def sync_status():
+    '''
+    Get the state of the background sync
+    '''
+    response = {
+        'last_sync': my_wallet.last_sync,
+        'staleness': my_wallet.get_staleness(),
+        'interval': my_wallet.sync_interval,
+        'length': len(my_wallet.blockchain.snapshot),
+        'verifier': my_wallet.blockchain.verifier.get_stats(),
+    }
+    return jsonify(response), 200
+
+
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Get the counters, histograms and gauges in the Prometheus text format
+    '''
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+
+
 # Use commands to automatically send HTTP requests
-def Mine(port):
-    # port is an integer
+def Mine(port, blocks=1):
+    # port is an integer, the job runs in the background and can be stopped by Cancel_mining(port, job_id)
     url = 'http://127.0.0.1:' + str(port) + '/mine'
+    response = requests.post(url, json={'blocks': blocks})
+    dic = response.json()
+    print (dic['message'])
+    return dic['job']['id']
+
+
+def Mining_status(port, job_id=None):
+    if job_id is None:
+        url = 'http://127.0.0.1:' + str(port) + '/mine/jobs'
+    else:
+        url = 'http://127.0.0.1:' + str(port) + '/mine/' + job_id
     response = requests.get(url)
     print(response.text)
 
 
+def Cancel_mining(port, job_id):
+    url = 'http://127.0.0.1:' + str(port) + '/mine/' + job_id + '/cancel'
+    response = requests.post(url)
+    dic = response.json()
+    print (dic['message'])
+
+
 def New_transaction(port, value, address):
     url = 'http://127.0.0.1:' + str(port) + '/transactions/new'
     params = {"value": value, "address": address}
@@ -310,6 +716,32 @@ def Get_neighbors(port):
     print (dic['message'])
 
 
+def start_replicas(count, replica_port):
+    '''
+    Fork the read replicas of this wallet, they serve the reads on replica_port
+    The primary serves everything on its port and stays the only writer
+    :param count: <int> the number of replicas, None for the number of CPUs
+    :param replica_port: <int> the port shared by the replicas
+    :return: <ReplicaPool>
+    '''
+    pool = ReplicaPool(app, count, '127.0.0.1', replica_port)
+    my_wallet.store_chain(force=True)   # the replicas load the state stored
+    with my_wallet.blockchain.lock:
+        my_wallet.blockchain.signal = pool.signal
+        pool.signal.begin()
+        pool.signal.end(len(my_wallet.blockchain.chain))
+    pool.start(setup_replica)
+    return pool
+
+
+def setup_replica(signal):
+    # run in a replica: the chain of the primary is opened read-only
+    global replica_signal
+    replica_signal = signal
+    my_wallet.blockchain = BlockChain(my_wallet.data_dir, read_only=True)
+    my_wallet.blockchain.follow(signal)
+
+
 def run_flask_app(port):
     os.environ['WERKZEUG_RUN_MAIN'] = 'true'    # disable Flask's output
     app.run(host='127.0.0.1', port=port)
@@ -332,7 +764,9 @@ def main():
         print ('\n')
         command = input('Input your operation command. Enter help or -h for help: ')
         if command == 'help' or command == '-h':
-            print ('mine / -m:\t\tMine a new block for this wallet.')
+            print ('mine / -m:\t\tMine new blocks for this wallet in the background.')
+            print ('jobs / -j:\t\tGet the status of the mining jobs.')
+            print ('cancel / -x:\t\tCancel a mining job.')
             print ('transaction / -t:\tTransfer coins to another address.')
             print ('balance / -b:\t\tGet the balance of this wallet.')
             print ('chain / -c:\t\tGet the full chain of this wallet.')
@@ -343,7 +777,21 @@ def main():
             continue
         
         if command == 'mine' or command == '-m':
-            Mine(port)
+            blocks = input('Input the number of blocks, 0 to keep mining. Press ENTER for 1: ')
+            try:
+                Mine(port, int(blocks) if blocks != '' else 1)
+            except ValueError:
+                print ('Error: wrong number of blocks!')
+            continue
+
+        if command == 'jobs' or command == '-j':
+            job_id = input('Input the job id. Press ENTER for all the jobs: ')
+            Mining_status(port, job_id or None)
+            continue
+
+        if command == 'cancel' or command == '-x':
+            job_id = input('Input the job id: ')
+            Cancel_mining(port, job_id)
             continue
         
         if command == 'transaction' or command == '-t':
@@ -392,8 +840,23 @@ if __name__ == '__main__':
     # input the port from the begining
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=10000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of mining processes')
+    parser.add_argument('-b', '--block-size', default=MAX_BLOCK_TRANSACTIONS, type=int, help='the most pooled transactions in a block')
+    parser.add_argument('-s', '--sync-interval', default=SYNC_INTERVAL, type=float, help='seconds between two rounds of background sync, 0 to disable')
+    parser.add_argument('-a', '--advertise', default=None, help='the address the peers fetch announced blocks from, default is 127.0.0.1:port. Eg. 192.168.0.5:5000')
+    parser.add_argument('-r', '--replicas', default=0, type=int, help='number of read replica processes, 0 to disable, -1 for one per CPU')
+    parser.add_argument('--replica-port', default=None, type=int, help='port the read replicas listen on, default is port + 1')
     args = parser.parse_args()
     port = args.port    # get the port
+    my_wallet.blockchain.miner = ParallelMiner(args.workers)
+    MAX_BLOCK_TRANSACTIONS = args.block_size
+    mining_jobs.block_size = args.block_size
+    my_wallet.node_address = args.advertise or '127.0.0.1:%d'%port     # where the server listens
+    if args.replicas != 0:
+        # forked before any thread is started
+        start_replicas(args.replicas if args.replicas > 0 else None, args.replica_port or port + 1)
+    if args.sync_interval > 0:
+        my_wallet.start_sync(args.sync_interval)
 
     print ('\n')
     threads = []
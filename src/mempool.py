@@ -0,0 +1,154 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the pool of signed transactions waiting to be mined.
+
+from collections import OrderedDict
+
+from utils import *
+
+
+class Mempool(object):
+    '''
+    Signed transactions checked against the unspent outputs
+    An output can be spent by one transaction in the pool only
+    '''
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.transactions = OrderedDict()   # hash -> transaction, in the order of arrival
+        self.fees = {}                      # hash -> fee of the transaction
+        self.spent = {}                     # (hash, index) -> hash of the transaction spending it
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, trans_hash):
+        return trans_hash in self.transactions
+
+    def check(self, trans, utxo, verifier):
+        '''
+        Check a transaction against the unspent outputs and the pool
+        :param trans: <dict> the transaction
+        :param utxo: <UTXOSet> the unspent outputs of the chain
+        :param verifier: <SignatureVerifier> to verify the signatures
+        :return: <str> the reason if it's invalid, None if it's valid
+        '''
+        # the transactions come from the peers, check the shape first
+        if not isinstance(trans, dict) or not isinstance(trans.get('in'), list) or not isinstance(trans.get('out'), list):
+            return 'Malformed transaction'
+        if trans.get('hash') != get_trans_hash(trans):
+            return 'Wrong transaction hash'
+        if trans['hash'] in self.transactions:
+            return 'Transaction already in the pool'
+        if len(trans['in']) == 0 or len(trans['out']) == 0:
+            return 'No input or output'
+
+        coins = 0.0
+        keys = set()
+        signatures = []
+        for trans_in in trans['in']:
+            if not isinstance(trans_in, dict) or not isinstance(trans_in.get('prev_out'), dict):
+                return 'Malformed input'
+            prev_out = trans_in['prev_out']
+            if trans_in.get('sig') == 'system' or 'index' not in prev_out:
+                return 'Input without an output to spend'
+            if not isinstance(trans_in.get('sig'), str) or not isinstance(trans_in.get('pub_key'), str) \
+                or not isinstance(prev_out.get('hash'), str) or not isinstance(prev_out['index'], int) \
+                or not isinstance(prev_out.get('n'), (int, float)):
+                return 'Malformed input'
+            key = (prev_out['hash'], prev_out['index'])
+            if key in keys or key in self.spent:
+                return 'Double spend'
+            keys.add(key)
+            output = utxo.outputs.get(key)
+            if output is None:
+                return 'Output not found or already spent'
+            if prev_out['n'] != output['value']:
+                return 'Wrong input amount'
+            try:
+                owner = get_wallet_address(verifier.get_key(trans_in['pub_key']))
+            except Exception:
+                return 'Wrong public key'
+            if owner != output['address']:
+                return 'Output not owned by the signer'
+            coins += output['value']
+            signatures.append((trans_in['pub_key'], get_sign_message(prev_out), trans_in['sig']))
+
+        amount = 0.0
+        for trans_out in trans['out']:
+            if not isinstance(trans_out, dict) or not isinstance(trans_out.get('address'), str):
+                return 'Malformed output'
+            if not isinstance(trans_out.get('value'), (int, float)) or trans_out['value'] < 0:
+                return 'Wrong output amount'
+            amount += trans_out['value']
+        if amount > coins:
+            return 'Balance not enough'
+
+        if verifier.verify(signatures) is not True:
+            return 'Wrong signature'
+        return None
+
+    def add(self, trans, utxo, verifier):
+        '''
+        Add a transaction if it's valid
+        :return: <str> the reason if it's rejected, None if it's added
+        '''
+        if len(self.transactions) >= self.max_size:
+            return 'Pool is full'
+        reason = self.check(trans, utxo, verifier)
+        if reason is not None:
+            return reason
+
+        fee = sum([trans_in['prev_out']['n'] for trans_in in trans['in']]) \
+            - sum([trans_out['value'] for trans_out in trans['out']])
+        self.transactions[trans['hash']] = trans
+        self.fees[trans['hash']] = fee
+        for trans_in in trans['in']:
+            self.spent[(trans_in['prev_out']['hash'], trans_in['prev_out']['index'])] = trans['hash']
+        return None
+
+    def remove(self, trans_hash):
+        trans = self.transactions.pop(trans_hash, None)
+        if trans is None:
+            return
+        del self.fees[trans_hash]
+        for trans_in in trans['in']:
+            self.spent.pop((trans_in['prev_out']['hash'], trans_in['prev_out']['index']), None)
+
+    def select(self, max_count, order='fee'):
+        '''
+        Choose the transactions of the next block
+        :param max_count: <int> the most transactions in a block
+        :param order: <str> 'fee' for the highest fee first, 'arrival' for the earliest first
+        :return: <list> the transactions
+        '''
+        hashes = list(self.transactions)    # in the order of arrival
+        if order == 'fee':
+            hashes.sort(key=lambda trans_hash: self.fees[trans_hash], reverse=True)   # stable
+        return [self.transactions[trans_hash] for trans_hash in hashes[:max_count]]
+
+    def update(self, utxo):
+        '''
+        Drop the transactions mined already or spending outputs no longer unspent
+        Call it after the chain is changed
+        :param utxo: <UTXOSet> the unspent outputs of the new chain
+        '''
+        for trans_hash in list(self.transactions):
+            for trans_in in self.transactions[trans_hash]['in']:
+                if (trans_in['prev_out']['hash'], trans_in['prev_out']['index']) not in utxo.outputs:
+                    self.remove(trans_hash)
+                    break
+
+    def restore(self, blocks, utxo, verifier):
+        '''
+        Put back the transactions of the blocks detached by a reorganization, the invalid ones are dropped
+        :param blocks: <list> the detached blocks
+        :param utxo: <UTXOSet> the unspent outputs of the new chain
+        :param verifier: <SignatureVerifier> to verify the signatures
+        :return: <int> the number of transactions put back
+        '''
+        count = 0
+        for block in blocks:
+            for trans in block.get('Transactions', []):
+                if self.add(trans, utxo, verifier) is None:
+                    count += 1
+        return count
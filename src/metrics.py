@@ -0,0 +1,276 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the counters, histograms and gauges exposed at /metrics.
+
+import math
+import re
+import threading
+from functools import wraps
+from time import perf_counter
+
+# the upper bounds of the histogram buckets in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# the upper bounds of the histogram buckets in bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    text = ','.join(['%s="%s"'%(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in pairs])
+    return '{' + text + '}'
+
+
+def parse_metrics(text):
+    '''
+    Read the text format back, to gather the metrics of other nodes
+    :param text: <str> rendered by Registry.render()
+    :return: <dict> name -> {((label, value), ...): value}, the labels sorted by name
+    '''
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if match is None:
+            continue    # a comment
+        name, labels, value = match.groups()
+        pairs = tuple(sorted((label, escaped.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\'))
+                             for label, escaped in LABEL_PATTERN.findall(labels or '')))
+        samples.setdefault(name, {})[pairs] = float(value)
+    return samples
+
+
+class Metric(object):
+    '''
+    A named metric, every combination of the label values has its own value
+    '''
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        '''
+        :param name: <str> the name of the metric. Eg. 'minibitcoin_sync_seconds'
+        :param documentation: <str> the help text
+        :param labelnames: <tuple> the names of the labels
+        :param registry: <Registry> where the metric is exposed, default is REGISTRY
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}    # label values -> value
+        self.lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} needs the labels {self.labelnames}')
+        return tuple([labels[name] for name in self.labelnames])
+
+    def render(self):
+        # the lines of the text format
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}')
+        return lines
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class Counter(Metric):
+    '''
+    A value that only goes up
+    '''
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    A value that goes up and down, or is read from a function when collected
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        '''
+        Read the value when collected
+        :param function: <function> returns the value, or {label values: value} if there are labels
+        '''
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        try:
+            value = self.function()
+        except Exception:
+            return {}   # nothing to report
+        if value is None:
+            return {}
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+
+class Histogram(Metric):
+    '''
+    Count the observed values in buckets, with their sum
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = [0] * len(self.buckets) + [0.0]    # the bucket counts and the sum
+                self.values[key] = counts
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def time(self, **labels):
+        '''
+        Observe the seconds of a block of code
+        Usage: with histogram.time(): ...
+        '''
+        return Timer(self, labels)
+
+    def timed(self, func):
+        '''
+        Observe the seconds of every call of a function
+        Usage: @histogram.timed
+        '''
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(self, {}):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def collect(self):
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, counts in sorted(self.collect().items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count  # the buckets are cumulative
+                labels = format_labels(self.labelnames, key, ('le', format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {total}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry(object):
+    '''
+    The metrics exposed together
+    '''
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        '''
+        :return: <str> all the metrics in the Prometheus text format
+        '''
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# the metrics of the hot paths
+VALIDATION_SECONDS = Histogram('minibitcoin_validation_seconds', 'Seconds spent validating chains')
+VALIDATED_BLOCKS = Counter('minibitcoin_validated_blocks_total', 'Blocks accepted by the validators')
+INVALID_CHAINS = Counter('minibitcoin_invalid_chains_total', 'Chains rejected by the validators')
+INVALID_BLOCKS = Counter('minibitcoin_invalid_blocks_total', 'Blocks whose spends are rejected while connecting')
+SIGNATURES_VERIFIED = Counter('minibitcoin_signatures_verified_total', 'Signatures verified, the cached ones are not counted')
+SYNC_SECONDS = Histogram('minibitcoin_sync_seconds', 'Seconds of a round of consensus with the peers')
+CHAIN_REPLACEMENTS = Counter('minibitcoin_chain_replacements_total', 'Times our chain was replaced by a peer chain')
+REORG_DEPTH = Histogram('minibitcoin_reorg_depth_blocks', 'Blocks detached by a switch of the main chain',
+                        buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+SYNC_PEER_REPLIES = Gauge('minibitcoin_sync_peer_replies', 'Peers replying in the last round of consensus')
+PEER_REQUESTS = Counter('minibitcoin_peer_requests_total', 'Requests sent to the peers', ['result'])
+PEER_REQUEST_SECONDS = Histogram('minibitcoin_peer_request_seconds', 'Seconds until a peer replied')
+PROOF_OF_WORK_SECONDS = Histogram('minibitcoin_proof_of_work_seconds', 'Seconds of a proof of work search')
+MINED_BLOCKS = Counter('minibitcoin_mined_blocks_total', 'Blocks mined by this node')
+STORE_SECONDS = Histogram('minibitcoin_store_seconds', 'Seconds of committing the chain to disk')
+MERKLE_SECONDS = Histogram('minibitcoin_merkle_build_seconds', 'Seconds of building a Merkle tree from its leaves', ['kind'])
+CHAIN_PAYLOAD_BYTES = Histogram('minibitcoin_chain_payload_bytes', 'Bytes of the chains sent and received',
+                                ['direction'], buckets=SIZE_BUCKETS)
+GOSSIP_MESSAGES = Counter('minibitcoin_gossip_messages_total', 'Announcements received from the peers', ['kind', 'result'])
+GOSSIP_RELAYED = Counter('minibitcoin_gossip_relayed_total', 'Announcements sent to the peers', ['kind'])
+HTTP_REQUESTS = Counter('minibitcoin_http_requests_total', 'HTTP requests served', ['route', 'method', 'status'])
+HTTP_REQUEST_SECONDS = Histogram('minibitcoin_http_request_seconds', 'Seconds until the response of a route', ['route'])
+HTTP_BYTES = Counter('minibitcoin_http_bytes_total', 'Bytes of the request bodies received and the responses sent, '
+                     'the streamed chains are counted by minibitcoin_chain_payload_bytes', ['route', 'direction'])
+
+# the gauges read from the node when collected
+CHAIN_HEIGHT = Gauge('minibitcoin_chain_height', 'Height of the last block of our chain')
+HASH_RATE = Gauge('minibitcoin_hash_rate', 'Hashes per second of the last proof of work search')
+PEER_LATENCY = Gauge('minibitcoin_peer_latency_seconds', 'Moving average of the latency of a peer', ['peer'])
+MEMPOOL_SIZE = Gauge('minibitcoin_mempool_transactions', 'Transactions waiting to be mined')
+MINING_JOBS = Gauge('minibitcoin_mining_jobs', 'Mining jobs kept by this node', ['state'])
+CHAIN_STALENESS = Gauge('minibitcoin_chain_staleness_seconds', 'Seconds since the last sync with the peers')
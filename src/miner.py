@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the proof of work engines used by the blockchain.
+
+import hashlib
+import multiprocessing
+import os
+import threading
+from abc import ABC, abstractmethod
+from time import time
+
+DIFFICULTY = 4      # the number of leading zeroes in the hex digest
+BATCH = 20000       # the nonces tried between two checks of the stop flag
+
+
+def get_target(difficulty=DIFFICULTY):
+    '''
+    Get the byte-level target of the proof of work
+    A digest is valid iff it is smaller than the target,
+    which is the same as having `difficulty` leading zeroes in its hex digest
+    :param difficulty: <int> the number of leading zeroes
+    :return: <bytes> 32-byte big-endian target
+    '''
+    return (16 ** (64 - difficulty)).to_bytes(32, 'big')
+
+
+def search(rand, start, step, target, stop, counters=None, worker=0):
+    '''
+    Search the nonces start, start+step, start+2*step, ... until a proof is found or stopped
+    The SHA-256 state of the prefix is computed once and copied for every nonce
+    :param rand: <int> the random number of this round
+    :param start: <int> the first nonce
+    :param step: <int> the distance between two nonces
+    :param target: <bytes> the target from get_target()
+    :param stop: <Event> stop the search when it's set
+    :param counters: <Array> the number of hashes done by every worker
+    :param worker: <int> the index of this worker in counters
+    :return: <tuple> (proof or None, number of hashes, seconds)
+    '''
+    prefix = hashlib.sha256(str(rand).encode())     # the midstate
+    proof = start
+    hashes = 0
+    start_time = time()
+    while not stop.is_set():
+        for _ in range(BATCH):
+            sha = prefix.copy()
+            sha.update(str(proof).encode())
+            if sha.digest() < target:
+                stop.set()  # tell the others
+                hashes += _ + 1
+                if counters is not None:
+                    counters[worker] = hashes
+                return proof, hashes, time() - start_time
+            proof += step
+        hashes += BATCH
+        if counters is not None:
+            counters[worker] = hashes
+    return None, hashes, time() - start_time
+
+
+# the shared objects of the processes in the pool, set by the initializer
+_stop = None
+_counters = None
+
+def _init_worker(stop, counters):
+    global _stop, _counters
+    _stop = stop
+    _counters = counters
+
+
+def _search_worker(rand, start, step, target):
+    return search(rand, start, step, target, _stop, _counters, start)
+
+
+class Miner(ABC):
+    '''
+    The interface of proof of work engines
+    '''
+    def __init__(self, difficulty=DIFFICULTY):
+        self.difficulty = difficulty
+        self.target = get_target(difficulty)
+        self.lock = threading.Lock()    # one round at a time
+        self.stats = []                 # hash rate of every worker in the last round
+
+    @abstractmethod
+    def mine(self, rand):
+        '''
+        Find a proof such that hash(rand, proof) is smaller than the target
+        :param rand: <int> the random number of this round
+        :return: <int> the proof, None if cancelled
+        '''
+
+    @abstractmethod
+    def cancel(self):
+        # stop the running round, nothing happens if there is none
+        pass
+
+    def get_stats(self):
+        '''
+        Get the hash rate of every worker
+        :return: <list> [{'worker', 'hashes', 'seconds', 'hash_rate'}]
+        '''
+        return list(self.stats)
+
+    @staticmethod
+    def make_stats(worker, hashes, seconds):
+        return {
+            'worker': worker,
+            'hashes': hashes,
+            'seconds': seconds,
+            'hash_rate': hashes / seconds if seconds > 0 else 0.0,
+        }
+
+
+class SerialMiner(Miner):
+    '''
+    Search the nonces in the calling thread
+    '''
+    def __init__(self, difficulty=DIFFICULTY):
+        super().__init__(difficulty)
+        self.stop = threading.Event()
+
+    def mine(self, rand):
+        with self.lock:
+            self.stop.clear()
+            proof, hashes, seconds = search(rand, 0, 1, self.target, self.stop)
+            self.stats = [self.make_stats(0, hashes, seconds)]
+            return proof
+
+    def cancel(self):
+        self.stop.set()
+
+
+class ParallelMiner(Miner):
+    '''
+    Partition the nonce space across a pool of processes
+    Worker i searches the nonces i, i+n, i+2n, ...
+    '''
+    def __init__(self, workers=None, difficulty=DIFFICULTY):
+        super().__init__(difficulty)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None    # created when mining for the first time
+        self.context = multiprocessing.get_context('fork') \
+            if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+        self.stop = self.context.Event()
+        self.counters = self.context.Array('d', self.workers, lock=False)
+        self.start_time = None
+
+    def mine(self, rand):
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.context.Pool(self.workers, initializer=_init_worker,
+                                              initargs=(self.stop, self.counters))
+            self.stop.clear()
+            for worker in range(self.workers):
+                self.counters[worker] = 0
+            self.start_time = time()
+
+            results = [self.pool.apply_async(_search_worker, (rand, worker, self.workers, self.target))
+                       for worker in range(self.workers)]
+            proof = None
+            stats = []
+            for worker, result in enumerate(results):
+                res, hashes, seconds = result.get()
+                if res is not None and proof is None:
+                    proof = res
+                stats.append(self.make_stats(worker, hashes, seconds))
+            self.stats = stats
+            self.start_time = None
+            return proof
+
+    def cancel(self):
+        self.stop.set()
+
+    def get_stats(self):
+        if self.start_time is None:
+            return list(self.stats)
+        # the round is running, read the live counters
+        seconds = time() - self.start_time
+        return [self.make_stats(worker, self.counters[worker], seconds) for worker in range(self.workers)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+if __name__ == '__main__':
+    miner = ParallelMiner()
+    print (miner.mine(12345))
+    print (miner.get_stats())
+    miner.close()
@@ -0,0 +1,170 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the mining jobs, which run apart from the threads serving the requests.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from uuid import uuid4
+
+from metrics import *
+
+MAX_FINISHED_JOBS = 100     # the finished jobs kept for their status
+
+
+class MiningJob(object):
+    '''
+    Mine a number of blocks, or keep mining until cancelled
+    '''
+    def __init__(self, blocks=1, fresh=False):
+        '''
+        :param blocks: <int> the number of blocks to mine, 0 to keep mining until cancelled
+        :param fresh: <bool> update from the peers before every block
+        '''
+        self.id = uuid4().hex
+        self.blocks = blocks
+        self.fresh = fresh
+        self.state = 'queued'   # queued -> running -> done / cancelled / failed
+        self.mined = []         # {'index', 'hash', 'amount', 'transactions'} of the mined blocks
+        self.stale = 0          # the rounds dropped because a peer chain was adopted
+        self.error = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.hash_rate = []     # the hash rate of every worker in the last round
+        self.stop = threading.Event()   # set when cancelled
+        self.done = threading.Event()   # set when finished
+
+    def is_finished(self):
+        return self.state in ('done', 'cancelled', 'failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'blocks': self.blocks,
+            'mined': list(self.mined),
+            'stale': self.stale,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'hash_rate': self.hash_rate,
+        }
+
+
+class MiningJobs(object):
+    '''
+    The mining jobs of a wallet, run one by one on a thread of their own
+    '''
+    def __init__(self, wallet, block_size):
+        '''
+        :param wallet: <Wallet> the wallet receiving the rewards
+        :param block_size: <int> the most pooled transactions in a block
+        '''
+        self.wallet = wallet
+        self.block_size = block_size
+        self.jobs = OrderedDict()   # id -> MiningJob, in the order of submission
+        self.current = None         # the running job
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)   # the rounds never run on the server threads
+
+    def submit(self, blocks=1, fresh=False):
+        '''
+        Queue a job
+        :return: <MiningJob>
+        '''
+        job = MiningJob(blocks, fresh)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget()
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        '''
+        :return: <MiningJob> None if there is no such job
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None and job.state == 'running':
+            job.hash_rate = self.wallet.blockchain.get_mining_stats()   # the live counters
+        return job
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        '''
+        Stop a job, the round being searched is dropped
+        :return: <MiningJob> None if there is no such job
+        '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_finished():
+                return job
+            job.stop.set()
+            if self.current is job:
+                self.wallet.blockchain.cancel_mining()
+        return job
+
+    def forget(self):
+        # drop the oldest finished jobs, the lock is held
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def run(self, job):
+        with self.lock:
+            if job.stop.is_set():
+                self.finish(job, 'cancelled')
+                return
+            self.current = job
+            job.state = 'running'
+            job.started = time()
+        try:
+            while job.blocks == 0 or len(job.mined) < job.blocks:
+                if job.stop.is_set():
+                    break
+                if job.fresh is True:
+                    self.wallet.sync()
+                block = self.wallet.mine_block(self.block_size)
+                job.hash_rate = self.wallet.blockchain.get_mining_stats()
+                if block is None:
+                    if job.stop.is_set():
+                        break
+                    job.stale += 1  # a longer chain from peers has been adopted, mine on it
+                    continue
+                job.mined.append({
+                    'index': block['index'],
+                    'hash': self.wallet.blockchain.hash(block),
+                    'amount': str(block['Transaction']['out'][0]['value']),
+                    'transactions': len(block['Transactions']),
+                })
+        except Exception as e:
+            job.error = str(e)
+            with self.lock:
+                self.finish(job, 'failed')
+            return
+        with self.lock:
+            self.finish(job, 'done' if job.blocks > 0 and len(job.mined) >= job.blocks else 'cancelled')
+
+    def finish(self, job, state):
+        # the lock is held
+        job.state = state
+        job.finished = time()
+        if self.current is job:
+            self.current = None
+        job.done.set()
+
+    def get_stats(self):
+        '''
+        :return: <dict> the number of jobs in every state
+        '''
+        stats = {}
+        with self.lock:
+            for job in self.jobs.values():
+                stats[job.state] = stats.get(job.state, 0) + 1
+        return stats
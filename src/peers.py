@@ -0,0 +1,241 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the HTTP client used to talk with the peers.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import time
+
+import requests
+
+from metrics import *
+
+INVENTORY_SIZE = 50000  # the recent hashes remembered by the gossip
+
+
+class PeerClient(object):
+    '''
+    Every peer has its own keep-alive session, latency and failure record
+    A peer failing again and again is skipped for a growing period
+    '''
+    def __init__(self, timeout=3.0, download_timeout=30.0, max_workers=16, backoff=2.0, max_backoff=300.0):
+        '''
+        :param timeout: <float> seconds to wait for a small response
+        :param download_timeout: <float> seconds to wait for a response with blocks
+        :param max_workers: <int> the most peers queried at the same time
+        :param backoff: <float> seconds to skip a peer after its first failure, doubled after each failure
+        :param max_backoff: <float> the longest period to skip a peer
+        '''
+        self.timeout = timeout
+        self.download_timeout = download_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sessions = {}      # node -> requests.Session
+        self.stats = {}         # node -> {'latency', 'failures', 'retry_at'}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def get_session(self, node):
+        with self.lock:
+            if node not in self.sessions:
+                self.sessions[node] = requests.Session()
+                self.stats[node] = {'latency': None, 'failures': 0, 'retry_at': 0.0}
+            return self.sessions[node]
+
+    def is_healthy(self, node):
+        # whether the peer is not being skipped
+        with self.lock:
+            stats = self.stats.get(node)
+            return stats is None or time() >= stats['retry_at']
+
+    def record(self, node, latency=None):
+        '''
+        Record the result of a request
+        :param node: <str> the peer
+        :param latency: <float> seconds of the request, None if it failed
+        '''
+        if latency is None:
+            PEER_REQUESTS.inc(result='failed')
+        else:
+            PEER_REQUESTS.inc(result='ok')
+            PEER_REQUEST_SECONDS.observe(latency)
+        with self.lock:
+            stats = self.stats[node]
+            if latency is None:
+                stats['failures'] += 1
+                stats['retry_at'] = time() + min(self.max_backoff, self.backoff * 2 ** (stats['failures'] - 1))
+            else:
+                stats['failures'] = 0
+                stats['retry_at'] = 0.0
+                if stats['latency'] is None:
+                    stats['latency'] = latency
+                else:
+                    # moving average
+                    stats['latency'] = 0.8 * stats['latency'] + 0.2 * latency
+
+    def request(self, node, path, method='GET', params=None, json=None, timeout=None, stream=False):
+        '''
+        Send a request to a peer through its session
+        :param node: <str> the peer. Eg. '192.168.0.5:5000'
+        :param path: <str> the path. Eg. '/chain/tip'
+        :param timeout: <float> seconds to wait, default is self.timeout
+        :return: <requests.Response> None if the peer does not reply
+        '''
+        session = self.get_session(node)
+        start = time()
+        try:
+            response = session.request(method, f'http://{node}{path}', params=params, json=json,
+                                       timeout=timeout or self.timeout, stream=stream)
+        except requests.RequestException:
+            self.record(node)
+            return None
+        self.record(node, time() - start)
+        return response
+
+    def get_json(self, node, path, params=None, timeout=None):
+        '''
+        :return: <dict> the JSON body of the response, None if it's not 200
+        '''
+        response = self.request(node, path, params=params, timeout=timeout)
+        if response is None or response.status_code != 200:
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    def fan_out(self, nodes, path, params=None, timeout=None, quorum=None):
+        '''
+        Query the healthy peers in parallel
+        Return as soon as quorum peers replied, or when the timeout is reached
+        :param nodes: <list> the peers
+        :param path: <str> the path
+        :param timeout: <float> the deadline of all the peers, default is self.timeout
+        :param quorum: <int> the number of replies to wait for, None to wait for all
+        :return: <dict> node -> the JSON body
+        '''
+        timeout = timeout or self.timeout
+        futures = {}
+        for node in nodes:
+            if self.is_healthy(node):
+                futures[self.executor.submit(self.get_json, node, path, params, timeout)] = node
+
+        replies = {}
+        deadline = time() + timeout
+        pending = set(futures)
+        while len(pending) > 0 and (quorum is None or len(replies) < quorum):
+            remain = deadline - time()
+            if remain <= 0:
+                break
+            done, pending = wait(pending, timeout=remain, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result() is not None:
+                    replies[futures[future]] = future.result()
+        return replies
+
+    def broadcast(self, nodes, path, json):
+        '''
+        Post to the healthy peers in the background, the replies are not waited for
+        :param nodes: <list> the peers
+        :param path: <str> the path. Eg. '/blocks/announce'
+        :param json: <dict> the body
+        :return: <int> the number of peers posted to
+        '''
+        count = 0
+        for node in nodes:
+            if self.is_healthy(node):
+                self.executor.submit(self.request, node, path, 'POST', None, json)
+                count += 1
+        return count
+
+    def get_stats(self):
+        '''
+        :return: <dict> node -> {'latency', 'failures', 'healthy'}
+        '''
+        with self.lock:
+            now = time()
+            return {node: {'latency': stats['latency'], 'failures': stats['failures'],
+                           'healthy': now >= stats['retry_at']}
+                    for node, stats in self.stats.items()}
+
+
+class Inventory(object):
+    '''
+    The hashes of the blocks and transactions seen recently, so nothing is fetched or relayed twice
+    The oldest ones are forgotten first
+    A hash is remembered once its item is accepted, the ones being fetched are claimed apart,
+    so a failed fetch does not hide the item from the next announcement
+    '''
+    def __init__(self, max_size=INVENTORY_SIZE):
+        self.max_size = max_size
+        self.hashes = OrderedDict()     # hash -> None, the oldest first
+        self.pending = set()            # the hashes being fetched
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, item_hash):
+        with self.lock:
+            return item_hash in self.hashes
+
+    def add(self, item_hash):
+        '''
+        Remember a hash
+        :param item_hash: <str> the hash of a block or a transaction
+        :return: <bool> True if it's new, False if it's seen already
+        '''
+        with self.lock:
+            if item_hash in self.hashes:
+                return False
+            self.hashes[item_hash] = None
+            if len(self.hashes) > self.max_size:
+                self.hashes.popitem(last=False)
+            return True
+
+    def claim(self, item_hash):
+        '''
+        Start fetching an announced item, release() it when done
+        :param item_hash: <str> the hash of a block or a transaction
+        :return: <bool> True if it's neither seen nor being fetched
+        '''
+        with self.lock:
+            if item_hash in self.hashes or item_hash in self.pending:
+                return False
+            self.pending.add(item_hash)
+            return True
+
+    def release(self, item_hash):
+        # the fetch is over, the hash is remembered only if the item was accepted by add()
+        with self.lock:
+            self.pending.discard(item_hash)
+
+
+def find_common_ancestor(client, node, length, local_length, get_hash):
+    '''
+    Find the last block shared with a peer by comparing the block hashes in its headers
+    The window of headers doubles every round, so a long fork costs O(log n) requests
+    :param client: <PeerClient> to query the peer
+    :param node: <str> the peer
+    :param length: <int> the length of the peer's chain
+    :param local_length: <int> the length of our chain
+    :param get_hash: <function> height -> the hash of our block at height
+    :return: <int> the height of the common ancestor, -1 if there is none, None if the peer fails or answers malformed headers
+    '''
+    top = min(local_length, length) - 1
+    step = 1
+    while top >= 0:
+        start = max(0, top - step + 1)
+        res = client.get_json(node, '/chain/headers', params={'from': start, 'limit': top - start + 1})
+        if not isinstance(res, dict) or not isinstance(res.get('headers'), list):
+            return None
+        for header in reversed(res['headers']):
+            if not isinstance(header, dict) or type(header.get('index')) is not int \
+                or not start <= header['index'] <= top:
+                return None     # only the requested heights are compared
+            if header.get('hash') == get_hash(header['index']):
+                return header['index']
+        top = start - 1
+        step *= 2
+    return -1
@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the read replicas, processes serving the reads of the chain stored by the primary.
+
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+
+class TipSignal(object):
+    '''
+    The tip of the primary in shared memory, written like a sequence lock:
+    the sequence is odd while the store is being written, and changes on every write
+    '''
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context('fork')
+        self.sequence = context.RawValue('q', 0)
+        self.length = context.RawValue('q', 0)  # the number of blocks published
+
+    def begin(self):
+        # a write starts, the replicas keep their last snapshot
+        self.sequence.value += 1
+
+    def end(self, length):
+        # a write is done, the store has length blocks
+        self.length.value = length
+        self.sequence.value += 1
+
+    def read(self):
+        '''
+        :return: <tuple> (sequence, length), the length is only good if the sequence is even and unchanged after
+        '''
+        return self.sequence.value, self.length.value
+
+
+class ReplicaPool(object):
+    '''
+    Worker processes accepting the requests on one shared socket
+    Every worker opens the chain stored by the primary read-only and follows the TipSignal,
+    the primary stays the only writer
+    '''
+    def __init__(self, app, count=None, host='127.0.0.1', port=10001):
+        '''
+        :param app: <Flask> the application served by the workers
+        :param count: <int> the number of workers, None for the number of CPUs
+        :param host: <str> the host to listen on
+        :param port: <int> the port to listen on, apart from the primary
+        '''
+        self.app = app
+        self.count = count or os.cpu_count() or 1
+        self.host = host
+        self.port = port
+        self.context = multiprocessing.get_context('fork')  # the workers start from the loaded application
+        self.signal = TipSignal(self.context)
+        self.socket = None
+        self.processes = []
+
+    def start(self, setup):
+        '''
+        Fork the workers, before the primary starts any thread
+        :param setup: <function> setup(signal) runs in every worker before it serves
+        '''
+        self.socket = socket.create_server((self.host, self.port), backlog=128)
+        for _ in range(self.count):
+            process = self.context.Process(target=self.serve, args=(setup, ), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def serve(self, setup):
+        # the loop of a worker, the kernel hands every connection to one of them
+        primary = os.getppid()
+        setup(self.signal)
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+        threading.Thread(target=self.watch, args=(server, primary), daemon=True).start()
+        server.serve_forever()
+
+    @staticmethod
+    def watch(server, primary, interval=1.0):
+        # stop serving when the primary is gone, the chain would never change again
+        while os.getppid() == primary:
+            time.sleep(interval)
+        server.shutdown()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
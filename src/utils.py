@@ -4,12 +4,242 @@
 
 import random
 import hashlib
+import json
 import base58
+import zlib
 from time import time
 
+CHUNK_SIZE = 64 * 1024  # the bytes buffered before a piece of a compressed stream is sent
+
+
+class TrackedDict(dict):
+    '''
+    A dict in a block, it tells the block to drop its caches when it's changed
+    '''
+    def __init__(self, data=(), owner=None):
+        dict.__init__(self)
+        self._owner = owner     # the block containing this dict
+        for key, value in dict(data).items():
+            dict.__setitem__(self, key, track(value, owner))
+
+    def changed(self):
+        if self._owner is not None:
+            self._owner.invalidate()
+
+    def adopt(self, owner):
+        # move into a block
+        self._owner = owner
+        for value in self.values():
+            if isinstance(value, (TrackedDict, TrackedList)):
+                value.adopt(owner)
+
+    def __setitem__(self, key, value):
+        self.changed()
+        dict.__setitem__(self, key, track(value, self._owner))
+
+    def __delitem__(self, key):
+        self.changed()
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, *args):
+        self.changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.changed()
+        return dict.popitem(self)
+
+    def clear(self):
+        self.changed()
+        dict.clear(self)
+
+    def __reduce__(self):
+        # stored as a plain dict
+        return (dict, (get_plain(self),))
+
+
+class TrackedList(list):
+    '''
+    A list in a block, it tells the block to drop its caches when it's changed
+    '''
+    def __init__(self, data=(), owner=None):
+        list.__init__(self, [track(value, owner) for value in data])
+        self._owner = owner     # the block containing this list
+
+    changed = TrackedDict.changed
+
+    def adopt(self, owner):
+        self._owner = owner
+        for value in self:
+            if isinstance(value, (TrackedDict, TrackedList)):
+                value.adopt(owner)
+
+    def __setitem__(self, index, value):
+        self.changed()
+        if isinstance(index, slice):
+            value = [track(item, self._owner) for item in value]
+        else:
+            value = track(value, self._owner)
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self.changed()
+        list.__delitem__(self, index)
+
+    def append(self, value):
+        self.changed()
+        list.append(self, track(value, self._owner))
+
+    def extend(self, values):
+        self.changed()
+        list.extend(self, [track(value, self._owner) for value in values])
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, n):
+        self.changed()
+        return list.__imul__(self, n)
+
+    def insert(self, index, value):
+        self.changed()
+        list.insert(self, index, track(value, self._owner))
+
+    def pop(self, *args):
+        self.changed()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self.changed()
+        list.remove(self, value)
+
+    def clear(self):
+        self.changed()
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self.changed()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self.changed()
+        list.reverse(self)
+
+    def __reduce__(self):
+        return (list, (get_plain(self),))
+
+
+class Block(TrackedDict):
+    '''
+    A block caching its canonical encoding and hash
+    The caches are dropped when the block or anything in it is changed,
+    so a block is serialized and hashed once in its lifetime
+    '''
+    def __init__(self, data=(), encoding=None, block_hash=None):
+        '''
+        :param data: <dict> the content of the block
+        :param encoding: <bytes> the known canonical encoding of data
+        :param block_hash: <str> the known hash of data
+        '''
+        self._encoding = encoding
+        self._hash = block_hash
+        TrackedDict.__init__(self, data, self)
+
+    def invalidate(self):
+        self._encoding = None
+        self._hash = None
+
+    def get_encoding(self):
+        if self._encoding is None:
+            self._encoding = json.dumps(self, sort_keys=True).encode()
+        return self._encoding
+
+    def get_hash(self):
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.get_encoding()).hexdigest()
+        return self._hash
+
+    def __reduce__(self):
+        return (Block, (get_plain(self),))
+
+
+def track(value, owner):
+    '''
+    Make a value of a block able to tell the block when it's changed
+    :param value: the value to put into the block
+    :param owner: <Block> the block
+    '''
+    if isinstance(value, (TrackedDict, TrackedList)) and not isinstance(value, Block):
+        value.adopt(owner)
+        return value
+    if isinstance(value, dict):
+        return TrackedDict(value, owner)
+    if isinstance(value, list):
+        return TrackedList(value, owner)
+    return value
+
+
+def get_plain(value):
+    # a copy made of plain dicts and lists
+    if isinstance(value, dict):
+        return {key: get_plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [get_plain(item) for item in value]
+    return value
+
+
+def to_block(data, encoding=None, block_hash=None):
+    '''
+    Get a Block from a dict, e.g. one received from peers
+    :param data: <dict> the block
+    :param encoding: <bytes> the known canonical encoding of data
+    :param block_hash: <str> the known hash of data
+    :return: <Block>
+    '''
+    if isinstance(data, Block):
+        return data
+    return Block(data, encoding, block_hash)
+
+
+def encode_block(block):
+    '''
+    The canonical encoding of a block, which is hashed and stored
+    :param block: <dict> Block
+    :return: <bytes>
+    '''
+    if isinstance(block, Block):
+        return block.get_encoding()
+    return json.dumps(block, sort_keys=True).encode()
+
+
+def hash_block(block):
+    '''
+    The SHA-256 hash of a block, cached by Block
+    :param block: <dict> Block
+    :return: <str>
+    '''
+    if isinstance(block, Block):
+        return block.get_hash()
+    return hashlib.sha256(encode_block(block)).hexdigest()
+
+
 def get_empty_block():
     # Create an empty block
-    block = {}
+    block = Block()
     block['index'] = None   # the index of the block
 
     # the block header
@@ -20,33 +250,73 @@ def get_empty_block():
 
 
     # the transactions part
-    block['Transaction'] = {}
-    trans = block['Transaction']
+    block['Transaction'] = get_empty_trans()
+    return block
+
+
+def get_empty_trans():
+    # Create an empty transaction
+    trans = TrackedDict()
     trans['hash'] = None    # the transaction ID: hash of this transaction
     trans['in'] = []        # the inputs of the transaction
     trans['out'] = []       # the outputs of the transaction
-    return block
+    return trans
+
+
+def get_trans_hash(trans):
+    '''
+    Get the transaction ID
+    :param trans: <dict> the transaction
+    :return: <str> the hash of its inputs and outputs
+    '''
+    temp = {}
+    temp['in'] = trans['in']
+    temp['out'] = trans['out']
+    return hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
+
+
+def get_transactions(block):
+    '''
+    Get all the transactions of a block
+    'Transaction' is the first one, 'Transactions' are the ones packed from the pool
+    :param block: <dict> Block
+    :return: <list>
+    '''
+    return [block['Transaction']] + list(block.get('Transactions', []))
 
 
-def get_trans_in(pre_hash=None, n=None, sig=None, pub_key=None):
+def get_trans_in(pre_hash=None, n=None, sig=None, pub_key=None, index=None):
     '''
     Create an empty input of a transaction
     :param pre_hash: <str> the hash of the input transaction
     :param n: <float> the input amount
     :param sig: <str> the signature
     :param pub_key: the public key
+    :param index: <int> the index of the spent output in the input transaction
     :return res: <dict> an empty input of transaction
     '''
-    res = {}
+    res = TrackedDict()
     res['prev_out'] = {}
     res['prev_out']['hash'] = pre_hash  #
     res['prev_out']['n'] = n            #
+    if index is not None:
+        res['prev_out']['index'] = index
 
     res['sig'] = sig                    #
     res['pub_key'] = pub_key            #
     return res
 
 
+def get_sign_message(prev_out):
+    '''
+    Get the message signed by the owner of the spent output
+    :param prev_out: <dict> the 'prev_out' of an input
+    :return: <bytes>
+    '''
+    ha = hashlib.sha256(json.dumps(prev_out, sort_keys=True).encode()).hexdigest()
+    return ha.encode()
+
+
 def get_trans_out(value=None, address=None, from_address=None):
     '''
     Create an empty output of a transaction
@@ -55,7 +325,7 @@ def get_trans_out(value=None, address=None, from_address=None):
     :param from_address: <str> the address where the coins come from
     :return res: <dict> an empty output of a transaction
     '''
-    res = {}
+    res = TrackedDict()
     res['value'] = value
     res['address'] = address
     res['from_address'] = from_address
@@ -95,6 +365,27 @@ def get_wallet_address(pub_key):
     return address
 
 
+def gzip_chunks(chunks, level=6, buffer_size=CHUNK_SIZE):
+    '''
+    Compress a stream of chunks with gzip on the fly
+    Small chunks are buffered, so every compressed piece is worth sending
+    :param chunks: <iterable> bytes
+    :return: <generator> the compressed bytes
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)     # 31: with the gzip header
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            data = compressor.compress(b''.join(buffer))
+            buffer = []
+            size = 0
+            if data:
+                yield data
+    yield compressor.compress(b''.join(buffer)) + compressor.flush()
+
 
 if __name__ == '__main__':
     pass
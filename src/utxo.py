@@ -0,0 +1,336 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the index of unspent transaction outputs (UTXO).
+
+from utils import *
+
+BLOCK_REWARD = 5.0  # the coins created by mining a block, the fees of its transactions go to the miner too
+LEGACY_HEIGHT = 1000    # the highest block created by older versions, which is connected with their balance rules
+
+
+def get_legacy_key(address):
+    '''
+    The key of the output holding the balance of an address in the blocks created by older versions
+    It's spent as the other outputs are
+    :param address: <str> the wallet address
+    :return: <tuple> (hash, index)
+    '''
+    return ('legacy:' + address, 0)
+
+
+def get_legacy_changes(trans):
+    '''
+    The balance changes made by a transaction of older versions, as their /balance counted them:
+    a single output is a mining reward; otherwise the sender, from_address of the first output,
+    pays the outputs to the others if it has an output too, and the others get their outputs.
+    The inputs are not counted
+    :param trans: <dict> block['Transaction'] of a block created by older versions
+    :return: <dict> address -> the change of its balance
+    '''
+    changes = {}
+    lis = trans['out']
+    if len(lis) == 1:
+        changes[lis[0]['address']] = lis[0]['value']
+        return changes
+    sender = lis[0]['from_address'] if len(lis) > 0 else None
+    paid = sender in [dic['address'] for dic in lis]
+    for dic in lis:
+        if dic['address'] == sender:
+            continue
+        changes[dic['address']] = changes.get(dic['address'], 0.0) + dic['value']
+        if paid is True:
+            changes[sender] = changes.get(sender, 0.0) - dic['value']
+    return changes
+
+
+class UTXOSet(object):
+    '''
+    The unspent outputs of a chain, keyed by (transaction hash, output index)
+    Every connected block keeps an undo record, so the set can be rolled back
+    Only the records of the last max_undo blocks are kept, a deeper rollback connects the blocks again
+    '''
+    def __init__(self, max_undo=None):
+        '''
+        :param max_undo: <int> the most undo records kept, None to keep all
+        '''
+        self.outputs = {}       # (hash, index) -> {'value', 'address', 'height'}
+        self.addresses = {}     # address -> {(hash, index): value}, the unspent outputs of the address
+        self.balances = {}      # address -> the balance of the address
+        self.undo = []          # undo[i] is [(key, output before the block)] of the block at height base+i
+        self.hashes = []        # hashes[i] is the hash of the connected block at height base+i
+        self.base = 0           # the height of the oldest block with an undo record
+        self.max_undo = max_undo
+        self.legacy_height = -1 # the height of the last block created by older versions, see is_legacy()
+
+    def __setstate__(self, state):
+        # the sets pickled by older versions keep every record
+        state.setdefault('base', 0)
+        state.setdefault('max_undo', None)
+        state.setdefault('legacy_height', None)     # unknown, the set is connected again
+        self.__dict__.update(state)
+
+    @property
+    def height(self):
+        # the height of the last connected block
+        return self.base + len(self.hashes) - 1
+
+    @property
+    def tip_hash(self):
+        if len(self.hashes) == 0:
+            return None
+        return self.hashes[-1]
+
+    def get_hash(self, height):
+        '''
+        :param height: <int> the height of a connected block
+        :return: <str> its hash, None if its undo record is dropped
+        '''
+        if height < self.base or height > self.height:
+            return None
+        return self.hashes[height - self.base]
+
+    def get_balance(self, address):
+        '''
+        Get the balance of the address, costs O(1)
+        :param address: <str> the wallet address
+        :return: <float>
+        '''
+        return self.balances.get(address, 0.0)
+
+    def get_unspent(self, address):
+        '''
+        Get the unspent outputs of the address, the oldest first
+        :param address: <str> the wallet address
+        :return: <list> [((hash, index), value)]
+        '''
+        return list(self.addresses.get(address, {}).items())
+
+    def set_output(self, key, output, undo):
+        '''
+        Set the output of the key and keep every index consistent
+        :param key: <tuple> (hash, index)
+        :param output: <dict> the new output, None to delete it
+        :param undo: <list> the undo record of current block, None if not needed
+        '''
+        old = self.outputs.get(key)
+        if undo is not None:
+            undo.append((key, old))
+
+        if old is not None:
+            del self.outputs[key]
+            del self.addresses[old['address']][key]
+            if len(self.addresses[old['address']]) == 0:
+                del self.addresses[old['address']]
+            self.balances[old['address']] -= old['value']
+        if output is not None:
+            self.outputs[key] = output
+            self.addresses.setdefault(output['address'], {})[key] = output['value']
+            self.balances[output['address']] = self.balances.get(output['address'], 0.0) + output['value']
+
+    def find_input(self, trans_in):
+        '''
+        Find the output spent by an input
+        :param trans_in: <dict> the input of a transaction
+        :return: <tuple> the key of the output, None if it's not found or the input has no index
+        '''
+        prev_out = trans_in['prev_out']
+        if 'index' not in prev_out:
+            return None     # created by older versions
+        key = (prev_out['hash'], prev_out['index'])
+        if key in self.outputs:
+            return key
+        return None
+
+    def is_legacy(self, block, height):
+        '''
+        Whether a block is connected with the balance rules of older versions, see connect_legacy()
+        They are the blocks without pooled transactions at the start of a chain, no higher than LEGACY_HEIGHT
+        :param block: <dict> the block
+        :param height: <int> the height of the block
+        :return: <bool>
+        '''
+        return height <= LEGACY_HEIGHT and self.legacy_height == height - 1 \
+            and 'Transactions' not in block and 'hashTransRoot' not in block['Blockheader']
+
+    def connect_block(self, block, block_hash, get_owner=None):
+        '''
+        Spend the inputs and add the outputs of the block
+        The blocks created by older versions are connected by connect_legacy(), the other ones have no input without index
+        Only the reward, block['Transaction'], has inputs from mining, its outputs are at most BLOCK_REWARD and the fees
+        :param block: <dict> the next block of the chain
+        :param block_hash: <str> the hash of the block
+        :param get_owner: <function> get_owner(pub_key) is the address of the key, the spends are checked if it's given
+        :return: <str> the reason if a spend is invalid and nothing is connected, None if it's connected
+        '''
+        undo = []
+        height = self.height + 1
+        legacy = self.is_legacy(block, height)
+        if legacy is True:
+            reason = self.connect_legacy(block, height, undo)
+        else:
+            reason = self.connect_transactions(block, height, undo, get_owner)
+        if reason is not None:
+            self.revert(undo)
+            return reason
+        if legacy is True:
+            self.legacy_height = height
+
+        self.undo.append(undo)
+        self.hashes.append(block_hash)
+        if self.max_undo is not None and len(self.undo) > self.max_undo:
+            # too deep to be reorganized, see MAX_FORK_DEPTH
+            dropped = len(self.undo) - self.max_undo
+            del self.undo[:dropped]
+            del self.hashes[:dropped]
+            self.base += dropped
+
+    def connect_legacy(self, block, height, undo):
+        '''
+        Connect a block created by older versions, which only has block['Transaction']
+        Older versions counted a balance per address instead of the outputs, so does this one:
+        the balance of every address is kept in its legacy output, see get_legacy_key()
+        :param block: <dict> the block
+        :param height: <int> the height of the block
+        :param undo: <list> the undo record of the block
+        :return: <str> the reason if it's invalid, None if it's connected
+        '''
+        for trans_out in block['Transaction']['out']:
+            if not isinstance(trans_out['value'], (int, float)) or trans_out['value'] < 0:
+                return 'Wrong output amount'
+        for address, change in get_legacy_changes(block['Transaction']).items():
+            key = get_legacy_key(address)
+            value = change + self.outputs[key]['value'] if key in self.outputs else change
+            output = {'value': value, 'address': address, 'height': height} if value > 0 else None
+            self.set_output(key, output, undo)
+        return None
+
+    def connect_transactions(self, block, height, undo, get_owner):
+        '''
+        Connect the transactions of a block, the spends are checked if get_owner is given
+        :param block: <dict> the block
+        :param height: <int> the height of the block
+        :param undo: <list> the undo record of the block
+        :param get_owner: <function> get_owner(pub_key) is the address of the key, None to skip the checks
+        :return: <str> the reason if it's invalid, None if it's connected
+        '''
+        fees = 0.0      # the fees of the checked transactions
+        for trans in get_transactions(block):
+            reward = trans is block['Transaction']
+            coins = 0.0     # the amount of the checked inputs
+            for trans_in in trans['in']:
+                if trans_in['sig'] == 'system':     # from mining
+                    if reward is not True:
+                        return 'Input without an output to spend'
+                    continue
+                key = self.find_input(trans_in)
+                if get_owner is not None:
+                    reason = self.check_input(trans_in, key, get_owner)
+                    if reason is not None:
+                        return reason
+                    coins += self.outputs[key]['value']
+                if key is not None:
+                    self.set_output(key, None, undo)
+
+            if get_owner is not None:
+                # the reward is checked against the fees when they are all known
+                reason = self.check_outputs(trans, float('inf') if reward else coins)
+                if reason is not None:
+                    return reason
+                if reward is not True:
+                    fees += coins - sum([trans_out['value'] for trans_out in trans['out']])
+            for index, trans_out in enumerate(trans['out']):
+                if trans_out['value'] == 0.0:
+                    continue    # nothing to spend
+                key = (trans['hash'], index)
+                if key in self.outputs:
+                    return 'Transaction already in the chain'
+                output = {'value': trans_out['value'], 'address': trans_out['address'], 'height': height}
+                self.set_output(key, output, undo)
+
+        if get_owner is not None:
+            reason = self.check_reward(block['Transaction'], fees)
+            if reason is not None:
+                return reason
+        return None
+
+    def check_input(self, trans_in, key, get_owner):
+        '''
+        Check an input spends an unspent output of its signer, as Mempool.check() does
+        :param trans_in: <dict> the input of a transaction
+        :param key: <tuple> the output found by find_input()
+        :param get_owner: <function> get_owner(pub_key) is the address of the key
+        :return: <str> the reason if it's invalid, None if it's valid
+        '''
+        if 'index' not in trans_in['prev_out']:
+            return 'Input without an output to spend'
+        if key is None:
+            return 'Output not found or already spent'
+        output = self.outputs[key]
+        if trans_in['prev_out']['n'] != output['value']:
+            return 'Wrong input amount'
+        try:
+            owner = get_owner(trans_in['pub_key'])
+        except Exception:
+            return 'Wrong public key'
+        if owner != output['address']:
+            return 'Output not owned by the signer'
+        return None
+
+    @staticmethod
+    def check_outputs(trans, coins):
+        '''
+        Check the outputs of a transaction spend no more than its inputs
+        :param trans: <dict> the transaction
+        :param coins: <float> the amount of its inputs
+        :return: <str> the reason if it's invalid, None if it's valid
+        '''
+        amount = 0.0
+        for trans_out in trans['out']:
+            if not isinstance(trans_out['value'], (int, float)) or trans_out['value'] < 0:
+                return 'Wrong output amount'
+            amount += trans_out['value']
+        if amount > coins:
+            return 'Balance not enough'
+        return None
+
+    @staticmethod
+    def check_reward(trans, fees):
+        '''
+        Check the reward of a block creates no more than BLOCK_REWARD
+        :param trans: <dict> the reward, block['Transaction']
+        :param fees: <float> the fees of the other transactions of the block
+        :return: <str> the reason if it's invalid, None if it's valid
+        '''
+        for trans_in in trans['in']:
+            if trans_in['sig'] != 'system':
+                return 'Reward spending an output'
+        reason = UTXOSet.check_outputs(trans, BLOCK_REWARD + fees)
+        if reason == 'Balance not enough':
+            return 'Reward too high'
+        return reason
+
+    def revert(self, undo):
+        # restore the outputs changed by an undo record
+        for key, output in reversed(undo):
+            self.set_output(key, output, None)
+
+    def disconnect_block(self):
+        # undo the last connected block
+        undo = self.undo.pop()
+        self.hashes.pop()
+        self.revert(undo)
+        self.legacy_height = min(self.legacy_height, self.height)
+
+    def can_rollback(self, height):
+        # whether the undo records reach down to height
+        return height >= self.base - 1
+
+    def rollback(self, height):
+        '''
+        Disconnect the blocks until the last one is at height
+        :param height: <int> the height of the last block to keep, see can_rollback()
+        '''
+        if self.can_rollback(height) is not True:
+            raise ValueError('the undo records of the blocks after height %d are dropped'%height)
+        while self.height > height:
+            self.disconnect_block()
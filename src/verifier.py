@@ -0,0 +1,196 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file implements the batched and cached verification of ECDSA signatures.
+
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from ecdsa import VerifyingKey, SECP256k1, BadSignatureError
+
+from metrics import *
+
+
+def parse_key(pub_key):
+    '''
+    :param pub_key: <str> the hex string of a public key
+    :return: <VerifyingKey>
+    '''
+    return VerifyingKey.from_string(bytes(bytearray.fromhex(pub_key)), curve=SECP256k1)
+
+
+def verify_signature(vk, message, sig):
+    '''
+    :param vk: <VerifyingKey> the public key
+    :param message: <bytes> the signed message
+    :param sig: <str> the hex string of the signature
+    :return: <bool> False if it's not a valid signature of the message, whatever sig is
+    '''
+    if not isinstance(sig, str) or not isinstance(message, bytes):
+        return False    # from the peers
+    try:
+        return vk.verify(bytes(bytearray.fromhex(sig)), message) is True
+    except (BadSignatureError, ValueError, TypeError):
+        return False
+
+
+def is_signature(item):
+    '''
+    Whether an item to verify has the types verify_signature() expects, so it can be cached
+    :param item: <tuple> (pub_key, message, sig)
+    :return: <bool>
+    '''
+    return isinstance(item, tuple) and len(item) == 3 and isinstance(item[0], str) \
+        and isinstance(item[1], bytes) and isinstance(item[2], str)
+
+
+def get_cached_key(keys, pub_key, size):
+    '''
+    Parse a public key once, the parsed keys are kept in an LRU cache
+    :param keys: <OrderedDict> pub_key -> VerifyingKey, the cache
+    :param pub_key: <str> the hex string of a public key
+    :param size: <int> the most keys kept
+    :return: <VerifyingKey>
+    '''
+    vk = keys.get(pub_key)
+    if vk is None:
+        vk = parse_key(pub_key)
+        keys[pub_key] = vk
+        if len(keys) > size:
+            keys.popitem(last=False)
+    else:
+        keys.move_to_end(pub_key)
+    return vk
+
+
+# the parsed keys of a process in the pool, bounded as the keys of the verifier
+_keys = OrderedDict()
+_key_cache_size = None
+
+def _init_worker(key_cache_size):
+    global _key_cache_size
+    _key_cache_size = key_cache_size
+
+
+def _verify_batch(items):
+    res = []
+    for pub_key, message, sig in items:
+        if not isinstance(pub_key, str):
+            res.append(False)
+            continue
+        try:
+            vk = get_cached_key(_keys, pub_key, _key_cache_size)
+        except Exception:
+            res.append(False)
+            continue
+        res.append(verify_signature(vk, message, sig))
+    return res
+
+
+class SignatureVerifier(object):
+    '''
+    Verify the signatures of a chain in batches across a pool of processes
+    The verified signatures and the parsed keys are kept in LRU caches
+    '''
+    def __init__(self, workers=None, batch_size=64, cache_size=100000, key_cache_size=1024):
+        '''
+        :param workers: <int> the number of processes, 1 to verify in the calling thread
+        :param batch_size: <int> the signatures sent to a process at a time
+        :param cache_size: <int> the most verified signatures to remember
+        :param key_cache_size: <int> the most parsed keys to remember
+        '''
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.key_cache_size = key_cache_size
+        self.verified = OrderedDict()   # (pub_key, message, sig) -> True
+        self.keys = OrderedDict()       # pub_key -> VerifyingKey
+        self.pool = None                # created when needed for the first time
+        self.lock = threading.Lock()
+
+        self.count = 0          # the number of signatures verified
+        self.hits = 0           # the number of signatures found in the cache
+        self.seconds = 0.0      # the time spent on verification
+
+    def get_key(self, pub_key):
+        return get_cached_key(self.keys, pub_key, self.key_cache_size)
+
+    def verify_local(self, items):
+        res = []
+        for pub_key, message, sig in items:
+            if not isinstance(pub_key, str):
+                res.append(False)
+                continue
+            try:
+                vk = self.get_key(pub_key)
+            except Exception:
+                res.append(False)
+                continue
+            res.append(verify_signature(vk, message, sig))
+        return res
+
+    def verify_parallel(self, items):
+        if self.pool is None:
+            context = multiprocessing.get_context('fork') \
+                if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=context,
+                                            initializer=_init_worker, initargs=(self.key_cache_size, ))
+        batches = [items[i:i+self.batch_size] for i in range(0, len(items), self.batch_size)]
+        res = []
+        for batch_res in self.pool.map(_verify_batch, batches):
+            res.extend(batch_res)
+        return res
+
+    def verify(self, items):
+        '''
+        Verify a list of signatures
+        :param items: <list> [(pub_key, message, sig)], the keys and signatures are hex strings
+        :return: <bool> True if all of them are valid
+        '''
+        if not all([is_signature(item) for item in items]):
+            return False    # a key or a signature of a peer is not a string, which can't be cached
+        with self.lock:
+            pending = []
+            for item in items:
+                if item in self.verified:
+                    self.verified.move_to_end(item)
+                    self.hits += 1
+                else:
+                    pending.append(item)
+            if len(pending) == 0:
+                return True
+
+            start = time()
+            if self.workers == 1 or len(pending) < 2 * self.batch_size:
+                res = self.verify_local(pending)     # not worth the processes
+            else:
+                res = self.verify_parallel(pending)
+            self.seconds += time() - start
+            self.count += len(pending)
+            SIGNATURES_VERIFIED.inc(len(pending))
+
+            for item, valid in zip(pending, res):
+                if valid is True:
+                    self.verified[item] = True
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+            return all(res)
+
+    def get_stats(self):
+        '''
+        :return: <dict> {'verified', 'cache_hits', 'seconds', 'rate'}, rate is verifications per second
+        '''
+        return {
+            'verified': self.count,
+            'cache_hits': self.hits,
+            'seconds': self.seconds,
+            'rate': self.count / self.seconds if self.seconds > 0 else 0.0,
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -2,17 +2,25 @@
 # Created by Ao Wang, 15300240004. All rights reserved.
 # This file implements the wallet of the blockchain
 
+import atexit
 import json
 import pickle   # we use pickle to store and load data
 import sys
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 from urllib.parse import urlparse
+
 import requests
 
 from flask import Flask, jsonify, request
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
 
 from block_chain import *
+from mempool import *
+from metrics import *
+from peers import *
 from utils import *
 
 path = sys.path[0]
@@ -20,18 +28,29 @@ os.chdir(path)  # change to current directory
 
 
 class Wallet(object):
-    def __init__(self, key_gen=False, load_key=True):
+    def __init__(self, key_gen=False, load_key=True, data_dir='database'):
         '''
         Initialize the wallet
         Default is to load existed keys
         User can choose to load exists keys in .pkl file
+        :param data_dir: <str> the directory of keys and the block chain
         '''
         self.pri_key = None                 # private key
         self.pub_key = None                 # public key
         self.address = None                 # wallet address
+        self.data_dir = data_dir
 
-        self.blockchain = BlockChain()      # the block chain in this wallet
+        self.blockchain = BlockChain(data_dir)  # the block chain in this wallet
         self.peers = []                     # other wallet peers in the network, which are neighbors
+        self.client = PeerClient()          # pooled connections to the peers
+        self.mempool = Mempool()            # the signed transactions waiting to be mined
+        self.quorum = None                  # the number of peer tips to wait for, None for a majority
+        self.last_sync = None               # the time of the last consensus with the peers
+        self.sync_interval = None           # seconds between two rounds of background sync
+        self.sync_stop = threading.Event()  # stop the background sync
+        self.inventory = Inventory()        # the hashes of the blocks and transactions seen by the gossip
+        self.node_address = None            # where the peers fetch the announced bodies. Eg. '192.168.0.5:5000'
+        self.gossip = ThreadPoolExecutor(1) # the announcements are handled one by one
 
         if key_gen is True and load_key is not True:
             self.generate_keys()
@@ -42,24 +61,40 @@ class Wallet(object):
             print ('key_gen and load_key can\'t have the same boolean value!')
             exit(0)
 
-        if os.path.exists('database/blockchain.pkl') is True:
-            with open('database/blockchain.pkl', 'rb') as file:
-                self.blockchain = pickle.load(file)
-        else:
-            # the very first block
-            block = get_empty_block()
-            block['index'] = 0
-            block['Blockheader']['hashPreBlock'] = 1
-            self.blockchain.chain.append(block)
+        if len(self.blockchain.chain) == 0:
+            legacy_path = os.path.join(data_dir, 'blockchain.pkl')
+            if os.path.exists(legacy_path) is True:
+                # move the chain pickled by older versions into the block store,
+                # their balances are kept, see UTXOSet.connect_legacy()
+                with open(legacy_path, 'rb') as file:
+                    legacy = pickle.load(file)
+                if len(legacy.chain) - 1 > LEGACY_HEIGHT:
+                    print ('The chain of older versions is higher than %d, it can\'t be moved!'%LEGACY_HEIGHT)
+                    exit(0)
+                for block in legacy.chain:
+                    if self.blockchain.add_block(block) is not True:
+                        self.blockchain.rewind(-1)
+                        print ('Block %d of the chain of older versions is invalid, it can\'t be moved!'%block['index'])
+                        exit(0)
+            else:
+                # the very first block
+                block = get_empty_block()
+                block['index'] = 0
+                block['Blockheader']['hashPreBlock'] = 1
+                self.blockchain.add_block(block)
+            self.store_chain(force=True)
+        atexit.register(self.store_chain, force=True)   # the batched blocks are committed on exit
         
         # update to the newest chain
-        self.resolve_conflicts()
+        self.sync()
 
 
-    def store_chain(self):
-        # store the Blockchain object
-        with open('database/blockchain.pkl', 'wb') as file:
-            pickle.dump(self.blockchain, file)
+    def store_chain(self, force=False):
+        '''
+        Commit the new blocks to the block store
+        :param force: <bool> fsync now, otherwise fsync is batched
+        '''
+        self.blockchain.commit(force)
 
     
     def generate_keys(self):
@@ -68,17 +103,17 @@ class Wallet(object):
         Use .to_string().hex() to get hex string from the object
         '''
         self.pri_key = SigningKey.generate(curve=SECP256k1) # protocol for Bitcoin
-        with open ('database/pri_key.pem','w') as file:
+        with open (os.path.join(self.data_dir, 'pri_key.pem'),'w') as file:
             # use SSL standard to store key
             file.write(self.pri_key.to_pem().decode())
         
         self.pub_key = self.pri_key.get_verifying_key()
-        with open('database/pub_key.pem','w') as file:
+        with open(os.path.join(self.data_dir, 'pub_key.pem'),'w') as file:
             # use SSL standard to store key
             file.write(self.pub_key.to_pem().decode())
         
         self.address = get_wallet_address(self.pub_key)
-        with open('database/address.pkl', 'wb') as file:
+        with open(os.path.join(self.data_dir, 'address.pkl'), 'wb') as file:
             pickle.dump(self.address, file)
         
         print ('Current wallet address: %s'%self.address)
@@ -86,33 +121,65 @@ class Wallet(object):
 
     def load_keys(self):
         # load keys and address from existed files
-        if os.path.exists('database/pri_key.pem') is not True \
-            or os.path.exists('database/pub_key.pem') is not True \
-            or os.path.exists('database/address.pkl') is not True:
+        if os.path.exists(os.path.join(self.data_dir, 'pri_key.pem')) is not True \
+            or os.path.exists(os.path.join(self.data_dir, 'pub_key.pem')) is not True \
+            or os.path.exists(os.path.join(self.data_dir, 'address.pkl')) is not True:
             self.generate_keys()
         else:
-            self.pri_key = SigningKey.from_pem(open('database/pri_key.pem').read())
-            self.pub_key = VerifyingKey.from_pem(open('database/pub_key.pem').read())
-            with open('database/address.pkl', 'rb') as file:
+            self.pri_key = SigningKey.from_pem(open(os.path.join(self.data_dir, 'pri_key.pem')).read())
+            self.pub_key = VerifyingKey.from_pem(open(os.path.join(self.data_dir, 'pub_key.pem')).read())
+            with open(os.path.join(self.data_dir, 'address.pkl'), 'rb') as file:
                 self.address = pickle.load(file)
             print ('Current wallet address: %s'%self.address)
     
 
-    def get_balance(self):
+    def sync(self):
+        '''
+        Update to the newest chain of the peers
+        last_sync is moved only by a round in which a peer answered
+        :return: <bool> True if our chain was replaced, False if not
+        '''
+        with SYNC_SECONDS.time():
+            return self.resolve_conflicts()
+
+
+    def start_sync(self, interval):
+        '''
+        Keep the chain current in a background thread, so reading needs no network
+        :param interval: <float> seconds between two rounds of consensus
+        '''
+        def loop():
+            while self.sync_stop.wait(interval) is not True:
+                try:
+                    self.sync()
+                except Exception as e:
+                    print ('Sync failed: %s'%e)
+
+        self.sync_interval = interval
+        self.sync_stop.clear()
+        threading.Thread(target=loop, daemon=True).start()
+
+
+    def get_staleness(self):
+        '''
+        Seconds since the last consensus with the peers
+        :return: <float> None if never synced
+        '''
+        if self.last_sync is None:
+            return None
+        return time() - self.last_sync
+
+
+    def get_balance(self, fresh=False):
         '''
         Get the remaining balance of this wallet
+        :param fresh: <bool> update from the peers first, otherwise read the local chain
         :return balance: <float> the balance
         '''
-        self.resolve_conflicts()    # update
-        balance = 0.0
-
-        # check the output only
-        # even if all the coins are transfered to others,
-        # we transfer 0.0 to ourself, which is easier to calculate balance
-        for block in self.blockchain.chain:
-            block_amount = self.get_block_balance(block)
-            balance += block_amount
-        return balance
+        if fresh is True:
+            self.sync()    # update
+        with self.blockchain.lock:  # the unspent outputs are changed in place by the writes
+            return self.blockchain.utxo.get_balance(self.address)
     
 
     def get_block_balance(self, block):
@@ -122,17 +189,17 @@ class Wallet(object):
         :return amount: <float> the output amount
         '''
         amount = 0.0
-        flag = False
-        lis = block['Transaction']['out']
-        for dic in lis:
-            if dic['address'] == self.address:
-                flag = True
-                break
-        
-        if flag is False:
-            # has nothing to do with me
-            return amount
-        else:
+        for trans in get_transactions(block):
+            flag = False
+            lis = trans['out']
+            for dic in lis:
+                if dic['address'] == self.address:
+                    flag = True
+                    break
+            
+            if flag is False:
+                # has nothing to do with me
+                continue
             if len(lis) == 1:
                 # reward of mining
                 amount += lis[0]['value']
@@ -150,29 +217,150 @@ class Wallet(object):
         return amount
 
 
-    def get_transaction_input_blocks(self, amount):
+    def mine_block(self, max_transactions):
         '''
-        Get a list of blocks acting as the input of a transaction with my coins
+        Find a proof and add a new block with the pooled transactions. Reward is 5.0 coins.
+        :param max_transactions: <int> the most transactions packed from the pool
+        :return: <dict> the new block, None if the search was cancelled
+        '''
+        proof = self.blockchain.proof_of_work()    # do the calculation
+        if proof is None:
+            return None
+        with self.blockchain.writing():
+            block = self.make_block(max_transactions)
+            added = self.blockchain.add_block(block)
+            self.mempool.update(self.blockchain.utxo)   # drops the spends the chain rejects too
+            if added is not True:
+                return None
+            self.store_chain()
+        MINED_BLOCKS.inc()
+        self.announce_block(self.blockchain.hash(block), block['index'])
+        return block
+
+
+    def make_block(self, max_transactions):
+        '''
+        Create the next block of the chain with the pooled transactions, call it on the writer path
+        :param max_transactions: <int> the most transactions packed from the pool
+        :return: <dict> the block
+        '''
+        last_block = self.blockchain.last_block
+
+        # create a new block
+        block = get_empty_block()
+        block['index'] = last_block['index'] + 1
+        block['Blockheader']['hashPreBlock'] = self.blockchain.hash(last_block)
+        block['Blockheader']['hashMerkleRoot'] = self.blockchain.merkle_root()
+
+        # pack the transactions in the pool, the fees go to the miner
+        transactions = self.mempool.select(max_transactions)
+        fees = sum([self.mempool.fees[trans['hash']] for trans in transactions])
+        reward = BLOCK_REWARD + fees
+
+        # refer to the previous block, so every reward has its own transaction hash
+        trans_in = get_trans_in(pre_hash=block['Blockheader']['hashPreBlock'], n=reward, sig='system')
+        block['Transaction']['in'].append(trans_in)
+
+        trans_out = get_trans_out(value=reward, address=self.address, from_address='system')
+        block['Transaction']['out'].append(trans_out)
+
+        block['Transaction']['hash'] = get_trans_hash(block['Transaction'])
+        block['Transactions'] = transactions
+        block['Blockheader']['hashTransRoot'] = get_trans_root(get_transactions(block))
+        return block
+
+
+    def get_transaction_inputs(self, amount):
+        '''
+        Get a list of unspent outputs acting as the inputs of a transaction with my coins
+        The outputs spent by the transactions in the pool are skipped
         :param amount: <float> the needed amount
-        :return block_dict: <dict> the dict of blocks and balance or None
+        :return inputs: <list> [((hash, index), value)] or None
         '''
         balance = 0.0
-        block_dict = {}
-
-        # check the output only
-        for block in self.blockchain.chain:
-            pre_balance = balance
-            block_balance = self.get_block_balance(block)
-            if block_balance != 0.0:
-                balance += block_balance
-                block_str = str(block)
-                block_dict[block_str] = block_balance   # use str as hash key
-            if pre_balance < amount and balance >= amount:
-                return block_dict
+        inputs = []
+
+        for key, value in self.blockchain.utxo.get_unspent(self.address):
+            if key in self.mempool.spent:
+                continue
+            inputs.append((key, value))
+            balance += value
+            if balance >= amount:
+                return inputs
         
-        if balance < amount:
-            return None # coins not enough
-    
+        return None # coins not enough
+
+
+    def new_transaction(self, amount, address, fee=0.0):
+        '''
+        Create a signed transaction and add it to the pool
+        even if all the coins are transfered to others,
+        we transfer 0.0 to ourself, which is easier to calculate balance
+        :param amount: <float> the amount to transfer
+        :param address: <str> the target wallet address
+        :param fee: <float> the fee for the miner
+        :return: <tuple> (transaction, reason), reason is None if it's added to the pool
+        '''
+        with self.blockchain.writing():
+            # the inputs are not spent by another transfer in the meantime
+            inputs = self.get_transaction_inputs(amount + fee)
+            if inputs is None:
+                return None, 'Balance not enough'
+
+            trans = self.make_transaction(inputs, amount, address, fee)
+            reason = self.mempool.add(trans, self.blockchain.utxo, self.blockchain.verifier)
+        if reason is None:
+            self.announce_transaction(trans['hash'])
+        return trans, reason
+
+
+    def submit_transaction(self, trans):
+        '''
+        Add a transaction signed by another wallet to the pool and announce it
+        :param trans: <dict> the transaction
+        :return: <str> the reason if it's rejected, None if it's added
+        '''
+        with self.blockchain.writing():
+            reason = self.mempool.add(trans, self.blockchain.utxo, self.blockchain.verifier)
+        if reason is None:
+            self.announce_transaction(trans['hash'])
+        return reason
+
+
+    def make_transaction(self, inputs, amount, address, fee=0.0):
+        '''
+        Sign a transaction spending my unspent outputs
+        :param inputs: <list> [((hash, index), value)], the outputs to spend
+        :param amount: <float> the amount to transfer
+        :param address: <str> the target wallet address
+        :param fee: <float> the fee for the miner
+        :return: <dict> the transaction
+        '''
+        trans = get_empty_trans()
+        # deploy tran_in
+        coins = 0.0
+        for key, value in inputs:
+            pre_hash, index = key
+            coins += value  # all the coins of the output are spent
+
+            prev_out = {}
+            prev_out['hash'] = pre_hash
+            prev_out['n'] = value
+            prev_out['index'] = index
+
+            sig = self.pri_key.sign(get_sign_message(prev_out)).hex() # str, use private key to sign the hash
+            pub_key = self.pub_key.to_string().hex()   # str
+            
+            trans_in = get_trans_in(pre_hash=pre_hash, n=value, sig=sig, pub_key=pub_key, index=index)   # dict
+            trans['in'].append(trans_in) # add the input
+        
+        trans_out_1 = get_trans_out(value=amount, address=address, from_address=self.address)
+        trans_out_2 = get_trans_out(value=coins-amount-fee, address=self.address, from_address=self.address)    # the change (maybe 0.0) to my wallet
+        trans['out'].append(trans_out_1)
+        trans['out'].append(trans_out_2)
+        trans['hash'] = get_trans_hash(trans)
+        return trans
+
 
     def peer_register(self, address):
         """
@@ -186,34 +374,250 @@ class Wallet(object):
         self.peers = list( set(self.peers) )    # delete the duplicate ones
 
 
+    def find_common_ancestor(self, node, length):
+        """
+        Find the last block shared with a peer by comparing the block hashes in its headers
+        The window of headers doubles every round, so a long fork costs O(log n) requests
+        :param node: <str> the peer
+        :param length: <int> the length of the peer's chain
+        :return: <int> the height of the common ancestor, -1 if there is none, None if the peer fails
+        """
+        return find_common_ancestor(self.client, node, length, len(self.blockchain.chain), self.blockchain.block_hash)
+
+
+    def fetch_peer_chain(self, node, length):
+        """
+        Download the blocks of a peer after the common ancestor only
+        The blocks are parsed and validated one by one as they arrive,
+        the transfer is stopped at the first invalid block
+        :param node: <str> the peer
+        :param length: <int> the length of the peer's chain
+        :return: <ForkedChain> the validated chain of the peer, None if the peer fails or its chain is invalid
+        """
+        height = self.find_common_ancestor(node, length)
+        if height is None:
+            return None
+        response = self.client.request(node, '/chain', params={'from': height + 1, 'format': 'ndjson'},
+                                       timeout=self.client.download_timeout, stream=True)
+        if response is None:
+            return None
+
+        validator = self.blockchain.start_validation(height)
+        blocks = []
+        size = 0
+        try:
+            if response.status_code != 200:
+                return None
+            for line in response.iter_lines():
+                size += len(line) + 1
+                if len(line) == 0:
+                    continue
+                block = to_block(json.loads(line))  # hashed once from now on
+                if validator.add(block) is not True:
+                    return None     # stop downloading
+                blocks.append(block)
+                if height + 1 + len(blocks) >= length:
+                    break   # no more than the peer claimed
+        except (ValueError, requests.RequestException):
+            return None     # broken response
+        finally:
+            response.close()
+            CHAIN_PAYLOAD_BYTES.observe(size, direction='received')
+        if validator.finish() is not True:
+            return None
+
+        self.blockchain.mark_validated(validator)
+        return ForkedChain(self.blockchain.chain, height, blocks)
+
+
     def resolve_conflicts(self):
         """
         This is our Consensus Algorithm, it resolves conflicts.
         Replace my chain with the longest one
+        The tips of all the peers are queried in parallel, the longest valid chain is downloaded
+        after the common ancestor, and our chain switches to it by detaching only the blocks after the ancestor
         :return: <bool> True if our chain was replaced, False if not
         """
         neighbors = self.peers
         new_chain = None
+        known_branch = False    # the longest chain is a branch in our tree
 
         max_length = len(self.blockchain.chain)
 
-        for node in neighbors:
-            response = requests.get(f'http://{node}/chain')
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                if length > max_length and self.blockchain.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+        quorum = self.quorum or len(neighbors) // 2 + 1
+        tips = self.client.fan_out(neighbors, '/chain/tip', quorum=quorum)
+        tips = dict([(node, tip) for node, tip in tips.items() if isinstance(tip, dict) and type(tip.get('length')) is int])
+        SYNC_PEER_REPLIES.set(len(tips))
+        # try the longest first
+        for node in sorted(tips, key=lambda node: tips[node]['length'], reverse=True):
+            if tips[node]['length'] <= max_length:
+                break
+            if tips[node].get('hash') in self.blockchain.tree:
+                # a branch we have left before, its blocks are kept in the tree
+                known_branch = True
+                break
+            chain = self.fetch_peer_chain(node, tips[node]['length'])     # validated already
+            if chain is not None and len(chain) > max_length:
+                max_length = len(chain)
+                new_chain = chain
+                break
         
-        if new_chain:
-            assert self.blockchain.valid_chain(new_chain) == True
-            self.blockchain.chain = new_chain
-            self.store_chain()  # store the new one
-            return True
-        return False
+        replaced = False
+        if new_chain or known_branch:
+            replaced = self.adopt_branch(new_chain)
+        if len(tips) > 0:
+            self.last_sync = time()     # a peer answered, no sync when all of them fail
+        return replaced
+
+
+    def adopt_branch(self, chain=None):
+        '''
+        Keep a validated branch in the tree, then switch to the best tip
+        :param chain: <ForkedChain> the branch, None to choose among the branches in the tree
+        :return: <bool> True if our chain was replaced, False if not
+        '''
+        with self.blockchain.writing():
+            if chain is not None:
+                self.blockchain.add_branch(chain.height, chain.blocks)
+            detached = self.blockchain.reorganize()
+            if detached is None:
+                return False
+            self.mempool.update(self.blockchain.utxo)
+            self.mempool.restore(detached, self.blockchain.utxo, self.blockchain.verifier)
+            self.store_chain(force=True)  # store the new one
+        CHAIN_REPLACEMENTS.inc()
+        REORG_DEPTH.observe(len(detached))
+        self.blockchain.cancel_mining()  # the block being mined is stale
+        return True
+
+
+    def announce_block(self, block_hash, height, exclude=None):
+        '''
+        Tell the peers about a block on our chain, they fetch it from us if it's new to them
+        :param block_hash: <str> the hash of the block
+        :param height: <int> the height of the block
+        :param exclude: <str> the peer it came from
+        :return: <int> the number of peers told
+        '''
+        self.inventory.add(block_hash)
+        if self.node_address is None:
+            return 0    # nowhere to fetch it from
+        peers = [node for node in self.peers if node != exclude]
+        body = {'hash': block_hash, 'height': height, 'node': self.node_address}
+        count = self.client.broadcast(peers, '/blocks/announce', body)    # the unhealthy peers are skipped
+        GOSSIP_RELAYED.inc(count, kind='block')
+        return count
+
+
+    def announce_transaction(self, trans_hash, exclude=None):
+        '''
+        Tell the peers about a transaction in our pool
+        :param trans_hash: <str> the hash of the transaction
+        :param exclude: <str> the peer it came from
+        :return: <int> the number of peers told
+        '''
+        self.inventory.add(trans_hash)
+        if self.node_address is None:
+            return 0
+        peers = [node for node in self.peers if node != exclude]
+        body = {'hash': trans_hash, 'node': self.node_address}
+        count = self.client.broadcast(peers, '/tx/announce', body)    # the unhealthy peers are skipped
+        GOSSIP_RELAYED.inc(count, kind='transaction')
+        return count
+
+
+    def receive_block(self, block_hash, height, node):
+        '''
+        Handle a block announced by a peer: fetch its body if it's new, add it and relay it
+        The hash claimed in the inventory is released, it's remembered only if the block is accepted
+        :param block_hash: <str> the hash of the block
+        :param height: <int> the height it claims
+        :param node: <str> the peer to fetch it from
+        :return: <bool> True if our chain was changed
+        '''
+        try:
+            return self.fetch_block(block_hash, height, node)
+        finally:
+            self.inventory.release(block_hash)
+
+
+    def fetch_block(self, block_hash, height, node):
+        # a block extending our tip is validated alone, otherwise the peer's chain is fetched after the common ancestor
+        if self.blockchain.tree.get_height(block_hash, height) is not None:
+            self.inventory.add(block_hash)
+            GOSSIP_MESSAGES.inc(kind='block', result='known')
+            return False
+        if height >= len(self.blockchain.chain):
+            res = self.client.get_json(node, '/blocks/' + block_hash)
+            try:
+                block = to_block(res['block']) if res is not None else None
+            except (KeyError, TypeError, ValueError):
+                block = None
+            if block is None or self.blockchain.hash(block) != block_hash:
+                GOSSIP_MESSAGES.inc(kind='block', result='rejected')
+                return False
+
+            with self.blockchain.writing():
+                extended = block['index'] == len(self.blockchain.chain) \
+                    and block['Blockheader']['hashPreBlock'] == self.blockchain.block_hash(-1)
+                if extended:
+                    # the next block of our chain
+                    validator = self.blockchain.start_validation(len(self.blockchain.chain) - 1)
+                    if validator.add(block) is not True or validator.finish() is not True \
+                        or self.blockchain.add_block(block) is not True:
+                        GOSSIP_MESSAGES.inc(kind='block', result='rejected')
+                        return False
+                    self.blockchain.mark_validated(validator)
+                    self.mempool.update(self.blockchain.utxo)
+                    self.store_chain()
+            if extended:
+                self.blockchain.cancel_mining()  # the block being mined is stale
+                GOSSIP_MESSAGES.inc(kind='block', result='accepted')
+                self.announce_block(block_hash, block['index'], exclude=node)
+                return True
+
+        # on another branch, or we are behind by more than one block
+        chain = self.fetch_peer_chain(node, height + 1)
+        if chain is None or self.adopt_branch(chain) is not True:
+            GOSSIP_MESSAGES.inc(kind='block', result='rejected')
+            return False
+        GOSSIP_MESSAGES.inc(kind='block', result='accepted')
+        self.inventory.add(block_hash)  # on our chain or on a kept branch
+        self.announce_block(self.blockchain.block_hash(-1), len(self.blockchain.chain) - 1, exclude=node)
+        return True
+
+
+    def receive_transaction(self, trans_hash, node):
+        '''
+        Handle a transaction announced by a peer: fetch it if it's new, add it to the pool and relay it
+        :param trans_hash: <str> the hash of the transaction
+        :param node: <str> the peer to fetch it from
+        :return: <bool> True if it's added to the pool
+        '''
+        try:
+            return self.fetch_transaction(trans_hash, node)
+        finally:
+            self.inventory.release(trans_hash)
+
 
+    def fetch_transaction(self, trans_hash, node):
+        # the hash is remembered by announce_transaction() once the transaction is in the pool
+        if trans_hash in self.mempool:
+            self.inventory.add(trans_hash)
+            GOSSIP_MESSAGES.inc(kind='transaction', result='known')
+            return False
+        trans = self.client.get_json(node, '/tx/' + trans_hash)
+        if trans is None or trans.get('hash') != trans_hash:
+            GOSSIP_MESSAGES.inc(kind='transaction', result='rejected')
+            return False
+        with self.blockchain.writing():
+            reason = self.mempool.add(trans, self.blockchain.utxo, self.blockchain.verifier)
+        if reason is not None:
+            GOSSIP_MESSAGES.inc(kind='transaction', result='rejected')
+            return False
+        GOSSIP_MESSAGES.inc(kind='transaction', result='accepted')
+        self.announce_transaction(trans_hash, exclude=node)
+        return True
 
 
 if __name__ == '__main__':
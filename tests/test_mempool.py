@@ -0,0 +1,49 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file tests the malformed transactions are rejected by the pool with a reason.
+
+from block_chain import *
+from mempool import *
+from test_utxo import make_block, make_chain, make_key, make_transfer
+
+
+def make_pool():
+    # a chain with one reward to spend
+    blockchain = make_chain()
+    key, pub_key, address = make_key()
+    assert blockchain.add_block(make_block(blockchain, address)) is True
+    trans = make_transfer(key, pub_key, address, blockchain.utxo.get_unspent(address)[0], 1.0, 'other')
+    return blockchain, Mempool(), trans
+
+
+def rehash(trans):
+    trans['hash'] = get_trans_hash(trans)
+    return trans
+
+
+def test_valid_transaction():
+    blockchain, mempool, trans = make_pool()
+    assert mempool.add(trans, blockchain.utxo, blockchain.verifier) is None
+
+
+def test_malformed_transactions():
+    blockchain, mempool, trans = make_pool()
+    check = lambda trans: mempool.check(trans, blockchain.utxo, blockchain.verifier)
+    assert check([]) == 'Malformed transaction'
+    assert check({'hash': '', 'in': {}, 'out': []}) == 'Malformed transaction'
+    assert check(rehash({'in': ['input'], 'out': trans['out']})) == 'Malformed input'
+    assert check(rehash({'in': [{'prev_out': 'output', 'sig': ''}], 'out': trans['out']})) == 'Malformed input'
+
+    for field, value in [('sig', 1), ('sig', None), ('pub_key', ['key'])]:
+        trans_in = dict(trans['in'][0])
+        trans_in[field] = value
+        assert check(rehash({'in': [trans_in], 'out': trans['out']})) == 'Malformed input'
+    for field, value in [('hash', ['hash']), ('index', {}), ('n', '5.0')]:
+        trans_in = dict(trans['in'][0])
+        trans_in['prev_out'] = dict(trans_in['prev_out'])
+        trans_in['prev_out'][field] = value
+        assert check(rehash({'in': [trans_in], 'out': trans['out']})) == 'Malformed input'
+
+    assert check(rehash({'in': trans['in'], 'out': [1.0]})) == 'Malformed output'
+    assert check(rehash({'in': trans['in'], 'out': [{'value': 1.0, 'address': None}]})) == 'Malformed output'
+    assert len(mempool) == 0
@@ -0,0 +1,131 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file tests the chain pickled by older versions is moved into the block store with its balances.
+
+import hashlib
+import json
+import os
+import pickle
+from types import SimpleNamespace
+
+import pytest
+from ecdsa import SigningKey, SECP256k1
+
+import wallet
+from wallet import Wallet
+from block_chain import *
+
+
+def legacy_block(chain):
+    # the next block, as the /mine and /transactions/new of older versions created it
+    block = {'index': chain[-1]['index'] + 1, 'Transaction': {'hash': None, 'in': [], 'out': []}}
+    mt = Merkle_Tree(chain)
+    mt.create_tree()
+    block['Blockheader'] = {
+        'hashPreBlock': hashlib.sha256(json.dumps(chain[-1], sort_keys=True).encode()).hexdigest(),
+        'hashMerkleRoot': mt.get_root_transaction(),
+        'timestamp': 0.0,
+    }
+    return block
+
+
+def legacy_trans_hash(block):
+    temp = {'in': block['Transaction']['in'], 'out': block['Transaction']['out']}
+    block['Transaction']['hash'] = hashlib.sha256(json.dumps(temp, sort_keys=True).encode()).hexdigest()
+
+
+def legacy_mine(chain, address):
+    block = legacy_block(chain)
+    block['Transaction']['in'].append({'prev_out': {'hash': None, 'n': 5.0}, 'sig': 'system', 'pub_key': None})
+    block['Transaction']['out'].append({'value': 5.0, 'address': address, 'from_address': 'system'})
+    legacy_trans_hash(block)
+    chain.append(block)
+
+
+def legacy_transfer(chain, pri_key, address, amount, target):
+    # the blocks with a balance are the inputs, until they cover the amount
+    owner = SimpleNamespace(address=address)
+    block_dict = []
+    balance = 0.0
+    for block in chain:
+        block_balance = Wallet.get_block_balance(owner, block)
+        if block_balance != 0.0:
+            balance += block_balance
+            block_dict.append((block, block_balance))
+        if balance >= amount:
+            break
+    assert balance >= amount
+
+    new_block = legacy_block(chain)
+    coins = 0.0
+    for block, block_balance in block_dict:
+        n = block_balance if coins + block_balance < amount else amount - coins
+        coins += block_balance
+        prev_out = {'hash': block['Transaction']['hash'], 'n': n}
+        sig = pri_key.sign(get_sign_message(prev_out)).hex()
+        new_block['Transaction']['in'].append({'prev_out': prev_out, 'sig': sig,
+                                               'pub_key': pri_key.get_verifying_key().to_string().hex()})
+    new_block['Transaction']['out'].append({'value': amount, 'address': target, 'from_address': address})
+    new_block['Transaction']['out'].append({'value': coins-amount, 'address': address, 'from_address': address})
+    legacy_trans_hash(new_block)
+    chain.append(new_block)
+
+
+def make_legacy_dir(directory):
+    # 3 mines and 4 transfers of the same wallet, its keys and the pickled chain
+    pri_key = SigningKey.generate(curve=SECP256k1)
+    address = get_wallet_address(pri_key.get_verifying_key())
+    target = get_wallet_address(SigningKey.generate(curve=SECP256k1).get_verifying_key())
+    chain = [{'index': 0, 'Blockheader': {'hashPreBlock': 1, 'hashMerkleRoot': None, 'timestamp': 0.0},
+              'Transaction': {'hash': None, 'in': [], 'out': []}}]
+    for _ in range(3):
+        legacy_mine(chain, address)
+    for amount in [3, 1, 2.5, 0.5]:
+        legacy_transfer(chain, pri_key, address, amount, target)
+
+    with open(os.path.join(directory, 'pri_key.pem'), 'w') as file:
+        file.write(pri_key.to_pem().decode())
+    with open(os.path.join(directory, 'pub_key.pem'), 'w') as file:
+        file.write(pri_key.get_verifying_key().to_pem().decode())
+    with open(os.path.join(directory, 'address.pkl'), 'wb') as file:
+        pickle.dump(address, file)
+    legacy = BlockChain.__new__(BlockChain)     # older versions pickled the whole chain
+    legacy.__dict__ = {'chain': chain}
+    with open(os.path.join(directory, 'blockchain.pkl'), 'wb') as file:
+        pickle.dump(legacy, file)
+    return chain, address, target
+
+
+def test_migrate_balances(tmp_path):
+    chain, address, target = make_legacy_dir(str(tmp_path))
+    balance = sum([Wallet.get_block_balance(SimpleNamespace(address=address), block) for block in chain])
+    assert balance == 8.0
+
+    my_wallet = Wallet(data_dir=str(tmp_path))
+    assert len(my_wallet.blockchain.chain) == len(chain)
+    assert my_wallet.get_balance() == 8.0
+    assert my_wallet.blockchain.utxo.get_balance(target) == 7.0
+
+    # the moved balance is spent as an output, then the blocks of older versions end
+    trans, reason = my_wallet.new_transaction(7.5, target)
+    assert reason is None
+    with my_wallet.blockchain.writing():
+        assert my_wallet.blockchain.add_block(my_wallet.make_block(10)) is True
+    assert my_wallet.get_balance() == 0.5 + BLOCK_REWARD
+    assert my_wallet.blockchain.utxo.get_balance(target) == 14.5
+
+    block = legacy_block(list(my_wallet.blockchain.chain))
+    block['Transaction']['out'].append({'value': 1e9, 'address': target, 'from_address': 'system'})
+    legacy_trans_hash(block)
+    assert my_wallet.blockchain.add_block(block) is False
+
+    # connected with the same rules when loaded
+    my_wallet.store_chain(force=True)
+    assert Wallet(data_dir=str(tmp_path)).get_balance() == 0.5 + BLOCK_REWARD
+
+
+def test_migrate_too_high(tmp_path, monkeypatch):
+    make_legacy_dir(str(tmp_path))
+    monkeypatch.setattr(wallet, 'LEGACY_HEIGHT', 3)
+    with pytest.raises(SystemExit):
+        Wallet(data_dir=str(tmp_path))
@@ -0,0 +1,33 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file tests the common ancestor is found from the headers of a peer, and malformed ones are ignored.
+
+from peers import *
+
+
+class FakeClient(object):
+    # answers /chain/headers with the hashes of a chain, or with a fixed response
+    def __init__(self, hashes, res=None):
+        self.hashes = hashes
+        self.res = res
+
+    def get_json(self, node, path, params=None):
+        if self.res is not None:
+            return self.res
+        stop = params['from'] + params['limit']
+        return {'headers': [{'index': i, 'hash': self.hashes[i]} for i in range(params['from'], stop)]}
+
+
+def test_find_common_ancestor():
+    local = ['h%d' % i for i in range(20)]
+    peer = local[:13] + ['p%d' % i for i in range(13, 30)]
+    assert find_common_ancestor(FakeClient(peer), 'node', 30, 20, lambda height: local[height]) == 12
+    assert find_common_ancestor(FakeClient(['x'] * 30), 'node', 30, 20, lambda height: local[height]) == -1
+
+
+def test_malformed_headers():
+    local = ['h%d' % i for i in range(20)]
+    for res in [[], {'headers': None}, {'headers': [None]}, {'headers': [{'index': '19', 'hash': 'h19'}]},
+                {'headers': [{'index': 10**9, 'hash': 'h'}]}, {'headers': [{'index': -1, 'hash': 'h'}]},
+                {'headers': [{'index': True, 'hash': 'h1'}]}]:
+        assert find_common_ancestor(FakeClient(None, res), 'node', 30, 20, lambda height: local[height]) is None
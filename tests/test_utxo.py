@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file tests the spends and the rewards checked when a block is added.
+
+from ecdsa import SigningKey, SECP256k1
+
+from block_chain import *
+
+
+def make_key():
+    pri_key = SigningKey.generate(curve=SECP256k1)
+    return pri_key, pri_key.get_verifying_key().to_string().hex(), get_wallet_address(pri_key.get_verifying_key())
+
+
+def make_chain():
+    # the genesis block only
+    blockchain = BlockChain()
+    block = get_empty_block()
+    block['index'] = 0
+    block['Blockheader']['hashPreBlock'] = 1
+    assert blockchain.add_block(block) is True
+    return blockchain
+
+
+def make_block(blockchain, address, reward=BLOCK_REWARD, transactions=()):
+    # the next block, as make_block() of the wallet creates it
+    block = get_empty_block()
+    block['index'] = len(blockchain.chain)
+    block['Blockheader']['hashPreBlock'] = blockchain.block_hash(-1)
+    block['Blockheader']['hashMerkleRoot'] = blockchain.merkle_root()
+    block['Transaction']['in'].append(get_trans_in(pre_hash=block['Blockheader']['hashPreBlock'], n=reward, sig='system'))
+    block['Transaction']['out'].append(get_trans_out(value=reward, address=address, from_address='system'))
+    block['Transaction']['hash'] = get_trans_hash(block['Transaction'])
+    block['Transactions'] = list(transactions)
+    block['Blockheader']['hashTransRoot'] = get_trans_root(get_transactions(block))
+    return block
+
+
+def make_transfer(key, pub_key, address, output, amount, target, fee=0.0):
+    # spend one output, the change goes back to the sender
+    (pre_hash, index), value = output
+    prev_out = {'hash': pre_hash, 'n': value, 'index': index}
+    trans = get_empty_trans()
+    trans['in'].append(get_trans_in(pre_hash=pre_hash, n=value, sig=key.sign(get_sign_message(prev_out)).hex(),
+                                    pub_key=pub_key, index=index))
+    trans['out'].append(get_trans_out(value=amount, address=target, from_address=address))
+    trans['out'].append(get_trans_out(value=value-amount-fee, address=address, from_address=address))
+    trans['hash'] = get_trans_hash(trans)
+    return trans
+
+
+def test_reward_with_fees():
+    blockchain = make_chain()
+    key, pub_key, address = make_key()
+    assert blockchain.add_block(make_block(blockchain, address)) is True
+
+    trans = make_transfer(key, pub_key, address, blockchain.utxo.get_unspent(address)[0], 2.0, 'other', fee=0.5)
+    block = make_block(blockchain, address, reward=BLOCK_REWARD + 0.5, transactions=[trans])
+    assert blockchain.valid_chain(blockchain.chain + [block]) is True
+    assert blockchain.add_block(block) is True
+    assert blockchain.utxo.get_balance(address) == 8.0
+    assert blockchain.utxo.get_balance('other') == 2.0
+
+
+def test_reward_too_high():
+    blockchain = make_chain()
+    _, _, address = make_key()
+    block = make_block(blockchain, address, reward=1e9)
+    assert blockchain.valid_chain(blockchain.chain + [block]) is True     # the hashes are right
+    assert blockchain.add_block(block) is False
+    assert len(blockchain.chain) == 1
+    assert blockchain.utxo.get_balance(address) == 0.0
+    assert UTXOSet.check_reward(block['Transaction'], 1.0) == 'Reward too high'
+
+
+def test_system_input_in_transactions():
+    blockchain = make_chain()
+    _, _, address = make_key()
+    assert blockchain.add_block(make_block(blockchain, address)) is True
+
+    trans = get_empty_trans()
+    trans['in'].append(get_trans_in(pre_hash=blockchain.block_hash(-1), n=1e9, sig='system'))
+    trans['out'].append(get_trans_out(value=1e9, address='thief', from_address='system'))
+    trans['hash'] = get_trans_hash(trans)
+    block = make_block(blockchain, address, transactions=[trans])
+    assert blockchain.valid_chain(blockchain.chain + [block]) is True
+    assert blockchain.add_block(block) is False
+    assert len(blockchain.chain) == 2
+    assert blockchain.utxo.get_balance('thief') == 0.0
+    assert blockchain.utxo.get_balance(address) == BLOCK_REWARD
@@ -0,0 +1,39 @@
+# -*- coding:utf-8 -*-
+# Created by Ao Wang, 15300240004. All rights reserved.
+# This file tests the signatures of other types are rejected instead of raising.
+
+from block_chain import *
+from verifier import _verify_batch, _init_worker
+from test_utxo import make_block, make_chain, make_key, make_transfer
+
+
+def test_non_string_signature():
+    key, pub_key, _ = make_key()
+    message = get_sign_message({'hash': 'hash', 'n': 1.0, 'index': 0})
+    sig = key.sign(message).hex()
+    vk = parse_key(pub_key)
+    assert verify_signature(vk, message, sig) is True
+    for bad in [123, None, ['sig'], {'sig': sig}]:
+        assert verify_signature(vk, message, bad) is False
+
+    verifier = SignatureVerifier(workers=1)
+    assert verifier.verify([(pub_key, message, sig)]) is True
+    assert verifier.verify([(pub_key, message, 123)]) is False
+    assert verifier.verify([(pub_key, message, ['sig'])]) is False
+    assert verifier.verify([(['key'], message, sig)]) is False
+    assert verifier.verify_local([(pub_key, message, 123), ({}, message, sig)]) == [False, False]
+
+    _init_worker(4)
+    assert _verify_batch([(pub_key, message, sig), (pub_key, message, 123), (None, message, sig)]) == [True, False, False]
+
+
+def test_chain_with_non_string_signature():
+    blockchain = make_chain()
+    key, pub_key, address = make_key()
+    assert blockchain.add_block(make_block(blockchain, address)) is True
+
+    trans = make_transfer(key, pub_key, address, blockchain.utxo.get_unspent(address)[0], 1.0, 'other')
+    trans['in'][0]['sig'] = 123
+    trans['hash'] = get_trans_hash(trans)
+    block = make_block(blockchain, address, transactions=[trans])
+    assert blockchain.valid_chain(blockchain.chain + [block]) is False